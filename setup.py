@@ -196,6 +196,9 @@ setup(
         ],
         'uvloop': [
             'uvloop'
+        ],
+        'numpy': [
+            'numpy'  # speeds up chunking for delta uploads
         ]
     },
 
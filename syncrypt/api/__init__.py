@@ -58,7 +58,8 @@ class SyncryptAPI():
             'stats': self.app.stats,
             'identity_state': self.app.identity.state,
             'user_key_state': self.app.identity.state, # deprecated
-            'slots': get_manager_instance().get_stats()
+            'slots': get_manager_instance().get_stats(),
+            'slot_waits': get_manager_instance().get_wait_stats()
         })
 
     @require_auth_token
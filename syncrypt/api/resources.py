@@ -158,9 +158,11 @@ class VaultResource(Resource):
             fingerprint = None
             metadata = {}
 
+        controller = self.app.vault_controllers.get(v.id)
+
         dct.update(
              folder=v.folder,
-             state=v.state,
+             state=controller.state if controller else v.state,
              remote_id=remote_id,
              metadata=metadata,
              ignore_paths=ignore_paths
@@ -6,6 +6,7 @@ import trio
 import syncrypt
 from syncrypt.api import SyncryptAPI
 from syncrypt.api.client import APIClient
+from syncrypt.backends.binary import get_manager_instance
 from syncrypt.exceptions import InvalidAuthentification, VaultFolderDoesNotExist
 from syncrypt.models import VaultState
 
@@ -65,6 +66,7 @@ class SyncryptDaemonApp(SyncryptApp):
         # It would be nice to have an erlang/elixir inspired supervisor here instead
         self.nursery.start_soon(self.refresh_vault_info_periodically)
         self.nursery.start_soon(self.refresh_flying_vaults_periodically)
+        self.nursery.start_soon(get_manager_instance().monitor_connections)
         await self.pull()
 
     async def shutdown(self):
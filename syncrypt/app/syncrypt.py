@@ -21,8 +21,10 @@ from syncrypt.managers import (BundleManager, FlyingVaultManager, RevisionManage
 from syncrypt.models import Bundle, Identity, IdentityState, Vault, VaultState, store
 from syncrypt.pipes import (DecryptRSA_PKCS1_OAEP, EncryptRSA_PKCS1_OAEP, FileWriter, Once,
                             StdoutWriter)
+from syncrypt.pipes.workers import set_worker_threads
 from syncrypt.utils.filesystem import is_empty
 from syncrypt.utils.format import format_fingerprint
+from syncrypt.utils.limiter import ByteLimiter
 
 from .vault import VaultController
 
@@ -48,10 +50,19 @@ class SyncryptApp(object):
         self.limiters = {
             'update': trio.CapacityLimiter(8),
             'stat': trio.CapacityLimiter(8),
-            'upload': trio.CapacityLimiter(8),
-            'download': trio.CapacityLimiter(8),
+            'upload': trio.CapacityLimiter(int(self.config.app['upload_concurrency'])),
+            'download': trio.CapacityLimiter(int(self.config.app['download_concurrency'])),
         } # type: Dict[str, trio.CapacityLimiter]
 
+        # Bounds the total size of all bundles that are being downloaded at the same time
+        self.download_bytes = ByteLimiter(int(self.config.app['download_max_bytes']))
+
+        # Bounds the total size of the encrypted uploads that are spooled at the same time
+        self.spool_bytes = ByteLimiter(int(self.config.app['spool_max_bytes']))
+
+        # CPU bound pipe work is run in a bounded pool of worker threads
+        set_worker_threads(int(self.config.app['pipe_workers']))
+
         self.stats = {
             'uploads': 0,
             'downloads': 0,
@@ -602,7 +613,13 @@ class SyncryptApp(object):
             self.identity.assert_initialized()
 
             await self.sync_vault(vault)
-            limit = trio.CapacityLimiter(1)
+            limit = trio.CapacityLimiter(vault.config.upload_concurrency)
+
+            async def push_and_release(bundle):
+                try:
+                    await self.push_bundle(bundle)
+                finally:
+                    limit.release_on_behalf_of(bundle)
 
             await self.set_vault_state(vault, VaultState.SYNCING)
             async with trio.open_nursery() as nursery:
@@ -610,11 +627,11 @@ class SyncryptApp(object):
                 await self.update_vault_metadata(vault)
 
                 async for bundle in self.bundles.upload_bundles_for_vault(vault):
-                    async with limit:
-                        await self.push_bundle(bundle)
-                        # nursery.start_soon(self.push_bundle, bundle)
+                    # Stop looking for more bundles while all upload slots are taken
+                    await limit.acquire_on_behalf_of(bundle)
+                    nursery.start_soon(push_and_release, bundle)
 
-                await self.set_vault_state(vault, VaultState.READY)
+            await self.set_vault_state(vault, VaultState.READY)
         except Exception:
             vault.logger.exception("Failure during vault push")
             await self.set_vault_state(vault, VaultState.FAILURE)
@@ -632,14 +649,44 @@ class SyncryptApp(object):
             raise ValueError('Vault object is bound to a session')
 
         async with self.limiters['upload']:
-            while True:
-                try:
-                    revision = await bundle.vault.backend.upload(bundle, self.identity)
-                    await self.revisions.apply(revision, bundle.vault)
-                    break
-                except SyncRequired:
-                    await trio.sleep(1)
-                    await self.sync_vault(bundle.vault) # deadlock?
+            spool_size = bundle.upload_spool_size
+            await self.spool_bytes.acquire(spool_size)
+            try:
+                # Encryption and spooling happen concurrently. Each upload revision needs the
+                # previous one as its parent, so revisions are serialized per vault. Only
+                # backends that implement store_contents (the local backend) transfer the
+                # contents outside of the revision lock; for the binary backend, the whole
+                # transfer still happens in upload() while the lock is held.
+                hash_deferred = bundle.hash_deferred
+                await bundle.prepare_upload()
+                if hash_deferred:
+                    # The file has been hashed while spooling, remember its stat now
+                    self.bundles.save_stats([bundle])
+                    if not bundle.remote_hash_differs:
+                        bundle.vault.logger.debug('%s has not been modified', bundle)
+                        return
+                if bundle.renamed_from is None:
+                    await bundle.vault.backend.store_contents(bundle)
+                async with bundle.vault.revision_lock:
+                    while True:
+                        try:
+                            if bundle.renamed_from is not None:
+                                revision = await bundle.vault.backend.rename_file(
+                                    bundle.renamed_from, bundle, self.identity)
+                            else:
+                                revision = await bundle.vault.backend.upload(bundle,
+                                                                             self.identity)
+                            await self.revisions.apply(revision, bundle.vault)
+                            break
+                        except SyncRequired:
+                            # Syncing does not need the revision lock, only the vault lock
+                            await trio.sleep(1)
+                            await self.sync_vault(bundle.vault)
+            finally:
+                # Do not leave the spool behind if the upload failed or has been cancelled
+                with trio.CancelScope(shield=True):
+                    await bundle.discard_upload_reader()
+                await self.spool_bytes.release(spool_size)
 
             self.stats['uploads'] += 1
 
@@ -685,9 +732,12 @@ class SyncryptApp(object):
                 await self.reset_vault_database(vault)
 
             #await self.open_or_init(vault)
-            async for revision in vault.backend.changes(vault.revision, None):
-                await self.set_vault_state(vault, VaultState.SYNCING)
-                await self.revisions.apply(revision, vault)
+            async def changes():
+                async for revision in vault.backend.changes(vault.revision, None):
+                    await self.set_vault_state(vault, VaultState.SYNCING)
+                    yield revision
+
+            await self.revisions.apply_stream(changes(), vault)
 
             await self.set_vault_state(vault, VaultState.READY)
 
@@ -707,20 +757,36 @@ class SyncryptApp(object):
             # Then, we will do a change detection for the local folder and download every bundle that
             # has changed.
             # TODO: do a change detection (.vault/metadata store vs filesystem)
-            limit = trio.CapacityLimiter(1)
+            limit = trio.CapacityLimiter(vault.backend.concurrency)
+            failed = [] # type: List[Bundle]
+
+            async def pull_and_release(bundle, size):
+                try:
+                    await self.pull_bundle(bundle)
+                except Exception:
+                    vault.logger.exception("Failure while pulling %s", bundle)
+                    failed.append(bundle)
+                finally:
+                    await self.download_bytes.release(size)
+                    limit.release_on_behalf_of(bundle)
 
             try:
-                # here we should use trimeter too allow for parallel processing
-                async with trio.open_nursery():
+                async with trio.open_nursery() as nursery:
                     async for bundle in self.bundles.download_bundles_for_vault(vault):
-                        async with limit:
-                            await self.pull_bundle(bundle)
-
-                    await self.set_vault_state(vault, VaultState.READY)
+                        size = bundle.file_size or 0
+                        await limit.acquire_on_behalf_of(bundle)
+                        await self.download_bytes.acquire(size)
+                        nursery.start_soon(pull_and_release, bundle, size)
             except Exception:
                 vault.logger.exception("Failure while pulling vault")
                 await self.set_vault_state(vault, VaultState.FAILURE)
-            await self.set_vault_state(vault, VaultState.READY)
+                return
+
+            if failed:
+                vault.logger.error("Could not pull %d bundle(s)", len(failed))
+                await self.set_vault_state(vault, VaultState.FAILURE)
+            else:
+                await self.set_vault_state(vault, VaultState.READY)
 
     async def pull_bundle(self, bundle):
         'download the bundle'
@@ -730,8 +796,9 @@ class SyncryptApp(object):
 
     async def remove_bundle(self, bundle: Bundle):
         vault = bundle.vault
-        revision = await vault.backend.remove_file(bundle, self.identity)
-        await self.revisions.apply(revision, vault)
+        async with vault.revision_lock:
+            revision = await vault.backend.remove_file(bundle, self.identity)
+            await self.revisions.apply(revision, vault)
 
     async def remove_file(self, vault: Vault, path: str):
         abs_path = os.path.normpath(os.path.abspath(path))
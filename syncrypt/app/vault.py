@@ -32,6 +32,8 @@ class VaultController:
         self.vault = vault
         self.lock = trio.Lock()
         self.ready = False
+        # True until the initialization, pull and push requested on start have finished
+        self.starting = False
         self.nursery = None  # type: Optional[Nursery]
         self.update_on_idle = update_on_idle
         self.logger = VaultLoggerAdapter(self.vault, logging.getLogger(__name__))
@@ -40,6 +42,17 @@ class VaultController:
         self.file_changes_receive_channel = receive_channel # type: trio.abc.ReceiveChannel
         self.cancel_scope = trio.CancelScope()
 
+    @property
+    def state(self):
+        '''
+        The state of the vault as it is reported to clients. The vault is not ready before
+        the initialization, pull and push requested on start have finished, even though these
+        steps set the state to READY in between.
+        '''
+        if self.starting and self.vault.state == VaultState.READY:
+            return VaultState.SYNCING
+        return self.vault.state
+
     async def resync(self):
         assert self.nursery is not None
         self.nursery.start_soon(partial(self.app.sync_vault, self.vault, full=True))
@@ -121,6 +134,7 @@ class VaultController:
 
             try:
                 self.vault.check_existence()
+                await self.app.db_vaults.migrate_revision(self.vault)
                 self.vault.identity.read()
                 self.vault.identity.assert_initialized()
             except IdentityNotInitialized:
@@ -135,6 +149,7 @@ class VaultController:
             self.do_init = do_init
             self.do_push = do_push
             self.do_pull = do_pull
+            self.starting = bool(do_init or do_push or do_pull)
 
             if task_status:
                 task_status.started()
@@ -160,6 +175,7 @@ class VaultController:
                         self.do_push = None
                     elif self.do_pull:
                         await self.app.pull_vault(self.vault)
+                    self.starting = False
 
                     if self.update_on_idle:
                         self.nursery.start_soon(self.respond_to_file_changes)
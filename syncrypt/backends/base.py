@@ -1,6 +1,6 @@
 import asyncio  # pylint: disable=unused-import
 from abc import abstractmethod
-from typing import Any, List, NewType, Optional, Union  # pylint: disable=unused-import
+from typing import Any, AsyncIterator, List, NewType, Optional, Union  # pylint: disable=unused-import
 
 from typing_extensions import Protocol
 
@@ -8,6 +8,11 @@ from syncrypt.models import Bundle, Identity, Revision
 
 
 class StorageBackend(Protocol):
+    # Maximum number of transfers this backend should run at the same time
+    concurrency = 1  # type: int
+
+    # True if the backend implements rename_file
+    supports_rename = False  # type: bool
 
     def version(self):
         raise NotImplementedError()
@@ -27,6 +32,14 @@ class StorageBackend(Protocol):
     async def init(self, identity: Identity) -> Revision:
         raise NotImplementedError()
 
+    async def store_contents(self, bundle: Bundle) -> None:
+        '''
+        Transfer the contents of the bundle ahead of its upload revision. This is called
+        without holding the revision lock of the vault, so that transfers can run concurrently.
+        Backends that can only send the contents together with the revision do nothing here.
+        '''
+        pass
+
     @abstractmethod
     async def upload(self, bundle: Bundle, identity: Identity) -> Revision:
         raise NotImplementedError()
@@ -44,13 +57,16 @@ class StorageBackend(Protocol):
         raise NotImplementedError()
 
     @abstractmethod
-    async def changes(self, since_rev, to_rev):
+    def changes(self, since_rev, to_rev) -> AsyncIterator[Revision]:
         raise NotImplementedError
 
     @abstractmethod
     async def remove_file(self, bundle: Bundle, identity: Identity) -> Revision:
         raise NotImplementedError
 
+    async def rename_file(self, source: Bundle, bundle: Bundle, identity: Identity) -> Revision:
+        raise NotImplementedError
+
     async def download(self, bundle):
         raise NotImplementedError()
 
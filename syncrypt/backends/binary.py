@@ -2,19 +2,21 @@ import logging
 import math
 import ssl
 import struct
-from typing import Any, List, Optional, cast  # pylint: disable=unused-import
+from collections import deque
+from typing import Any, Deque, List, Optional, Tuple, cast  # pylint: disable=unused-import
 
 import certifi
 import iso8601
 import trio
 from erlastic import Atom
 from syncrypt import __project__, __version__
-from syncrypt.exceptions import (ConnectionResetException, InvalidAuthentification, ServerError,
-                                 SyncRequired, UnexpectedResponseException, UnsuccessfulResponse,
+from syncrypt.exceptions import (ConnectionPoolTimeout, ConnectionResetException,
+                                 InvalidAuthentification, ServerError, SyncRequired,
+                                 UnexpectedResponseException, UnsuccessfulResponse,
                                  VaultNotInitialized)
 from syncrypt.models import Bundle, Identity, Revision, RevisionOp, Vault
-from syncrypt.pipes import (ChunkedURLWriter, Limit, Once, TrioStreamReader, TrioStreamWriter,
-                            URLReader, URLWriter)
+from syncrypt.pipes import (ChunkedURLWriter, Limit, Once, ReceiveStream, TrioStreamReader,
+                            TrioStreamWriter, URLReader, URLWriter)
 from syncrypt.utils.format import format_size
 from syncrypt.vendor import bert
 from tenacity import (retry, retry_if_exception_type, retry_unless_exception_type,
@@ -34,6 +36,8 @@ BINARY_DEBUG = False
 
 NIL = Atom('nil')
 
+SLOT_STATE_SIGNS = {'idle': '*', 'busy': 'B', 'opening': 'o', 'closed': '-'}
+
 # additional vault fields
 V_BYTE_SIZE      = Atom('byte_size')
 V_FILE_COUNT     = Atom('file_count')
@@ -71,6 +75,81 @@ class BinaryStorageConnectionLoggerAdapter(logging.LoggerAdapter):
             return (msg, kwargs)
 
 
+FRAME_HEADER = struct.Struct('!I')
+
+# Initial size of the receive buffer of a connection. It grows for larger frames.
+RECEIVE_BUFFER_SIZE = 64 * 1024
+
+
+class FrameReader():
+    '''
+    Reads frames (a 4 byte length followed by a BERT packet) from a trio stream. Data is read
+    ahead into a reusable buffer, so that many small frames can be parsed from the data of a
+    single receive_some call.
+    '''
+
+    def __init__(self, stream: ReceiveStream, buffer_size: int = RECEIVE_BUFFER_SIZE) -> None:
+        self.stream = stream
+        self._buf = bytearray(buffer_size)
+        self._start = 0
+        self._end = 0
+
+    @property
+    def buffered(self) -> int:
+        return self._end - self._start
+
+    async def read_frame(self) -> memoryview:
+        '''
+        Return the next frame without its length. The memoryview points into the receive
+        buffer and is only valid until the next read.
+        '''
+        await self._fill(FRAME_HEADER.size)
+        packet_length, = FRAME_HEADER.unpack_from(self._buf, self._start)
+        assert packet_length > 0
+        await self._fill(FRAME_HEADER.size + packet_length)
+        start = self._start + FRAME_HEADER.size
+        self._start = start + packet_length
+        return memoryview(self._buf)[start:self._start]
+
+    async def receive_some(self, max_bytes: Optional[int] = None) -> bytes:
+        '''
+        Read raw data that follows a frame, like the contents of a download. Data that has
+        already been read ahead is returned first.
+        '''
+        if self._start == self._end:
+            return (await self.stream.receive_some(max_bytes))
+        end = self._end if max_bytes is None or max_bytes < 0 \
+                else min(self._end, self._start + max_bytes)
+        data = bytes(self._buf[self._start:end])
+        self._start = end
+        return data
+
+    async def aclose(self) -> None:
+        await self.stream.aclose()
+
+    async def _fill(self, count: int) -> None:
+        'make sure that at least count bytes are in the buffer'
+        if self._end - self._start >= count:
+            return
+        if self._start + count > len(self._buf):
+            # Move the partial frame to the front, growing the buffer if it is too small
+            remaining = self._end - self._start
+            if count > len(self._buf):
+                buf = bytearray(count)
+                buf[:remaining] = self._buf[self._start:self._end]
+                self._buf = buf
+            else:
+                self._buf[:remaining] = self._buf[self._start:self._end]
+            self._start = 0
+            self._end = remaining
+        while self._end - self._start < count:
+            data = await self.stream.receive_some(len(self._buf) - self._end)
+            if len(data) == 0:
+                raise ConnectionResetException()
+            self._buf[self._end:self._end + len(data)] = data
+            self._end += len(data)
+
+
 class BinaryStorageConnection():
     '''
     A connection slot which is instantiated by BinaryStorageManager.
@@ -83,6 +162,7 @@ class BinaryStorageConnection():
     def __init__(self, manager: 'BinaryStorageManager') -> None:
         self.manager = manager
         self.stream = None # type: Optional[trio.abc.Stream]
+        self.reader = None # type: Optional[FrameReader]
         self.logger = BinaryStorageConnectionLoggerAdapter(self, logger)
 
         # State
@@ -91,6 +171,19 @@ class BinaryStorageConnection():
         self.connected = False
         self.connecting = False
 
+        # Times (trio.current_time) of the last command and the last keepalive
+        self.last_used = 0.0
+        self.last_checked = 0.0
+
+        # Number of tasks that share this connection in pipelined mode
+        self.shared = 0
+
+        # Requests that have been sent, but whose response has not been read yet. The
+        # server answers in order, so the first one is the next to read its response.
+        self._send_lock = trio.Lock()
+        self._in_flight = deque() # type: Deque[trio.Event]
+        self._broken = False
+
     @property
     def state(self):
         if self.connected:
@@ -111,25 +204,11 @@ class BinaryStorageConnection():
 
     async def read_term(self, assert_ok=True):
         '''reads a BERT tuple, asserts that first item is "ok"'''
-        assert self.stream is not None
-        pl_read = (await self.stream.receive_some(4))
-
-        if len(pl_read) != 4:
-            raise ConnectionResetException()
-
-        pl_tuple = struct.unpack('!I', pl_read)
-        packet_length = pl_tuple[0]
-        assert packet_length > 0
-
-        packet = b''
-        while len(packet) < packet_length:
-            buf = await self.stream.receive_some(packet_length - len(packet))
-            if len(buf) == 0:
-                raise ConnectionResetException()
-            packet += buf
+        assert self.reader is not None
+        packet = await self.reader.read_frame()
 
         if BINARY_DEBUG:
-            logger.debug('[READ] Serialized: %s', packet)
+            logger.debug('[READ] Serialized: %s', bytes(packet))
 
         decoded = bert.decode(packet)
 
@@ -151,6 +230,58 @@ class BinaryStorageConnection():
         decoded = await self.read_term(assert_ok=True)
         return decoded[1] if len(decoded) > 1 else None
 
+    @asynccontextmanager
+    async def exchange(self, *term):
+        '''
+        Send a command and wait until its response is next on the stream, which then has to be
+        read within the context. Several tasks can send commands on the same connection before
+        the first response arrives (pipelining), their responses are read in the order of the
+        commands.
+        '''
+        turn = await self.send_request(*term)
+        async with self.response_turn(turn):
+            yield
+
+    async def send_request(self, *term) -> trio.Event:
+        '''
+        Send a command and return an event that will be set once its response is next on the
+        stream. The response has to be read within response_turn.
+        '''
+        turn = trio.Event()
+        async with self._send_lock:
+            if self._broken:
+                raise ConnectionResetException()
+            self._in_flight.append(turn)
+            if len(self._in_flight) == 1:
+                turn.set()
+            try:
+                await self.write_term(*term)
+            except BaseException:
+                self._break_pipeline()
+                raise
+        return turn
+
+    @asynccontextmanager
+    async def response_turn(self, turn: trio.Event):
+        try:
+            await turn.wait()
+            if self._broken:
+                raise ConnectionResetException()
+            yield
+        except BaseException:
+            # The response might not have been read completely, so the stream is out of sync
+            self._break_pipeline()
+            raise
+        self._in_flight.popleft()
+        if self._in_flight:
+            self._in_flight[0].set()
+
+    def _break_pipeline(self):
+        self._broken = True
+        for turn in self._in_flight:
+            turn.set()
+        self._in_flight.clear()
+
     async def write_term(self, *term):
         '''write a BERT tuple'''
         assert self.stream is not None
@@ -190,6 +321,9 @@ class BinaryStorageConnection():
             else:
                 self.stream = await trio.open_tcp_stream(self.manager.host, self.manager.port)
 
+            self.reader = FrameReader(self.stream)
+            self._broken = False
+
             version_info = await self.read_term()
             self.server_version = version_info[1].decode()
 
@@ -321,9 +455,11 @@ class BinaryStorageConnection():
             await self.clear_connection()
 
     async def clear_connection(self):
+        self._break_pipeline()
         if self.stream:
             await self.stream.aclose()
             self.stream = None
+        self.reader = None
         self.connected = False
         self.connecting = False
         self.vault = None
@@ -340,90 +476,96 @@ class BinaryStorageConnection():
 
         assert bundle.uptodate
 
-        metadata = await bundle.encrypted_metadata_reader().readall()
-        metadata_size = len(metadata)
-
-        while True:
-            revision = Revision(operation=RevisionOp.Upload)
-            revision.vault_id = vault.config.id
-            revision.parent_id = vault.revision
-            revision.crypt_hash = bundle.local_hash
-            revision.file_hash = bundle.store_hash
-            revision.file_size_crypt = bundle.file_size_crypt
-            revision.revision_metadata = metadata
-            revision.sign(identity=identity)
-
-            # upload key and file
-            await self.write_term('upload',
-                    revision.file_hash,
-                    revision.crypt_hash,
-                    revision.revision_metadata,
-                    revision.file_size_crypt,
-                    revision.user_fingerprint,
-                    revision.signature,
-                    revision.parent_id
-                )
+        reader = await bundle.encrypted_upload_reader()
 
-            response = await self.read_term(assert_ok=False)
+        try:
+            # The metadata contains the hash, so read it after the contents have been spooled
+            metadata = await bundle.encrypted_metadata_reader().readall()
+            metadata_size = len(metadata)
+
+            while True:
+                revision = Revision(operation=RevisionOp.Upload)
+                revision.vault_id = vault.config.id
+                revision.parent_id = vault.revision
+                revision.crypt_hash = bundle.local_hash
+                revision.file_hash = bundle.store_hash
+                revision.file_size_crypt = bundle.file_size_crypt
+                revision.revision_metadata = metadata
+                revision.sign(identity=identity)
+
+                # upload key and file
+                await self.write_term('upload',
+                        revision.file_hash,
+                        revision.crypt_hash,
+                        revision.revision_metadata,
+                        revision.file_size_crypt,
+                        revision.user_fingerprint,
+                        revision.signature,
+                        revision.parent_id
+                    )
 
-            if response[0] == Atom('ok'):
-                break
-            elif response[0] == Atom('error') and \
-                    isinstance(response[1], (list, tuple)) and \
-                    response[1][0] == Atom('parent_revision_outdated'):
-                logger.info('Revision outdated')
-                await trio.sleep(10.0)
-                continue
-            else:
-                raise ServerError(response)
-
-        self.logger.debug('Uploading bundle (metadata: {0} bytes, content: {1} bytes)'\
-                .format(metadata_size, bundle.file_size_crypt))
-
-        bundle.bytes_written = 0
-        upload_id = None
-        urls = None
-        reader = vault.crypt_engine.read_encrypted_stream(bundle)
-
-        response = response[1] if len(response) > 1 else None
-
-        if isinstance(response, tuple) and len(response) > 0 and response[0] == Atom('url'):
-            if isinstance(response[1], tuple) and response[1][0] == Atom('multi'):
-                _, upload_id, urls = response[1]
-                chunksize = int(math.ceil(bundle.file_size_crypt * 1.0 / len(urls)))
-                self.logger.info('Chunked URL upload to %d urls. chunksize=%d', len(urls), chunksize)
-                writer = reader >> ChunkedURLWriter([u.decode() for u in urls], chunksize,\
-                        total_size=bundle.file_size_crypt)
-                url = None
-            else:
-                url = response[1].decode()
-                self.logger.info('Non-chunked URL upload to %s.', url)
-                writer = reader >> URLWriter(url, size=bundle.file_size_crypt)
-                upload_id = None
+                response = await self.read_term(assert_ok=False)
+
+                if response[0] == Atom('ok'):
+                    break
+                elif response[0] == Atom('error') and \
+                        isinstance(response[1], (list, tuple)) and \
+                        response[1][0] == Atom('parent_revision_outdated'):
+                    logger.info('Revision outdated')
+                    await trio.sleep(10.0)
+                    continue
+                else:
+                    raise ServerError(response)
+
+            self.logger.debug('Uploading bundle (metadata: {0} bytes, content: {1} bytes)'\
+                    .format(metadata_size, bundle.file_size_crypt))
 
-            await writer.consume()
+            bundle.bytes_written = 0
+            upload_id = None
+            urls = None
 
-            if writer.bytes_written != bundle.file_size_crypt:
-                self.logger.error('Uploaded size did not match: should be %d, is %d (diff %d)',
-                        bundle.file_size_crypt, writer.bytes_written,
-                        writer.bytes_written - bundle.file_size_crypt)
-                raise Exception('Uploaded size did not match')
+            response = response[1] if len(response) > 1 else None
 
-            if upload_id:
-                await self.write_term('uploaded', (Atom('multi'), upload_id, writer.etags))
+            if isinstance(response, tuple) and len(response) > 0 and response[0] == Atom('url'):
+                if isinstance(response[1], tuple) and response[1][0] == Atom('multi'):
+                    _, upload_id, urls = response[1]
+                    chunksize = int(math.ceil(bundle.file_size_crypt * 1.0 / len(urls)))
+                    self.logger.info('Chunked URL upload to %d urls. chunksize=%d', len(urls), chunksize)
+                    writer = reader >> ChunkedURLWriter([u.decode() for u in urls], chunksize,\
+                            total_size=bundle.file_size_crypt)
+                    url = None
+                else:
+                    url = response[1].decode()
+                    self.logger.info('Non-chunked URL upload to %s.', url)
+                    writer = reader >> URLWriter(url, size=bundle.file_size_crypt)
+                    upload_id = None
+
+                await writer.consume()
+
+                if writer.bytes_written != bundle.file_size_crypt:
+                    self.logger.error('Uploaded size did not match: should be %d, is %d (diff %d)',
+                            bundle.file_size_crypt, writer.bytes_written,
+                            writer.bytes_written - bundle.file_size_crypt)
+                    raise Exception('Uploaded size did not match')
+
+                if upload_id:
+                    await self.write_term('uploaded', (Atom('multi'), upload_id, writer.etags))
+                else:
+                    await self.write_term('uploaded', url)
             else:
-                await self.write_term('uploaded', url)
-        else:
-            self.logger.debug('Streaming upload requested.')
+                self.logger.debug('Streaming upload requested.')
 
-            writer = reader >> TrioStreamWriter(self.stream)
-            await writer.consume()
+                writer = reader >> TrioStreamWriter(self.stream)
+                await writer.consume()
 
-            if writer.bytes_written != bundle.file_size_crypt:
-                self.logger.error('Uploaded size did not match: should be %d, is %d (diff %d)',
-                        bundle.file_size_crypt, writer.bytes_written,
-                        writer.bytes_written - bundle.file_size_crypt)
-                raise Exception('Uploaded size did not match')
+                if writer.bytes_written != bundle.file_size_crypt:
+                    self.logger.error('Uploaded size did not match: should be %d, is %d (diff %d)',
+                            bundle.file_size_crypt, writer.bytes_written,
+                            writer.bytes_written - bundle.file_size_crypt)
+                    raise Exception('Uploaded size did not match')
+        finally:
+            # Closing the reader removes its spool, also if the upload failed
+            await reader.close()
 
         # server should return the response
         response = await self.read_response()
@@ -448,15 +590,13 @@ class BinaryStorageConnection():
         revision.sign(identity=identity)
 
         # upload key and file
-        await self.write_term('remove_file',
-            revision.file_hash,
-            revision.user_fingerprint,
-            revision.signature,
-            revision.parent_id
-        )
-
-        # assert :ok
-        response = await self.read_response()
+        async with self.exchange('remove_file',
+                    revision.file_hash,
+                    revision.user_fingerprint,
+                    revision.signature,
+                    revision.parent_id):
+            # assert :ok
+            response = await self.read_response()
         ret_revision = self.server_info_to_revision(rewrite_atoms_dict(response), vault)
         revision.revision_id = ret_revision.revision_id
         revision.created_at = ret_revision.created_at
@@ -519,6 +659,8 @@ class BinaryStorageConnection():
         elif operation == 'set_metadata':
             operation = RevisionOp.SetMetadata
             vault_public_key = vault.identity.export_public_key()
+        elif operation == 'rename_file':
+            operation = RevisionOp.RenameFile
         elif operation == 'add_user':
             operation = RevisionOp.AddUser
             user_id = server_info['metadata'].decode()
@@ -575,27 +717,26 @@ class BinaryStorageConnection():
         #if verbose:
         #    await self.write_term('changes_with_email', since_rev, to_rev)
         #else:
-        await self.write_term('changes', since_rev, to_rev)
-
-        previous_id = since_rev
-        response = await self.read_response()
-
-        # response is either list or stream
-        if len(response) > 0 and response[0] == Atom('stream_response'):
-            (_, rev_count) = response
-            assert isinstance(rev_count, int)
-            for _ in range(rev_count):
-                server_info = await self.read_term(assert_ok=False)
-                server_info = rewrite_atoms_dict(server_info)
-                revision = self.server_info_to_revision(server_info, vault, previous_id)
-                yield revision
-                previous_id = revision.revision_id
-        else:
-            for server_info in response:
-                server_info = rewrite_atoms_dict(server_info)
-                revision = self.server_info_to_revision(server_info, vault, previous_id)
-                yield revision
-                previous_id = revision.revision_id
+        async with self.exchange('changes', since_rev, to_rev):
+            previous_id = since_rev
+            response = await self.read_response()
+
+            # response is either list or stream
+            if len(response) > 0 and response[0] == Atom('stream_response'):
+                (_, rev_count) = response
+                assert isinstance(rev_count, int)
+                for _ in range(rev_count):
+                    server_info = await self.read_term(assert_ok=False)
+                    server_info = rewrite_atoms_dict(server_info)
+                    revision = self.server_info_to_revision(server_info, vault, previous_id)
+                    yield revision
+                    previous_id = revision.revision_id
+            else:
+                for server_info in response:
+                    server_info = rewrite_atoms_dict(server_info)
+                    revision = self.server_info_to_revision(server_info, vault, previous_id)
+                    yield revision
+                    previous_id = revision.revision_id
 
     async def list_vaults(self) -> List[Any]:
         self.logger.info('Getting a list of vaults')
@@ -619,8 +760,8 @@ class BinaryStorageConnection():
 
         self.logger.info('Getting a list of vault users')
 
-        await self.write_term('list_vault_users')
-        response = await self.read_term()
+        async with self.exchange('list_vault_users'):
+            response = await self.read_term()
 
         return [{k: v.decode() for k, v in user.items()}
                 for user in map(rewrite_atoms_dict, response[1])]
@@ -696,14 +837,25 @@ class BinaryStorageConnection():
 
     async def get_user_vault_key(self, fingerprint, vault_id):
         if self.manager.global_auth:
-            await self.write_term('vault_login', self.manager.global_auth, vault_id)
+            login = ('vault_login', self.manager.global_auth, vault_id) # type: Tuple[Any, ...]
         else:
-            await self.write_term('vault_login', self.manager.username,
-                    self.manager.password, vault_id)
-        auth_token = await self.read_response()
-        auth_token = auth_token.decode()
-        await self.write_term('get_user_vault_key', fingerprint, vault_id)
-        response = await self.read_response()
+            login = ('vault_login', self.manager.username, self.manager.password, vault_id)
+        get_key = ('get_user_vault_key', fingerprint, vault_id)
+
+        try:
+            login_turn = await self.send_request(*login)
+            # In pipelined mode, don't wait for the login before requesting the key
+            key_turn = (await self.send_request(*get_key)) if self.manager.pipelining else None
+            async with self.response_turn(login_turn):
+                auth_token = await self.read_response()
+            auth_token = auth_token.decode()
+            if key_turn is None:
+                key_turn = await self.send_request(*get_key)
+            async with self.response_turn(key_turn):
+                response = await self.read_response()
+        except BaseException:
+            self._break_pipeline()
+            raise
         response = rewrite_atoms_dict(response)
         return auth_token, response['encrypted_content']
 
@@ -753,7 +905,9 @@ class BinaryStorageConnection():
         if url:
             stream_source = URLReader(url)
         else:
-            stream_source = TrioStreamReader(self.stream) >> Limit(file_size)
+            # The contents follow the response, some of it might already be buffered
+            assert self.reader is not None
+            stream_source = TrioStreamReader(self.reader) >> Limit(file_size)
 
         hash_ok = await vault.crypt_engine.write_encrypted_stream(
                 bundle,
@@ -766,13 +920,17 @@ class BinaryStorageConnection():
             await self.write_term('invalid_content_hash', bundle.store_hash, vault.revision)
 
 
+    async def ping(self):
+        'send a cheap command to check that the connection is still alive'
+        async with self.exchange('user_info'):
+            await self.read_response()
+
     async def vault_size(self, vault):
         self.logger.debug('Querying vault size: %s', vault.config.id)
 
         # download key and file
-        await self.write_term('vault_size', vault.config.id)
-
-        size = await self.read_response()
+        async with self.exchange('vault_size', vault.config.id):
+            size = await self.read_response()
         return size
 
     async def list_keys(self, user: Optional[str] = None):
@@ -909,8 +1067,32 @@ class BinaryStorageManager():
         self.password = None
         self.concurrency = None # type: Optional[int]
 
-        self._monitor_task = None
+        # Maximum number of seconds to wait for a connection (None to wait forever)
+        self.acquire_timeout = None # type: Optional[float]
+
+        # Pool maintenance (see maintain_connections). Timeouts and intervals are in seconds,
+        # 0 disables them.
+        self.maintenance_interval = 5.0
+        self.idle_timeout = 300.0
+        self.keepalive_interval = 60.0
+        self.keepalive_timeout = 30.0
+        self.min_connections = 0
+        self._last_vault = None # type: Optional[Vault]
+
+        # In pipelined mode, up to pipeline_depth simple request/response commands can share
+        # one connection (see BinaryStorageConnection.exchange)
+        self.pipelining = False
+        self.pipeline_depth = 8
+
+        self._monitor_task = None # type: Optional[trio.CancelScope]
         self.slots = [] # type: List[BinaryStorageConnection]
+        self._waiters = deque() # type: Deque[_SlotWaiter]
+        self.wait_stats = {
+            'waited': 0,
+            'timeouts': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+        }
         self.loop = None
 
     def get_stats(self):
@@ -928,6 +1110,7 @@ class BinaryStorageManager():
         logged = False
         if not self._monitor_task is None:
             self._monitor_task.cancel()
+            self._monitor_task = None
         for conn in self.slots:
             if conn.connected or conn.connecting:
                 if not logged:
@@ -939,96 +1122,260 @@ class BinaryStorageManager():
 
     async def monitor_connections(self):
         '''
-        Monitor and close open and non-busy connections one-by-one.
+        Maintain the connection pool until close() is called. Errors are logged, but do not
+        stop the maintenance.
         '''
-        while True:
-            await trio.sleep(30.0)
-            def sign_for_state(state):
-                if state == 'idle':
-                    return '*'
-                elif state == 'busy':
-                    return 'B'
-                elif state == 'opening':
-                    return 'o'
-                elif state == 'closed':
-                    return '-'
-                return ' '
-
-            if BINARY_DEBUG:
-                logger.debug('Slots: [%s]',
-                             ''.join([sign_for_state(slot.state) for slot in self.slots]))
+        with trio.CancelScope() as self._monitor_task:
+            while True:
+                await trio.sleep(self.maintenance_interval)
 
-            for conn in self.slots:
-                if conn.connected and conn.available:
-                    logger.debug('Closing due to idleness: %s', conn)
+                if BINARY_DEBUG:
+                    logger.debug('Slots: [%s]',
+                                 ''.join([SLOT_STATE_SIGNS.get(slot.state, ' ')
+                                          for slot in self.slots]))
+
+                try:
+                    await self.maintain_connections()
+                except Exception:
+                    logger.exception('Exception while maintaining connections')
+
+    async def maintain_connections(self):
+        '''
+        Close connections that have been idle for longer than idle_timeout, check idle
+        connections every keepalive_interval seconds and open connections until at least
+        min_connections are logged in.
+        '''
+        now = trio.current_time()
+        open_count = len([conn for conn in self.slots if conn.connected or conn.connecting])
+
+        conn = None # type: Optional[BinaryStorageConnection]
+        for conn in list(self.slots):
+            if not (conn.connected and conn.available):
+                continue
+            if self.idle_timeout and now - conn.last_used >= self.idle_timeout \
+                    and open_count > self.min_connections:
+                logger.debug('Closing due to idleness: %s', conn)
+                conn.available = False
+                try:
                     await conn.disconnect()
-                    break
+                except Exception:
+                    await conn.clear_connection()
+                await self.release_connection(conn)
+                open_count -= 1
+            elif self.keepalive_interval and \
+                    now - max(conn.last_used, conn.last_checked) >= self.keepalive_interval:
+                conn.available = False
+                try:
+                    with trio.fail_after(self.keepalive_timeout):
+                        await conn.ping()
+                    conn.last_checked = trio.current_time()
+                except Exception:
+                    logger.info('Keepalive failed, closing %s', conn)
+                    open_count -= 1
+                    with trio.CancelScope(shield=True):
+                        await conn.clear_connection()
+                await self.release_connection(conn)
+
+        # Warm up connections, so that the next command does not have to wait for them
+        while open_count < self.min_connections and self.host and not self._waiters:
+            conn = self._reserve_closed_slot()
+            if conn is None:
+                break
+            try:
+                await conn.connect()
+                await conn.login(self._last_vault)
+                logger.debug('Warmed up %s', conn)
+            except Exception:
+                logger.warning('Could not open a connection in advance', exc_info=True)
+                with trio.CancelScope(shield=True):
+                    await conn.clear_connection()
+                    await self.release_connection(conn)
+                break
+            conn.last_used = conn.last_checked = trio.current_time()
+            await self.release_connection(conn)
+            open_count += 1
+
+    def get_wait_stats(self):
+        'return statistics about how long tasks had to wait for a connection'
+        stats = dict(self.wait_stats)
+        stats['waiting'] = len(self._waiters)
+        stats['wait_time_avg'] = \
+                stats['wait_time_total'] / stats['waited'] if stats['waited'] else 0.0
+        return stats
 
     #@retry(retry=retry_if_exception_type() & retry_unless_exception_type(InvalidAuthentification),
     #       stop=stop_after_attempt(3),
     #       wait=wait_exponential(multiplier=1, max=10))
-    async def acquire_connection(self, vault, skip_login=False):
-        'return an available connection or block until one is free'
-        #if self._monitor_task is None:
-        #    self._monitor_task = \
-        #            asyncio.get_event_loop().create_task(self.monitor_connections())
+    async def acquire_connection(self, vault, skip_login=False, timeout=None, shared=False):
+        '''
+        Return an available connection or block until one is released. Waiting tasks are
+        served in FIFO order. Raises ConnectionPoolTimeout if no connection could be acquired
+        within timeout seconds (default: acquire_timeout).
 
-        # Prefer slots that have the same vault as we want
-        prio_slots = sorted(self.slots, key=lambda c: c.vault == vault, reverse=True)
+        A shared connection may be in use by other tasks at the same time. It can only be used
+        for commands that go through BinaryStorageConnection.exchange.
+        '''
+        if vault is not None:
+            self._last_vault = vault
 
-        for conn in prio_slots:
-            if conn.connected and conn.available:
-                conn.available = False
-                if conn.vault != vault:
-                    logger.debug('Found an available connection, but we need to switch the vault to %s', vault)
-                    conn.connecting = True
-                    try:
-                        await conn.connect()
-                        if not skip_login:
-                            await conn.login(vault)
-                    except:
-                        await conn.clear_connection()
-                        raise
-                elif vault:
-                    logger.debug('Found an available connection for %s', vault)
-                else:
-                    logger.debug('Found an available connection %s', conn)
-                conn.available = False
-                return conn
+        conn = None # type: Optional[BinaryStorageConnection]
+        shared = shared and self.pipelining and not skip_login
+        if shared:
+            for conn in self.slots:
+                if conn.connected and 0 < conn.shared < self.pipeline_depth \
+                        and conn.vault == vault:
+                    conn.shared += 1
+                    conn.last_used = trio.current_time()
+                    return conn
+
+        conn = None
+        if not self._waiters:
+            conn = self._reserve_slot(vault)
+        if conn is None:
+            logger.debug("Wait for empty slot in: %s", self.slots)
+            waiter = await self._wait_for_slot(
+                self.acquire_timeout if timeout is None else timeout,
+                vault if shared else _EXCLUSIVE
+            )
+            if waiter.joined:
+                return waiter.conn
+            conn = waiter.conn
+        assert conn is not None
+
+        try:
+            if not conn.connected:
+                await conn.connect()
+                if not skip_login:
+                    await conn.login(vault)
+                logger.debug("Choosing %s", conn)
+            elif conn.vault != vault and not skip_login:
+                logger.debug('Found an available connection, but we need to switch the vault to %s', vault)
+                await conn.login(vault)
+            else:
+                logger.debug('Found an available connection %s', conn)
+        except:
+            with trio.CancelScope(shield=True):
+                await conn.clear_connection()
+                await self.release_connection(conn)
+            raise
+        conn.available = False
+        conn.last_used = trio.current_time()
+        if shared:
+            # Other tasks may only join once the connection is logged in to the vault. login()
+            # reads responses directly and sets conn.vault before its round trip.
+            conn.shared = 1
+            self._share_with_waiters(conn)
+        return conn
+
+    def _share_with_waiters(self, conn: BinaryStorageConnection) -> None:
+        'let tasks that wait for a shared connection to the same vault use conn as well'
+        for waiter in list(self._waiters):
+            if conn.shared >= self.pipeline_depth:
+                break
+            if waiter.vault is not _EXCLUSIVE and waiter.vault == conn.vault:
+                self._waiters.remove(waiter)
+                conn.shared += 1
+                waiter.joined = True
+                waiter.conn = conn
+                waiter.event.set()
+
+    def _reserve_slot(self, vault) -> Optional[BinaryStorageConnection]:
+        '''
+        Reserve an idle connection, preferring one that is logged in to the given vault, or a
+        closed slot that can be opened. Returns None if all slots are busy.
+        '''
+        idle = [conn for conn in self.slots if conn.connected and conn.available]
+        if idle:
+            conn = next((conn for conn in idle if conn.vault == vault), idle[0])
+            conn.available = False
+            return conn
 
-        # Try to find an unconnected slot and open a connection
-        for conn in prio_slots:
+        return self._reserve_closed_slot()
+
+    def _reserve_closed_slot(self) -> Optional[BinaryStorageConnection]:
+        'reserve a slot that is not connected, or create one if there are less than concurrency'
+        for conn in self.slots:
             if not conn.connected and not conn.connecting:
                 conn.connecting = True
-                try:
-                    await conn.connect()
-                    if not skip_login:
-                        await conn.login(vault)
-                    conn.available = False
-                    logger.debug("Choosing %s", conn)
-                    return conn
-                except:
-                    await conn.clear_connection()
-                    raise
-                break
+                return conn
 
         if len(self.slots) < (1 if self.concurrency is None else self.concurrency):
             # spawn a new connection
             conn = BinaryStorageConnection(self)
-            await conn.connect()
-            if not skip_login:
-                await conn.login(vault)
-            conn.available = False
+            conn.connecting = True
             self.slots.append(conn)
-            logger.debug("Created and using %s", conn)
+            logger.debug("Created %s", conn)
             return conn
 
-        logger.debug("Wait for empty slot in: %s", self.slots)
+        return None
+
+    async def _wait_for_slot(self, timeout: Optional[float], vault) -> '_SlotWaiter':
+        waiter = _SlotWaiter(vault)
+        self._waiters.append(waiter)
+        started = trio.current_time()
+        try:
+            with trio.move_on_after(math.inf if timeout is None else timeout):
+                await waiter.event.wait()
+        except BaseException:
+            # The connection might have been handed over just before we were cancelled
+            if waiter.conn is not None:
+                with trio.CancelScope(shield=True):
+                    await self.release_connection(waiter.conn)
+            else:
+                self._waiters.remove(waiter)
+            raise
+
+        waited = trio.current_time() - started
+        self.wait_stats['waited'] += 1
+        self.wait_stats['wait_time_total'] += waited
+        self.wait_stats['wait_time_max'] = max(self.wait_stats['wait_time_max'], waited)
+
+        if waiter.conn is None:
+            self._waiters.remove(waiter)
+            self.wait_stats['timeouts'] += 1
+            raise ConnectionPoolTimeout(
+                'No connection became available within {0} seconds'.format(timeout)
+            )
+        return waiter
+
+    async def release_connection(self, conn: BinaryStorageConnection) -> None:
+        '''
+        Give the connection back to the pool. It is directly handed over to the task that has
+        been waiting the longest.
+        '''
+        if conn.shared > 0:
+            # Only the last task that shares the connection releases it
+            conn.shared -= 1
+            if conn.shared > 0:
+                return
+        if not conn.connected and (conn.connecting or conn.stream is not None):
+            # The connection has not been logged in, so it can't be used by anyone else
+            await conn.clear_connection()
+        if self._waiters:
+            waiter = self._waiters.popleft()
+            if conn.connected:
+                conn.available = False
+            else:
+                conn.connecting = True
+            waiter.conn = conn
+            waiter.event.set()
+        else:
+            conn.available = True
+
 
-        await trio.sleep(1.0)
+# Used as the vault of a _SlotWaiter that needs a connection for itself
+_EXCLUSIVE = object()
 
-        # if we haven't found one, try again
-        return await self.acquire_connection(vault)
+
+class _SlotWaiter():
+    'A task that waits in BinaryStorageManager for a connection'
+
+    def __init__(self, vault) -> None:
+        self.vault = vault
+        self.event = trio.Event()
+        self.conn = None # type: Optional[BinaryStorageConnection]
+        # True if the connection is shared with the task that acquired it
+        self.joined = False
 
 
 def get_manager_instance() -> BinaryStorageManager:
@@ -1045,7 +1392,8 @@ class BinaryStorageBackend(StorageBackend):
 
     def __init__(self, vault: Vault = None, auth=None, host=None, port=None,
             concurrency=None, username=None, password=None, ssl=True,
-            ssl_verify=True) -> None:
+            ssl_verify=True, acquire_timeout=None, idle_timeout=None, keepalive_interval=None,
+            min_connections=None, pipelining=None, pipeline_depth=None) -> None:
 
         assert isinstance(ssl, bool)
         assert isinstance(ssl_verify, bool)
@@ -1062,6 +1410,18 @@ class BinaryStorageBackend(StorageBackend):
         if not manager.username: manager.username = username
         if not manager.password: manager.password = password
         manager.concurrency = int(concurrency)
+        if acquire_timeout is not None:
+            manager.acquire_timeout = float(acquire_timeout) or None
+        if idle_timeout is not None:
+            manager.idle_timeout = float(idle_timeout)
+        if keepalive_interval is not None:
+            manager.keepalive_interval = float(keepalive_interval)
+        if min_connections is not None:
+            manager.min_connections = min(int(min_connections), manager.concurrency)
+        if pipelining is not None:
+            manager.pipelining = pipelining
+        if pipeline_depth is not None:
+            manager.pipeline_depth = max(1, int(pipeline_depth))
 
         # Vault specific login information
         self.vault = vault
@@ -1080,16 +1440,27 @@ class BinaryStorageBackend(StorageBackend):
             logger.debug('Setting global_auth to %s', value)
             manager.global_auth = value
 
+    @property
+    def concurrency(self) -> int:
+        'The number of connection slots of the manager'
+        concurrency = get_manager_instance().concurrency
+        return 1 if concurrency is None else concurrency
+
+    @concurrency.setter
+    def concurrency(self, value: int) -> None:
+        get_manager_instance().concurrency = value
+
     def set_auth(self, username, password):
         manager = get_manager_instance()
         manager.username = username
         manager.password = password
 
     @asynccontextmanager
-    async def _acquire_connection(self, ignore_vault=False, skip_login=False):
+    async def _acquire_connection(self, ignore_vault=False, skip_login=False, shared=False):
         conn = await get_manager_instance().acquire_connection(
             None if ignore_vault else self.vault,
-            skip_login=skip_login
+            skip_login=skip_login,
+            shared=shared
         )
         try:
             yield conn
@@ -1101,7 +1472,9 @@ class BinaryStorageBackend(StorageBackend):
             await conn.clear_connection()
             raise
         finally:
-            conn.available = True
+            conn.last_used = trio.current_time()
+            with trio.CancelScope(shield=True):
+                await get_manager_instance().release_connection(conn)
 
     async def init(self, identity: Identity) -> Revision:
         self.auth = None
@@ -1128,16 +1501,20 @@ class BinaryStorageBackend(StorageBackend):
                 conn.logger.debug('Logged in to server (version %s)', version)
 
     async def vault_size(self, vault):
-        async with self._acquire_connection() as conn:
+        async with self._acquire_connection(shared=True) as conn:
             size = await conn.vault_size(vault)
             conn.logger.debug('Vault size is: %s', format_size(size))
             return size
 
     async def changes(self, since_rev, to_rev):
-        async with self._acquire_connection() as conn:
+        async with self._acquire_connection(shared=True) as conn:
             async for rev in conn.changes(since_rev, to_rev):
                 yield rev
 
+    # The server checks the parent revision before it hands out the upload URLs for the
+    # contents, so the contents cannot be stored ahead of the revision (see
+    # StorageBackend.store_contents). Uploads to the server are therefore transferred one at a
+    # time per vault, under the revision lock; only their encryption and spooling overlap.
     async def upload(self, bundle, identity):
         async with self._acquire_connection() as conn:
             return (await conn.upload(bundle, identity))
@@ -1154,7 +1531,7 @@ class BinaryStorageBackend(StorageBackend):
             return await conn.signup(username, password, firstname, surname)
 
     async def remove_file(self, bundle: Bundle, identity: Identity) -> Revision:
-        async with self._acquire_connection() as conn:
+        async with self._acquire_connection(shared=True) as conn:
             return await conn.remove_file(bundle, identity)
 
     async def set_vault_metadata(self, identity: Identity) -> Revision:
@@ -1195,6 +1572,10 @@ class BinaryStorageBackend(StorageBackend):
         async with self._acquire_connection() as conn:
             return (await conn.list_vaults_for_identity(identity))
 
+    async def list_vault_users(self):
+        async with self._acquire_connection(shared=True) as conn:
+            return (await conn.list_vault_users())
+
     def __getattr__(self, name):
         async def myco(*args, **kwargs):
             async with self._acquire_connection() as conn:
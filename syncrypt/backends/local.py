@@ -1,19 +1,30 @@
 import logging
 import os
-import pickle
-import shutil
+import re
 from datetime import datetime
 from typing import Any, List, Optional, cast  # pylint: disable=unused-import
 from uuid import uuid4
 
+import trio
+
+from syncrypt.crypt.delta import (ManifestReader, encrypt_chunk, get_chunk_id, pack_manifest,
+                                  split_file, unpack_manifest, write_chunked_stream)
 from syncrypt.exceptions import VaultNotInitialized
 from syncrypt.models import Bundle, Identity, Revision, RevisionOp, Vault
 from syncrypt.pipes import FileReader, FileWriter
+from syncrypt.pipes.workers import run_in_worker
 
 from .base import StorageBackend
+from .txchain import TxChain
 
 logger = logging.getLogger(__name__)
 
+# Objects are stored in two levels of subdirectories named after the first characters of
+# their hash ("ab/cd/abcd..."), so that no single directory grows too large. Version 1 was
+# the flat layout with all objects in the top level directory.
+LAYOUT_VERSION = 2
+FLAT_OBJECT_RE = re.compile(r'^[0-9a-f]{4,}(\.hash)?$')
+
 
 def require_vault(f):
     def inner(backend, *args, **kwargs):
@@ -36,9 +47,14 @@ class LocalStorageBackend(StorageBackend):
     global_auth = None # type: str
     # ^ deprecated
 
-    def __init__(self, vault: Vault = None, folder=None, **kwargs) -> None:
+    supports_rename = True
+
+    def __init__(self, vault: Vault = None, folder=None, concurrency=None, **kwargs) -> None:
         self.folder = folder
         self.vault = vault
+        self._txchain = None # type: Optional[TxChain]
+        if concurrency is not None:
+            self.concurrency = int(concurrency)
 
     @property
     def path(self):
@@ -56,6 +72,72 @@ class LocalStorageBackend(StorageBackend):
     async def open(self):
         if not os.path.isdir(self.path):
             os.makedirs(self.path, exist_ok=True)
+        self.migrate_layout()
+
+    def object_path(self, store_hash: str) -> str:
+        return os.path.join(self.path, store_hash[:2], store_hash[2:4], store_hash)
+
+    def chunk_path(self, chunk_id: str) -> str:
+        return os.path.join(self.path, "chunks", chunk_id[:2], chunk_id[2:4], chunk_id)
+
+    def _write_atomic(self, dest_path: str, data: bytes) -> None:
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        with open(dest_path + ".tmp", "wb") as dest_file:
+            dest_file.write(data)
+        os.replace(dest_path + ".tmp", dest_path)
+
+    async def _upload_chunks(self, bundle: Bundle) -> bytes:
+        'store all chunks of the bundle that are not known yet and return the manifest'
+        vault = cast(Vault, self.vault)
+        manifest = []
+        uploaded = 0
+        uploaded_bytes = 0
+        async for chunk in split_file(bundle.path, vault.config.delta_chunk_size):
+            chunk_id = await run_in_worker(len(chunk), get_chunk_id, bundle.key, chunk)
+            manifest.append((chunk_id, len(chunk)))
+            chunk_path = self.chunk_path(chunk_id)
+            if os.path.exists(chunk_path):
+                continue
+            data = await run_in_worker(len(chunk), encrypt_chunk, bundle.key, chunk_id, chunk)
+            self._write_atomic(chunk_path, data)
+            uploaded += 1
+            uploaded_bytes += len(data)
+        logger.info("Uploaded %d of %d chunks (%d bytes) for %s",
+                    uploaded, len(manifest), uploaded_bytes, bundle)
+        return pack_manifest(bundle.key, manifest)
+
+    async def _read_chunk(self, chunk_id: str) -> bytes:
+        async with await trio.open_file(self.chunk_path(chunk_id), 'rb') as chunk_file:
+            return (await chunk_file.read())
+
+    def migrate_layout(self) -> None:
+        'move objects of a local remote that uses the flat layout into the sharded layout'
+        layout_path = os.path.join(self.path, "layout")
+        try:
+            with open(layout_path, "r") as layout_file:
+                if int(layout_file.read().strip() or 1) >= LAYOUT_VERSION:
+                    return
+        except FileNotFoundError:
+            pass
+        moved = 0
+        for name in os.listdir(self.path):
+            if FLAT_OBJECT_RE.match(name) and os.path.isfile(os.path.join(self.path, name)):
+                dest_path = self.object_path(name)
+                os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+                os.replace(os.path.join(self.path, name), dest_path)
+                moved += 1
+        if moved > 0:
+            logger.info("Moved %d objects in %s to the sharded layout", moved, self.path)
+        with open(layout_path + ".tmp", "w") as layout_file:
+            layout_file.write(str(LAYOUT_VERSION))
+        os.replace(layout_path + ".tmp", layout_path)
+
+    @property
+    def txchain(self) -> TxChain:
+        path = os.path.join(self.path, "txchain")
+        if self._txchain is None or self._txchain.path != path:
+            self._txchain = TxChain(path)
+        return self._txchain
 
     def add_revision(self, revision: Revision) -> Revision:
         "Persist the revision in the local storage. This will also generate a revision id."
@@ -68,14 +150,12 @@ class LocalStorageBackend(StorageBackend):
         revision.revision_id = str(uuid4())
         revision.created_at = datetime.utcnow()
 
-        with open(os.path.join(self.path, "txchain"), "ab") as txchain:
-            logger.debug(
-                "Adding revision %s to signchain (%s)",
-                revision.revision_id,
-                os.path.join(self.path, "txchain"),
-            )
-            binary_tx = pickle.dumps(revision)
-            txchain.write(binary_tx)
+        logger.debug(
+            "Adding revision %s to signchain (%s)",
+            revision.revision_id,
+            self.txchain.path,
+        )
+        self.txchain.append(revision)
 
         return revision
 
@@ -91,8 +171,7 @@ class LocalStorageBackend(StorageBackend):
         await self.open()  # create directory
 
         # create txchain store
-        with open(os.path.join(self.path, "txchain"), "wb"):
-            pass
+        self.txchain.create()
 
         revision = Revision(operation=RevisionOp.CreateVault)
         revision.vault_id = new_vault_id
@@ -113,27 +192,51 @@ class LocalStorageBackend(StorageBackend):
         return []
 
     @require_vault
-    @require_revision
-    async def upload(self, bundle: Bundle, identity: Identity) -> Revision:
+    async def store_contents(self, bundle: Bundle) -> None:
         vault = cast(Vault, self.vault) # We can savely cast because of @require_vault
 
-        logger.info("Uploading %s", bundle)
-        dest_path = os.path.join(self.path, bundle.store_hash)
-        shutil.copyfile(bundle.path, dest_path)
-
-        metadata = await bundle.encrypted_metadata_reader().readall()
-        len(metadata)
+        logger.debug("Storing contents of %s", bundle)
+        dest_path = self.object_path(bundle.store_hash)
 
         if bundle.local_hash is None:
             raise ValueError("Please update bundle before upload.")
 
         await bundle.load_key()
-        s = vault.crypt_engine.read_encrypted_stream(bundle) >> FileWriter(dest_path)
-        await s.consume()
-        # s = bundle.encrypted_metadata_reader() >> FileWriter(dest_path + ".metadata")
-        # await s.consume()
-        with open(dest_path + ".hash", "w") as hashfile:
+        bundle.chunked = bundle.delta_upload
+        if bundle.chunked:
+            # Only upload unknown chunks, the object itself is the list of chunks
+            manifest = await self._upload_chunks(bundle)
+            bundle.file_size_crypt = len(manifest)
+            self._write_atomic(dest_path, manifest)
+        else:
+            reader = await bundle.encrypted_upload_reader()
+            try:
+                # Write to a temporary file first, so that readers never see a partial object
+                writer = FileWriter(dest_path, create_dirs=True, store_temporary=True,
+                                    fsync=vault.config.fsync)
+                s = reader >> writer
+                await s.consume()
+                await writer.finalize()
+            finally:
+                # Closing the reader removes its spool, also if the upload failed
+                await reader.close()
+        with open(dest_path + ".hash.tmp", "w") as hashfile:
             hashfile.write(bundle.local_hash)
+        os.replace(dest_path + ".hash.tmp", dest_path + ".hash")
+        bundle.contents_stored = True
+
+    @require_vault
+    @require_revision
+    async def upload(self, bundle: Bundle, identity: Identity) -> Revision:
+        vault = cast(Vault, self.vault) # We can savely cast because of @require_vault
+
+        logger.info("Uploading %s", bundle)
+
+        if not bundle.contents_stored:
+            await self.store_contents(bundle)
+
+        # The metadata contains the hash, so read it after the contents have been spooled
+        metadata = await bundle.encrypted_metadata_reader().readall()
 
         revision = Revision(operation=RevisionOp.Upload)
         revision.vault_id = vault.config.id
@@ -145,6 +248,38 @@ class LocalStorageBackend(StorageBackend):
         revision.file_size_crypt = bundle.file_size_crypt
         revision.sign(identity=identity)
 
+        revision = self.add_revision(revision)
+        bundle.contents_stored = False
+        return revision
+
+    @require_vault
+    @require_revision
+    async def rename_file(self, source: Bundle, bundle: Bundle, identity: Identity) -> Revision:
+        vault = cast(Vault, self.vault) # We can savely cast because of @require_vault
+
+        logger.info("Renaming %s to %s", source, bundle)
+
+        if bundle.local_hash is None:
+            raise ValueError("Please update bundle before upload.")
+
+        # The contents stay encrypted with the same key, so the object is only moved
+        await bundle.load_key()
+        assert bundle.key == source.key
+        metadata = await bundle.encrypted_metadata_reader().readall()
+        source_path = self.object_path(source.store_hash)
+        dest_path = self.object_path(bundle.store_hash)
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        os.replace(source_path, dest_path)
+        os.replace(source_path + ".hash", dest_path + ".hash")
+
+        revision = Revision(operation=RevisionOp.RenameFile)
+        revision.vault_id = vault.config.id
+        revision.parent_id = vault.revision
+        revision.file_hash = source.store_hash
+        revision.revision_metadata = metadata
+        revision.crypt_hash = bundle.local_hash
+        revision.sign(identity=identity)
+
         return self.add_revision(revision)
 
     @require_vault
@@ -153,10 +288,15 @@ class LocalStorageBackend(StorageBackend):
 
         logger.info("Downloading %s", bundle)
 
-        dest_path = os.path.join(self.path, bundle.store_hash)
-
         await bundle.load_key()
-        stream = FileReader(dest_path)
+        if bundle.chunked:
+            with open(self.object_path(bundle.store_hash), "rb") as manifest_file:
+                manifest = unpack_manifest(bundle.key, manifest_file.read())
+            await write_chunked_stream(bundle,
+                                       ManifestReader(bundle.key, manifest, self._read_chunk))
+            return
+
+        stream = FileReader(self.object_path(bundle.store_hash))
         try:
             await vault.crypt_engine.write_encrypted_stream(bundle, stream)
         finally:
@@ -192,26 +332,23 @@ class LocalStorageBackend(StorageBackend):
         }
 
     async def changes(self, since_rev, to_rev):
-        logger.info("Reading signchain from %s", os.path.join(self.path, "txchain"))
-        with open(os.path.join(self.path, "txchain"), "rb") as txchain:
-            try:
-                if since_rev:
-                    # Skip until since_rev
-                    logger.debug("Skipping until %s", since_rev)
-                    rev = pickle.load(txchain)
-                    while rev.revision_id != since_rev:
-                        rev = pickle.load(txchain)
-
-                rev = pickle.load(txchain)
+        logger.info("Reading signchain from %s", self.txchain.path)
+        self.txchain.upgrade()
+        offset = None
+        if since_rev:
+            # Seek to the revision after since_rev
+            offset = self.txchain.index.end_of(since_rev)
+            if offset is None:
+                logger.debug("Revision %s not found in signchain", since_rev)
+                return
+        try:
+            for rev in self.txchain.read_from(offset):
                 logger.debug("Loaded %s", rev)
-
-                while rev.revision_id != to_rev:
-                    yield rev
-                    rev = pickle.load(txchain)
-            except EOFError:
-                pass
-            finally:
-                logger.debug("Finished serving changes")
+                if rev.revision_id == to_rev:
+                    break
+                yield rev
+        finally:
+            logger.debug("Finished serving changes")
 
     @require_vault
     @require_revision
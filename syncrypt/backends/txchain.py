@@ -0,0 +1,284 @@
+'''
+The append-only revision log ("txchain") of the local storage backend.
+
+The log starts with a magic header, followed by one record per revision:
+
+    +-----------------+----------------+--------------------------+
+    | length (uint32) | crc32 (uint32) | msgpack encoded revision |
+    +-----------------+----------------+--------------------------+
+
+Writers take an exclusive lock on "txchain.lock", so that several daemons can share one
+local remote directory. Readers do not lock, unless they have to rebuild the index. They
+map the file into memory and stop at a trailing record that has not been written completely
+yet. A trailing record that is still incomplete while the write lock is held has been torn
+by a crash, it is cut off when the index is rebuilt.
+'''
+import logging
+import mmap
+import os
+import pickle
+import struct
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, Optional, Tuple  # pylint: disable=unused-import
+
+import umsgpack
+
+from syncrypt.exceptions import InvalidRevision, SyncRequired
+from syncrypt.models import Revision, RevisionOp
+
+logger = logging.getLogger(__name__)
+
+try:
+    import fcntl
+except ImportError: # on Windows
+    fcntl = None # type: ignore
+    logger.warning('File locking is not available, several processes must not share a '
+                   'local storage backend')
+
+MAGIC = b'SCTXCHN1'
+RECORD_HEADER = struct.Struct('>II')
+EPOCH = datetime(1970, 1, 1)
+
+# Revision fields that are stored in the log, in the order of the encoded list. Local fields
+# like path or creator_id are not stored. New fields may only be appended.
+REVISION_FIELDS = (
+    'revision_id', 'parent_id', 'vault_id', 'user_fingerprint', 'signature',
+    'vault_public_key', 'file_hash', 'revision_metadata', 'crypt_hash', 'file_size_crypt',
+    'user_id', 'user_public_key'
+)
+
+
+def encode_revision(revision: Revision) -> bytes:
+    created_at = None
+    if revision.created_at is not None:
+        created_at = (revision.created_at - EPOCH) // timedelta(microseconds=1)
+    values = [getattr(revision, name) for name in REVISION_FIELDS]
+    payload = umsgpack.packb([revision.operation.value, created_at] + values)
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def decode_revision(payload) -> Revision:
+    operation, created_at, *values = umsgpack.unpackb(payload)
+    revision = Revision(operation=RevisionOp(operation))
+    if created_at is not None:
+        revision.created_at = EPOCH + timedelta(microseconds=created_at)
+    for name, value in zip(REVISION_FIELDS, values):
+        setattr(revision, name, value)
+    return revision
+
+
+@contextmanager
+def write_lock(path):
+    with open(path + '.lock', 'a') as lockfile:
+        if fcntl is not None:
+            fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX)
+        yield
+
+
+class TxChain(object):
+    'Reads and appends revision records in a txchain file'
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.index = TxChainIndex(self)
+        self._locked = False
+
+    @contextmanager
+    def lock(self):
+        'take the write lock, unless it is already held through this object'
+        if self._locked:
+            yield
+            return
+        with write_lock(self.path):
+            self._locked = True
+            try:
+                yield
+            finally:
+                self._locked = False
+
+    def create(self) -> None:
+        with self.lock():
+            with open(self.path, 'wb') as txchain:
+                txchain.write(MAGIC)
+            self.index.reset()
+
+    def append(self, revision: Revision) -> Tuple[int, int]:
+        '''
+        Append the revision to the log. Unless it creates the vault, its parent has to be
+        the last revision in the log.
+        '''
+        self.upgrade()
+        record = encode_revision(revision)
+        with self.lock(), open(self.path, 'ab') as txchain:
+            # This cuts off a torn record at the end of the log, so look at the head first
+            head = self.index.last_revision_id()
+            start = txchain.seek(0, os.SEEK_END)
+            if head is None and start > len(MAGIC):
+                raise InvalidRevision('Cannot determine the head of {0}'.format(self.path))
+            if revision.operation != RevisionOp.CreateVault and revision.parent_id != head:
+                raise SyncRequired('Parent {0} is not the head of the txchain ({1})'
+                                   .format(revision.parent_id, head))
+            txchain.write(record)
+            txchain.flush()
+            os.fsync(txchain.fileno())
+            end = start + len(record)
+            self.index.append(revision.revision_id, start, end)
+        return start, end
+
+    def read_from(self, offset: Optional[int] = None) -> Iterator[Revision]:
+        'yield all revisions starting at the given offset'
+        self.upgrade()
+        for _, _, payload in self.records(offset):
+            yield decode_revision(payload)
+
+    def records(self, offset: Optional[int] = None) -> Iterator[Tuple[int, int, bytes]]:
+        'yield (start, end, payload) of all complete records starting at the given offset'
+        with open(self.path, 'rb') as txchain:
+            size = os.fstat(txchain.fileno()).st_size
+            if size <= len(MAGIC):
+                return
+            data = mmap.mmap(txchain.fileno(), size, access=mmap.ACCESS_READ)
+        try:
+            if data[:len(MAGIC)] != MAGIC:
+                raise InvalidRevision('Unknown txchain format in {0}'.format(self.path))
+            pos = len(MAGIC) if offset is None else offset
+            while pos + RECORD_HEADER.size <= size:
+                length, checksum = RECORD_HEADER.unpack_from(data, pos)
+                end = pos + RECORD_HEADER.size + length
+                if end > size:
+                    # This record is still being written
+                    break
+                payload = data[pos + RECORD_HEADER.size:end]
+                if zlib.crc32(payload) != checksum:
+                    if end == size:
+                        # The last record might not have reached the disk completely
+                        break
+                    raise InvalidRevision('Checksum mismatch at offset {0} in {1}'
+                                          .format(pos, self.path))
+                yield pos, end, payload
+                pos = end
+        finally:
+            data.close()
+
+    def upgrade(self) -> None:
+        'convert a txchain of pickled revisions written by older versions'
+        with open(self.path, 'rb') as txchain:
+            if txchain.read(len(MAGIC)) == MAGIC:
+                return
+        with self.lock():
+            with open(self.path, 'rb') as txchain:
+                if txchain.read(len(MAGIC)) == MAGIC:
+                    return # upgraded by someone else in the meantime
+                txchain.seek(0)
+                logger.info('Converting %s to the record format', self.path)
+                with open(self.path + '.tmp', 'wb') as converted:
+                    converted.write(MAGIC)
+                    while True:
+                        try:
+                            revision = pickle.load(txchain)
+                        except EOFError:
+                            break
+                        converted.write(encode_revision(revision))
+            os.replace(self.path + '.tmp', self.path)
+            self.index.rebuild()
+
+
+class TxChainIndex(object):
+    '''
+    Maps revision ids to their position in the txchain file, so that changes() can seek to
+    the requested revision instead of decoding the whole chain. The index is a text file
+    with one "<revision_id> <start> <end>" line per revision. It is rebuilt from the txchain
+    whenever it does not cover the txchain exactly. Like appending, rebuilding the index
+    requires the write lock of the txchain.
+    '''
+
+    def __init__(self, txchain: TxChain) -> None:
+        self.txchain = txchain
+        self.path = txchain.path + '.idx'
+        self._offsets = None # type: Optional[Dict[str, Tuple[int, int]]]
+        self._last_revision_id = None # type: Optional[str]
+        self._txchain_size = -1
+
+    def reset(self) -> None:
+        with open(self.path, 'w'):
+            pass
+        self._offsets = {}
+        self._last_revision_id = None
+        self._txchain_size = len(MAGIC)
+
+    def append(self, revision_id: str, start: int, end: int) -> None:
+        with open(self.path, 'a') as index:
+            index.write('{0} {1} {2}\n'.format(revision_id, start, end))
+        if self._offsets is not None and self._txchain_size == start:
+            self._offsets[revision_id] = (start, end)
+            self._last_revision_id = revision_id
+            self._txchain_size = end
+        else:
+            self._offsets = None
+
+    def end_of(self, revision_id: str) -> Optional[int]:
+        'return the offset right after the given revision, or None if it is unknown'
+        entry = self._refresh().get(revision_id)
+        return entry[1] if entry else None
+
+    def last_revision_id(self) -> Optional[str]:
+        self._refresh()
+        return self._last_revision_id
+
+    def rebuild(self) -> None:
+        with self.txchain.lock():
+            logger.info('Rebuilding txchain index %s', self.path)
+            offsets = {} # type: Dict[str, Tuple[int, int]]
+            covered = len(MAGIC)
+            self._last_revision_id = None
+            with open(self.path + '.tmp', 'w') as index:
+                for start, end, payload in self.txchain.records():
+                    revision_id = umsgpack.unpackb(payload)[2]
+                    offsets[revision_id] = (start, end)
+                    self._last_revision_id = revision_id
+                    covered = end
+                    index.write('{0} {1} {2}\n'.format(revision_id, start, end))
+            txchain_size = os.path.getsize(self.txchain.path)
+            if txchain_size > covered:
+                # Nobody is writing while we hold the lock, so the rest has been torn by a crash
+                logger.warning('Removing an incomplete record of %d bytes from %s',
+                               txchain_size - covered, self.txchain.path)
+                os.truncate(self.txchain.path, covered)
+                txchain_size = covered
+            os.replace(self.path + '.tmp', self.path)
+            self._offsets = offsets
+            self._txchain_size = txchain_size
+
+    def _refresh(self) -> Dict[str, Tuple[int, int]]:
+        txchain_size = os.path.getsize(self.txchain.path)
+        if self._offsets is None or self._txchain_size != txchain_size:
+            if not self._load(txchain_size):
+                with self.txchain.lock():
+                    # Another process might have updated the index while we waited for the lock
+                    if not self._load(os.path.getsize(self.txchain.path)):
+                        self.rebuild()
+        assert self._offsets is not None
+        return self._offsets
+
+    def _load(self, txchain_size: int) -> bool:
+        offsets = {} # type: Dict[str, Tuple[int, int]]
+        covered = len(MAGIC)
+        revision_id = None
+        try:
+            with open(self.path, 'r') as index:
+                for line in index:
+                    revision_id, start, end = line.split()
+                    if int(start) != covered:
+                        return False
+                    covered = int(end)
+                    offsets[revision_id] = (int(start), covered)
+        except (FileNotFoundError, ValueError):
+            return False
+        if covered != txchain_size:
+            return False
+        self._offsets = offsets
+        self._last_revision_id = revision_id
+        self._txchain_size = txchain_size
+        return True
@@ -96,6 +96,22 @@ class BackendConfigMixin():
 
         # Maximum number of concurent connections
         'concurrency': 10,
+
+        # Maximum number of seconds to wait for a free connection (0 to wait forever)
+        'acquire_timeout': 600,
+
+        # Close connections that have been idle for this many seconds (0 to keep them open)
+        'idle_timeout': 300,
+
+        # Check idle connections every this many seconds (0 to disable)
+        'keepalive_interval': 60,
+
+        # Number of connections that are opened and logged in ahead of time
+        'min_connections': 1,
+
+        # Send several commands on one connection without waiting for each response
+        'pipelining': '0',
+        'pipeline_depth': 8,
     }
 
     @property
@@ -120,6 +136,8 @@ class BackendConfigMixin():
             kwargs['ssl_verify'] = not (kwargs['ssl_verify'].lower() in ['no', 'false', '0'])
         else:
             del kwargs['ssl_verify']
+        if 'pipelining' in kwargs and kwargs['type'] == 'binary':
+            kwargs['pipelining'] = not (kwargs['pipelining'].lower() in ['no', 'false', '0'])
         kwargs.pop('type')
         kwargs['concurrency'] = self.DEFAULT_BACKEND_CFG['concurrency']
         return kwargs
@@ -130,6 +148,10 @@ class VaultConfig(Config, BackendConfigMixin):
     block_size = 16
     enc_buf_size = block_size * 10 * 1024
 
+    # In single pass upload mode, encrypted contents up to this size will be
+    # spooled in memory. Larger files are spooled to a temporary file.
+    spool_max_size = 16 * 1024 * 1024
+
     # This list contains file patterns that we will always ignore. If an item
     # was removed from this list, syncrypt will not function as expected.
     # See below for a list of user-defineable ignore patterns
@@ -141,7 +163,20 @@ class VaultConfig(Config, BackendConfigMixin):
             'ignore': '.*',
             'name': '',
             'pull_interval': 300,
-            'crypt_engine': 'aes_cbc'
+            # aes_cbc, aes_gcm (encrypts chunks of crypt_chunk_size bytes in parallel) or plaintext
+            'crypt_engine': 'aes_cbc',
+            'crypt_chunk_size': 1024 * 1024,
+            # Number of bundles of this vault that are prepared for upload concurrently
+            'upload_concurrency': 4,
+            # Read, encrypt and hash files in one pass when uploading
+            'single_pass_upload': '1',
+            # When to fsync downloaded files: none, finalize or directory
+            'fsync': 'none',
+            # Upload files of at least delta_min_size bytes as content-defined chunks of about
+            # delta_chunk_size bytes, so that only changed chunks have to be uploaded again
+            'delta_sync': '0',
+            'delta_min_size': 4 * 1024 * 1024,
+            'delta_chunk_size': 1024 * 1024
         },
         'remote': BackendConfigMixin.DEFAULT_BACKEND_CFG
     }
@@ -155,11 +190,40 @@ class VaultConfig(Config, BackendConfigMixin):
     def ignore_patterns(self):
         return self._config['vault']['ignore'].split(',') + self.hard_ignore
 
+    @property
+    def single_pass_upload(self):
+        value = self._config['vault'].get('single_pass_upload', '1')
+        return not (value.lower() in ['no', 'false', '0'])
+
+    @property
+    def upload_concurrency(self):
+        return int(self._config['vault'].get('upload_concurrency', 4))
+
+    @property
+    def delta_sync(self):
+        value = self._config['vault'].get('delta_sync', '0')
+        return not (value.lower() in ['no', 'false', '0'])
+
+    @property
+    def delta_min_size(self):
+        return int(self._config['vault'].get('delta_min_size', 4 * 1024 * 1024))
+
+    @property
+    def delta_chunk_size(self):
+        return int(self._config['vault'].get('delta_chunk_size', 1024 * 1024))
+
+    @property
+    def fsync(self):
+        return self._config['vault'].get('fsync', 'none')
+
     @property
     def crypt_engine_cls(self):
         if self._config['vault']['crypt_engine'] == 'aes_cbc':
             from .crypt.aes_cbc import AESCBCEngine
             return AESCBCEngine
+        elif self._config['vault']['crypt_engine'] == 'aes_gcm':
+            from .crypt.aes_gcm import AESGCMEngine
+            return AESGCMEngine
         elif self._config['vault']['crypt_engine'] == 'plaintext':
             from .crypt.plaintext import PlaintextEngine
             return PlaintextEngine
@@ -168,6 +232,8 @@ class VaultConfig(Config, BackendConfigMixin):
 
     @property
     def crypt_engine_kwargs(self):
+        if self._config['vault']['crypt_engine'] == 'aes_gcm':
+            return {'chunk_size': int(self._config['vault'].get('crypt_chunk_size', 1024 * 1024))}
         return {}
 
 
@@ -175,6 +241,20 @@ class AppConfig(Config, BackendConfigMixin):
     default_config = {
         'app': {
             'concurrency': 6,
+            # Number of threads for encryption, compression and hashing (0 = event loop)
+            'pipe_workers': 4,
+            # Number of bundles that are uploaded concurrently across all vaults
+            'upload_concurrency': 8,
+            # Number of bundles that are downloaded concurrently across all vaults
+            'download_concurrency': 8,
+            # Maximum total size of the bundles that are downloaded at the same time
+            'download_max_bytes': 64 * 1024 * 1024,
+            # Maximum total size of the encrypted uploads that are spooled at the same time
+            'spool_max_bytes': 256 * 1024 * 1024,
+            # Number of revisions that are committed to the store at once while syncing
+            'revision_batch_size': 500,
+            # Number of revisions that are received and verified ahead of the ones being applied
+            'sync_lookahead': 200,
             'vaults': ''
         },
         'gui': {
@@ -192,7 +272,12 @@ class AppConfig(Config, BackendConfigMixin):
         },
         'store': {
             'engine': 'sqlite',
-            'path': 'syncrypt.db'
+            'path': 'syncrypt.db',
+            # SQLite pragmas, see https://www.sqlite.org/pragma.html
+            'journal_mode': 'wal',
+            'synchronous': 'normal',
+            'cache_size': -16000, # in KiB if negative
+            'mmap_size': 256 * 1024 * 1024
         },
         'remote': BackendConfigMixin.DEFAULT_BACKEND_CFG
     }
@@ -4,7 +4,7 @@ from typing import Tuple
 
 from syncrypt.models import Bundle
 from syncrypt.pipes import (Buffered, Count, DecryptAES, EncryptAES, FileReader, FileWriter, Hash,
-                            PadAES, Pipe, SnappyCompress, SnappyDecompress, UnpadAES)
+                            PadAES, Pipe, SnappyCompress, SnappyDecompress, SpoolWriter, UnpadAES)
 
 from .base import CryptEngine
 
@@ -13,6 +13,8 @@ logger = logging.getLogger(__name__)
 
 class AESCBCEngine(CryptEngine):
 
+    spools_upload = True
+
     def read_encrypted_stream(self, bundle: Bundle) -> Pipe:
         assert not bundle.key is None
         return FileReader(bundle.path) \
@@ -25,12 +27,9 @@ class AESCBCEngine(CryptEngine):
 
         # This will calculate the hash of the file contents
         # As such it will never be sent to the server (see below)
-        # TODO: check impact of SnappyCompress and PadAES pipes on
-        #       performance. Both are only needed for knowing the
-        #       file size in upload. If they have a huge impact on
-        #       performance, try to change the protocol so that the
-        #       stream size does not need to be known inb4 by the
-        #       client source.
+        # Note that SnappyCompress and PadAES are only needed for knowing the
+        # file size in upload. In single pass upload mode, this pre-pass is
+        # skipped and the size is determined in spool_encrypted_stream.
         hashing_reader = FileReader(bundle.path) \
                     >> Hash(bundle.vault.config.hash_algo)
 
@@ -41,14 +40,7 @@ class AESCBCEngine(CryptEngine):
                     >> Count()
         await counting_reader.consume()
 
-        # We add the AES key to the hash so that the hash stays
-        # constant when the files is not changed, but the original
-        # hash is also not revealed to the server
-        assert len(bundle.key) == bundle.key_size
-        hash_obj = hashing_reader.hash_obj
-        hash_obj.update(bundle.key)
-
-        crypt_hash = hash_obj.hexdigest()
+        crypt_hash = self._finalize_hash(bundle, hashing_reader)
 
         # Add one time the symmetric block_size to the encrypted file size.
         # This is the length of the IV.
@@ -57,6 +49,42 @@ class AESCBCEngine(CryptEngine):
 
         return crypt_hash, file_size_crypt
 
+    async def get_crypt_hash(self, bundle: Bundle) -> str:
+        hashing_reader = FileReader(bundle.path) \
+                    >> Hash(bundle.vault.config.hash_algo)
+        await hashing_reader.consume()
+        return self._finalize_hash(bundle, hashing_reader)
+
+    async def spool_encrypted_stream(self, bundle: Bundle) -> Tuple[str, int, Pipe]:
+        assert not bundle.key is None
+
+        # Read, hash, compress and encrypt the file in a single pass. The
+        # ciphertext is spooled so that its exact size is known before the
+        # upload starts.
+        hashing_reader = FileReader(bundle.path) \
+                    >> Hash(bundle.vault.config.hash_algo)
+
+        spool = hashing_reader \
+                >> SnappyCompress() \
+                >> Buffered(bundle.vault.config.enc_buf_size) \
+                >> PadAES() \
+                >> EncryptAES(bundle.key) \
+                >> SpoolWriter(max_size=bundle.vault.config.spool_max_size)
+        await spool.consume()
+
+        crypt_hash = self._finalize_hash(bundle, hashing_reader)
+
+        return crypt_hash, spool.bytes_written, spool.reader()
+
+    def _finalize_hash(self, bundle: Bundle, hashing_reader: Hash) -> str:
+        # We add the AES key to the hash so that the hash stays
+        # constant when the files is not changed, but the original
+        # hash is also not revealed to the server
+        assert len(bundle.key) == bundle.key_size
+        hash_obj = hashing_reader.hash_obj
+        hash_obj.update(bundle.key)
+        return hash_obj.hexdigest()
+
     async def write_encrypted_stream(self, bundle: Bundle, stream: Pipe, assert_hash=None):
         hash_pipe = Hash(bundle.vault.config.hash_algo)
 
@@ -76,7 +104,8 @@ class AESCBCEngine(CryptEngine):
                 >> UnpadAES() \
                 >> SnappyDecompress() \
                 >> hash_pipe \
-                >> FileWriter(bundle.path, create_dirs=True, create_backup=True, store_temporary=True)
+                >> FileWriter(bundle.path, create_dirs=True, create_backup=True, store_temporary=True,
+                              size=bundle.file_size, fsync=bundle.vault.config.fsync)
 
         await sink.consume()
 
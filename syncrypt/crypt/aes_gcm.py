@@ -0,0 +1,121 @@
+import logging
+import os
+from typing import Tuple
+
+import trio
+
+from syncrypt.models import Bundle
+from syncrypt.pipes import (ChunkedGCM, Count, DecryptAESGCM, EncryptAESGCM, FileReader,
+                            FileWriter, Hash, Limit, Pipe)
+
+from .base import CryptEngine
+
+logger = logging.getLogger(__name__)
+
+
+class AESGCMEngine(CryptEngine):
+    '''
+    Encrypts files in independent chunks with AES-GCM (see ChunkedGCM). Chunks are encrypted
+    and decrypted in parallel, any byte range can be decrypted on its own and the size of the
+    ciphertext follows from the size of the file. As the contents are not compressed, the
+    upload needs only one pass to hash the file before it is encrypted while being sent.
+    '''
+
+    def __init__(self, chunk_size=1024 * 1024, parallel=4):
+        self.chunk_size = int(chunk_size)
+        self.parallel = int(parallel)
+
+    def read_encrypted_stream(self, bundle: Bundle) -> Pipe:
+        assert not bundle.key is None
+        return FileReader(bundle.path) \
+                >> EncryptAESGCM(bundle.key, self.chunk_size, self.parallel)
+
+    async def get_crypt_hash_and_size(self, bundle: Bundle) -> Tuple[str, int]:
+        hashing_reader = FileReader(bundle.path) \
+                    >> Hash(bundle.vault.config.hash_algo)
+        counting_reader = hashing_reader >> Count()
+        await counting_reader.consume()
+        crypt_hash = self._finalize_hash(bundle, hashing_reader)
+        return crypt_hash, ChunkedGCM.encrypted_size(counting_reader.count, self.chunk_size)
+
+    async def spool_encrypted_stream(self, bundle: Bundle) -> Tuple[str, int, Pipe]:
+        assert not bundle.key is None
+        # The encrypted size is known without encrypting the file, so nothing has to be
+        # spooled. The plaintext is limited to the hashed size in case the file grows.
+        hashing_reader = FileReader(bundle.path) \
+                    >> Hash(bundle.vault.config.hash_algo)
+        counting_reader = hashing_reader >> Count()
+        await counting_reader.consume()
+        crypt_hash = self._finalize_hash(bundle, hashing_reader)
+        size = counting_reader.count
+        reader = FileReader(bundle.path) \
+                >> Limit(size) \
+                >> EncryptAESGCM(bundle.key, self.chunk_size, self.parallel)
+        return crypt_hash, ChunkedGCM.encrypted_size(size, self.chunk_size), reader
+
+    def _finalize_hash(self, bundle: Bundle, hashing_reader: Hash) -> str:
+        # Like in AESCBCEngine, the key is added so that the server never learns the hash of
+        # the plaintext
+        assert len(bundle.key) == bundle.key_size
+        hash_obj = hashing_reader.hash_obj
+        hash_obj.update(bundle.key)
+        return hash_obj.hexdigest()
+
+    async def write_encrypted_stream(self, bundle: Bundle, stream: Pipe, assert_hash=None):
+        hash_pipe = Hash(bundle.vault.config.hash_algo)
+
+        if bundle.key is None:
+            await bundle.load_key()
+
+        # Security check against malicious path not inside
+        vault_path = os.path.abspath(bundle.vault.folder)
+        bundle_path = os.path.abspath(bundle.path)
+
+        if os.path.commonpath([vault_path]) != os.path.commonpath([vault_path, bundle_path]):
+            raise AssertionError("Refusing to write to given bundle path: " + bundle_path)
+
+        sink = stream \
+                >> DecryptAESGCM(bundle.key, self.parallel) \
+                >> hash_pipe \
+                >> FileWriter(bundle.path, create_dirs=True, create_backup=True, store_temporary=True,
+                              size=bundle.file_size, fsync=bundle.vault.config.fsync)
+
+        await sink.consume()
+
+        hash_obj = hash_pipe.hash_obj
+        hash_obj.update(bundle.key)
+        received_hash = hash_obj.hexdigest()
+
+        passed = not assert_hash or received_hash == assert_hash
+
+        if not passed:
+            logger.error('hash mismatch: {} != {}'.format(assert_hash, received_hash))
+
+        await sink.finalize()
+
+        return passed
+
+    async def read_range(self, key: bytes, encrypted_path: str, offset: int, length: int) -> bytes:
+        '''
+        Decrypt "length" bytes of plaintext starting at "offset" from the encrypted file.
+        Only the chunks that overlap with the range are read.
+        '''
+        async with await trio.open_file(encrypted_path, 'rb') as encrypted:
+            crypt_size = os.fstat(encrypted.fileno()).st_size
+            header = await encrypted.read(ChunkedGCM.header.size)
+            gcm = ChunkedGCM.from_header(key, header)
+            chunk_count = max(1, -(-(crypt_size - len(header)) // gcm.encrypted_chunk_size))
+            first = offset // gcm.chunk_size
+            last = min((offset + max(length, 1) - 1) // gcm.chunk_size, chunk_count - 1)
+            if first >= chunk_count:
+                return b''
+            await encrypted.seek(len(header) + first * gcm.encrypted_chunk_size)
+            data = await encrypted.read((last - first + 1) * gcm.encrypted_chunk_size)
+        parts = []
+        for index in range(first, last + 1):
+            start = (index - first) * gcm.encrypted_chunk_size
+            chunk = data[start:start + gcm.encrypted_chunk_size]
+            parts.append(gcm.decrypt_chunk(index, chunk, index == chunk_count - 1))
+        plaintext = b''.join(parts)
+        skip = offset - first * gcm.chunk_size
+        return plaintext[skip:skip + length]
@@ -9,9 +9,25 @@ from syncrypt.pipes import Pipe
 
 class CryptEngine(Protocol):
 
+    # True if spool_encrypted_stream buffers the whole ciphertext before it is uploaded
+    spools_upload = False # type: bool
+
     async def get_crypt_hash_and_size(self, bundle: Bundle) -> Tuple[str, int]:
         raise NotImplementedError()
 
+    async def get_crypt_hash(self, bundle: Bundle) -> str:
+        crypt_hash, _ = await self.get_crypt_hash_and_size(bundle)
+        return crypt_hash
+
+    async def spool_encrypted_stream(self, bundle: Bundle) -> Tuple[str, int, Pipe]:
+        '''
+        Return the hash, the encrypted size and a pipe with the encrypted
+        contents of the bundle. Engines that can produce all three in a single
+        pass over the file should override this.
+        '''
+        crypt_hash, file_size_crypt = await self.get_crypt_hash_and_size(bundle)
+        return crypt_hash, file_size_crypt, self.read_encrypted_stream(bundle)
+
     @abstractmethod
     def read_encrypted_stream(self, bundle: Bundle) -> Pipe:
         raise NotImplementedError()
@@ -0,0 +1,131 @@
+'''
+Delta uploads split a file into content-defined chunks (see ContentDefinedChunker) and
+store every chunk as an object of its own. Only chunks that the remote does not have yet
+need to be uploaded. The bundle object itself then holds the encrypted manifest, the list of
+chunks that make up the file.
+
+Chunks are encrypted deterministically with the bundle key, so the same contents result in
+the same chunk id and ciphertext:
+
+    chunk id   = HMAC-SHA256(bundle key, contents)
+    ciphertext = AES-GCM(bundle key, nonce = first 12 bytes of the chunk id) + tag
+
+This only reveals which chunks of the same bundle are equal.
+'''
+import hashlib
+import hmac
+import os
+from typing import AsyncIterator, List, Tuple  # pylint: disable=unused-import
+
+import umsgpack
+from Cryptodome.Cipher import AES
+
+from syncrypt.exceptions import InvalidBundleContents
+from syncrypt.models import Bundle
+from syncrypt.pipes import FileReader, FileWriter, Pipe
+from syncrypt.pipes.workers import run_in_worker
+from syncrypt.utils.chunker import ContentDefinedChunker
+
+TAG_SIZE = 16
+MANIFEST_NONCE_SIZE = 12
+
+# A manifest is a list of (chunk id, plaintext size) pairs
+Manifest = List[Tuple[str, int]]
+
+
+def get_chunk_id(key: bytes, data) -> str:
+    return hmac.new(key, data, hashlib.sha256).hexdigest()
+
+
+def encrypt_chunk(key: bytes, chunk_id: str, data) -> bytes:
+    cipher = AES.new(key, AES.MODE_GCM, nonce=bytes.fromhex(chunk_id)[:12])
+    ciphertext, tag = cipher.encrypt_and_digest(data)
+    return ciphertext + tag
+
+
+def decrypt_chunk(key: bytes, chunk_id: str, data) -> bytes:
+    data = memoryview(data)
+    cipher = AES.new(key, AES.MODE_GCM, nonce=bytes.fromhex(chunk_id)[:12])
+    try:
+        plaintext = cipher.decrypt_and_verify(data[:-TAG_SIZE], data[-TAG_SIZE:])
+    except ValueError:
+        raise InvalidBundleContents('Chunk {0} failed authentication'.format(chunk_id))
+    if not hmac.compare_digest(get_chunk_id(key, plaintext), chunk_id):
+        raise InvalidBundleContents('Chunk {0} does not match its id'.format(chunk_id))
+    return plaintext
+
+
+def pack_manifest(key: bytes, manifest: Manifest) -> bytes:
+    nonce = os.urandom(MANIFEST_NONCE_SIZE)
+    cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+    ciphertext, tag = cipher.encrypt_and_digest(umsgpack.packb([list(c) for c in manifest]))
+    return nonce + ciphertext + tag
+
+
+def unpack_manifest(key: bytes, data: bytes) -> Manifest:
+    nonce = data[:MANIFEST_NONCE_SIZE]
+    cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+    try:
+        packed = cipher.decrypt_and_verify(data[MANIFEST_NONCE_SIZE:-TAG_SIZE],
+                                           data[-TAG_SIZE:])
+    except ValueError:
+        raise InvalidBundleContents('Manifest failed authentication')
+    return [(chunk_id, size) for chunk_id, size in umsgpack.unpackb(packed)]
+
+
+async def split_file(path: str, avg_size: int) -> AsyncIterator[bytes]:
+    'cut the file at path into content-defined chunks of about avg_size bytes and yield them'
+    chunker = ContentDefinedChunker(avg_size)
+    reader = FileReader(path)
+    try:
+        while True:
+            data = await reader.read()
+            if len(data) == 0:
+                break
+            for chunk in await run_in_worker(len(data), chunker.feed, data):
+                yield chunk
+        for chunk in chunker.finish():
+            yield chunk
+    finally:
+        await reader.close()
+
+
+class ManifestReader(Pipe):
+    '''
+    Yields the plaintext of a chunked file. read_chunk(chunk_id) has to return the encrypted
+    chunk.
+    '''
+    def __init__(self, key: bytes, manifest: Manifest, read_chunk) -> None:
+        super(ManifestReader, self).__init__()
+        self.key = key
+        self.manifest = manifest
+        self.read_chunk = read_chunk
+        self._next = 0
+
+    async def read(self, count=-1):
+        if self._next >= len(self.manifest):
+            return b''
+        chunk_id, size = self.manifest[self._next]
+        self._next += 1
+        data = await self.read_chunk(chunk_id)
+        plaintext = await run_in_worker(len(data), decrypt_chunk, self.key, chunk_id, data)
+        if len(plaintext) != size:
+            raise InvalidBundleContents('Chunk {0} has an unexpected size'.format(chunk_id))
+        return plaintext
+
+
+async def write_chunked_stream(bundle: Bundle, stream: Pipe) -> None:
+    'write the plaintext of a chunked bundle into its file'
+
+    # Security check against malicious path not inside
+    vault_path = os.path.abspath(bundle.vault.folder)
+    bundle_path = os.path.abspath(bundle.path)
+
+    if os.path.commonpath([vault_path]) != os.path.commonpath([vault_path, bundle_path]):
+        raise AssertionError("Refusing to write to given bundle path: " + bundle_path)
+
+    sink = stream \
+            >> FileWriter(bundle.path, create_dirs=True, create_backup=True, store_temporary=True,
+                          size=bundle.file_size, fsync=bundle.vault.config.fsync)
+    await sink.consume()
+    await sink.finalize()
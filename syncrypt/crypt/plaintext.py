@@ -40,7 +40,8 @@ class PlaintextEngine(CryptEngine):
 
         sink = stream \
                 >> hash_pipe \
-                >> FileWriter(bundle.path, create_dirs=True, create_backup=True, store_temporary=True)
+                >> FileWriter(bundle.path, create_dirs=True, create_backup=True, store_temporary=True,
+                              size=bundle.file_size, fsync=bundle.vault.config.fsync)
 
         await sink.consume()
 
@@ -19,6 +19,10 @@ class InvalidBundleKey(SyncryptBaseException):
     pass
 
 
+class InvalidBundleContents(SyncryptBaseException):
+    pass
+
+
 class InvalidRevision(SyncryptBaseException):
     pass
 
@@ -92,6 +96,10 @@ class UnexpectedResponseException(BinaryStorageException):
     pass
 
 
+class ConnectionPoolTimeout(BinaryStorageException):
+    status = 503
+
+
 class IdentityError(SyncryptBaseException):
     pass
 
@@ -1,11 +1,12 @@
 import logging
 import os.path
 from fnmatch import fnmatch
+from typing import Dict, List, Optional  # pylint: disable=unused-import
 
 from sqlalchemy import inspect
 from sqlalchemy.orm.exc import NoResultFound
 
-from syncrypt.models import Bundle, Vault, store
+from syncrypt.models import Bundle, BundleStat, Vault, store
 
 logger = logging.getLogger(__name__)
 
@@ -13,23 +14,77 @@ logger = logging.getLogger(__name__)
 class BundleManager:
     model = Bundle
 
+    # Number of updated bundle stats that are written to the store at once
+    stat_batch_size = 100
+
     def __init__(self, app):
         self.app = app
 
+    def get_stat_index(self, vault: Vault) -> Dict[str, BundleStat]:
+        'return the known file stats of all bundles in the vault by relpath'
+        with store.session() as session:
+            stats = session.query(BundleStat).filter(BundleStat.vault_id == vault.id).all()
+            return {stat.relpath: stat for stat in stats}
+
+    def save_stats(self, bundles: List[Bundle]) -> None:
+        'persist the stats of the given bundles that have been changed by Bundle.update'
+        dirty = [bundle for bundle in bundles if bundle.stat_dirty]
+        if not dirty:
+            return
+        with store.session() as session:
+            for bundle in dirty:
+                session.add(bundle.stat)
+                bundle.stat_dirty = False
+
+    def delete_stats(self, vault: Vault, relpaths) -> None:
+        'forget the stats of the given paths, e.g. because their files are gone'
+        relpaths = list(relpaths)
+        if not relpaths:
+            return
+        with store.session() as session:
+            session.query(BundleStat).filter(
+                BundleStat.vault_id == vault.id,
+                BundleStat.relpath.in_(relpaths)
+            ).delete(synchronize_session=False)
+
+    async def _update_with_index(self, bundle: Bundle, index: Dict[str, BundleStat],
+                                 updated: List[Bundle], defer_hash: bool = False) -> None:
+        bundle.stat = index.get(bundle.relpath)
+        await bundle.update(defer_hash=defer_hash)
+        if bundle.stat_dirty:
+            updated.append(bundle)
+            if len(updated) >= self.stat_batch_size:
+                self.save_stats(updated)
+                updated.clear()
+
+    def _attach_vault(self, session, bundle: Bundle, vault: Vault) -> None:
+        '''
+        Set the vault of a bundle that has been loaded in the session, without leaving the vault
+        in the session. Bundles that have been yielded before are transferred concurrently, and
+        they require their vault to be detached.
+        '''
+        # vault is loaded lazily. We already have the vault object here, so just set it.
+        bundle.vault = vault
+        if inspect(vault).session:
+            session.expunge(vault)
+
     async def download_bundles_for_vault(self, vault):
         """
         return an iterator of all bundles in the vault that possible require download
         """
-        with store.session() as session:
-            lst = list(session.query(Bundle).filter(Bundle.vault==vault).all())
-            for bundle in lst:
-                bundle.vault = vault
-                await bundle.update()
-                if bundle.remote_hash_differs:
-                    session.expunge(bundle)
-                    if inspect(vault).session:
-                        session.expunge(vault)
-                    yield bundle
+        index = self.get_stat_index(vault)
+        updated = [] # type: List[Bundle]
+        try:
+            with store.session() as session:
+                lst = list(session.query(Bundle).filter(Bundle.vault==vault).all())
+                for bundle in lst:
+                    self._attach_vault(session, bundle, vault)
+                    await self._update_with_index(bundle, index, updated)
+                    if bundle.remote_hash_differs:
+                        session.expunge(bundle)
+                        yield bundle
+        finally:
+            self.save_stats(updated)
 
     def get_bundle_for_relpath(self, relpath, vault):
         # check if path should be ignored
@@ -57,51 +112,113 @@ class BundleManager:
 
     async def upload_bundles_for_vault(self, vault):
         """
-        return an iterator of all bundles in the vault that require upload
+        return an iterator of all bundles in the vault that require upload. In single pass
+        upload mode, modified files are not hashed yet (see Bundle.update), so some of them
+        may turn out to be unchanged when they are spooled.
         """
         registered_paths = set()
+        # Paths of all bundles whose file exists on disk
+        present_paths = set()
+        # Registered bundles whose file has disappeared. If the backend can rename files,
+        # these are matched against the new files on disk before they are yielded.
+        vanished = [] # type: List[Bundle]
 
         if inspect(vault).session:
             raise ValueError('Vault object is bound to a session')
 
-        # First, try to find changes from database to disk
-        with store.session() as session:
-            lst = list(session.query(Bundle).filter(Bundle.vault==vault).all())
-            for bundle in lst:
-                bundle.vault = vault
-                registered_paths.add(bundle.relpath)
-                await bundle.update()
-                if bundle.remote_hash_differs:
-                    session.expunge(bundle)
-                    if inspect(vault).session:
-                        session.expunge(vault)
-                    yield bundle
+        index = self.get_stat_index(vault)
+        updated = [] # type: List[Bundle]
+        try:
+            # First, try to find changes from database to disk
+            with store.session() as session:
+                lst = list(session.query(Bundle).filter(Bundle.vault==vault).all())
+                for bundle in lst:
+                    self._attach_vault(session, bundle, vault)
+                    registered_paths.add(bundle.relpath)
+                    # In single pass mode, modified files are hashed while their upload is spooled
+                    await self._update_with_index(bundle, index, updated, defer_hash=True)
+                    vanished_file = bundle.local_hash is None and not bundle.hash_deferred
+                    if not vanished_file:
+                        present_paths.add(bundle.relpath)
+                    if bundle.remote_hash_differs:
+                        session.expunge(bundle)
+                        if vanished_file and vault.backend.supports_rename:
+                            vanished.append(bundle)
+                            continue
+                        yield bundle
+
+                if inspect(vault).session:
+                    session.expunge(vault)
+
+                # Next, we will walk the disk to find new bundles
+                async def walk_disk(subfolder=None):
+                    folder = vault.folder
+                    if subfolder:
+                        folder = os.path.join(folder, subfolder)
+                    for file in os.listdir(folder):
+                        if any(fnmatch(file, ig) for ig in vault.config.ignore_patterns):
+                            continue
+                        abspath = os.path.join(folder, file)
+                        relpath = os.path.relpath(abspath, vault.folder)
+                        #logger.debug("%s, %s", abspath, registered_paths)
+                        if relpath in registered_paths:
+                            continue
+                        if os.path.isdir(abspath):
+                            async for bundle in walk_disk(subfolder=relpath):
+                                yield bundle
+                        else:
+                            yield self.get_bundle_for_relpath(relpath, vault)
 
-            if inspect(vault).session:
-                session.expunge(vault)
-
-            # Next, we will walk the disk to find new bundles
-            async def walk_disk(subfolder=None):
-                folder = vault.folder
-                if subfolder:
-                    folder = os.path.join(folder, subfolder)
-                for file in os.listdir(folder):
-                    if any(fnmatch(file, ig) for ig in vault.config.ignore_patterns):
-                        continue
-                    abspath = os.path.join(folder, file)
-                    relpath = os.path.relpath(abspath, vault.folder)
-                    #logger.debug("%s, %s", abspath, registered_paths)
-                    if relpath in registered_paths:
-                        continue
-                    if os.path.isdir(abspath):
-                        async for bundle in walk_disk(subfolder=relpath):
-                            yield bundle
+                async for bundle in walk_disk():
+                    present_paths.add(bundle.relpath)
+                    source = None
+                    if vanished:
+                        source = await self.find_rename_source(bundle, vanished, index, updated)
+                    if source is not None:
+                        vanished.remove(source)
+                        bundle.renamed_from = source
                     else:
-                        yield self.get_bundle_for_relpath(relpath, vault)
+                        await self._update_with_index(bundle, index, updated, defer_hash=True)
+                    yield bundle
+
+                for bundle in vanished:
+                    yield bundle
 
-            async for bundle in walk_disk():
-                await bundle.update()
-                yield bundle
+            # The whole vault has been walked, so stats of files that are gone can go as well
+            self.delete_stats(vault, set(index) - present_paths)
+        finally:
+            self.save_stats(updated)
+
+    async def find_rename_source(self, bundle: Bundle, vanished: List[Bundle],
+                                 index: Dict[str, BundleStat],
+                                 updated: List[Bundle]) -> Optional[Bundle]:
+        '''
+        Find the vanished bundle that has been renamed or moved to the path of the given new
+        bundle. A candidate matches if it has the same size and, encrypted with the key of the
+        candidate, the new file has the same hash. On a match, the bundle keeps the key of
+        its source and has been updated; otherwise it is left untouched.
+        '''
+        try:
+            size = os.stat(bundle.path).st_size
+        except FileNotFoundError:
+            return None
+        candidates = [source for source in vanished
+                      if source.file_size == size and source.hash and source.key]
+        if not candidates:
+            return None
+        for source in candidates:
+            logger.debug('Checking whether %s has been renamed to %s', source, bundle)
+            bundle.chunked = source.chunked
+            await bundle.set_key(source.key)
+            await self._update_with_index(bundle, index, updated)
+            if bundle.local_hash == source.hash:
+                logger.info('Detected rename of %s to %s', source, bundle)
+                return source
+        # Never reuse the key of another file
+        bundle.chunked = False
+        await bundle.generate_key()
+        await self._update_with_index(bundle, index, updated)
+        return None
 
     #def find_for_vault(self, vault: Vault):
     #    return self.download_bundles_for_vault(vault)
@@ -109,6 +226,7 @@ class BundleManager:
     async def delete_for_vault(self, vault: Vault) -> None:
         with store.session() as session:
             session.query(self.model).filter(self.model.vault_id == vault.id).delete()
+            session.query(BundleStat).filter(BundleStat.vault_id == vault.id).delete()
 
     async def get_bundle_by_hash(self, vault: Vault, store_hash) -> Bundle:
         with store.session() as session:
@@ -1,17 +1,33 @@
 import logging
-from sqlalchemy import inspect
-from typing import Sequence
+from typing import Dict, List, Optional, Sequence, Tuple  # pylint: disable=unused-import
 
 import smokesignal
+import trio
+from sqlalchemy import and_, inspect
+from sqlalchemy import exists as sa_exists
 from sqlalchemy.orm.exc import NoResultFound
 
 from syncrypt.exceptions import InvalidRevision, UnexpectedParentInRevision
-from syncrypt.models import (Bundle, Identity, Revision, RevisionOp, UserVaultKey, Vault, VaultUser,
-                             store)
+from syncrypt.models import (Bundle, BundleStat, Identity, Revision, RevisionOp, UserVaultKey, Vault,
+                             VaultUser, store)
+from syncrypt.models.base import decrypt_serialized_metadata
 from syncrypt.pipes import Once
+from syncrypt.pipes.workers import run_in_worker_thread
 
 logger = logging.getLogger(__name__)
 
+# Operations whose revision_metadata is encrypted with the vault key
+METADATA_OPERATIONS = (RevisionOp.Upload, RevisionOp.RenameFile, RevisionOp.SetMetadata)
+
+
+async def _iterate(revisions):
+    if hasattr(revisions, '__aiter__'):
+        async for revision in revisions:
+            yield revision
+    else:
+        for revision in revisions:
+            yield revision
+
 
 class RevisionManager:
     model = Revision
@@ -36,120 +52,317 @@ class RevisionManager:
             session.query(Revision).filter(Revision.local_vault_id == vault.id).delete()
 
     async def apply(self, revision: Revision, vault: Vault):
+        await self.apply_many([revision], vault)
+
+    async def apply_many(self, revisions, vault: Vault, batch_size: Optional[int] = None):
+        '''
+        Apply a chain of revisions (an iterable or async iterable) to the vault.
+
+        The chain is validated in memory and the revisions are committed in groups of
+        batch_size. The vault's revision pointer is stored once per group, in the same
+        transaction. Revisions that are already in the store are skipped; this happens when
+        a revision pointer that has been migrated from the vault config lags behind.
+        '''
         if inspect(vault).session:
             raise ValueError('Vault object is bound to a session')
 
-        revision.assert_valid()
+        if batch_size is None:
+            batch_size = int(self.app.config.app['revision_batch_size'])
+
+        group = [] # type: List[Revision]
+        check_applied = True
+        async for revision in _iterate(revisions):
+            group.append(revision)
+            if len(group) >= batch_size:
+                check_applied = await self._apply_group(group, vault, check_applied)
+                group = []
+        if group:
+            await self._apply_group(group, vault, check_applied)
+
+    async def apply_stream(self, revisions, vault: Vault, lookahead: Optional[int] = None):
+        '''
+        Apply a chain of revisions like apply_many, but in three stages that run concurrently:
+        the revisions are received up to lookahead revisions ahead, their signatures are
+        verified and their metadata is decrypted in worker threads, and they are applied in
+        order. This way a sync is limited by its slowest stage instead of the sum of all
+        stages.
+        '''
+        if lookahead is None:
+            lookahead = int(self.app.config.app['sync_lookahead'])
+
+        send_received, receive_received = trio.open_memory_channel(lookahead) # type: Tuple[trio.abc.SendChannel, trio.abc.ReceiveChannel]
+        send_prepared, receive_prepared = trio.open_memory_channel(lookahead) # type: Tuple[trio.abc.SendChannel, trio.abc.ReceiveChannel]
+
+        async def receive():
+            async with send_received:
+                async for revision in _iterate(revisions):
+                    await send_received.send(revision)
+
+        async def prepared():
+            async for revision, done in receive_prepared:
+                await done.wait()
+                yield revision
 
-        # 1. Check preconditions for this to be a valid revision (current revision must be parent)
-        if vault.revision != revision.parent_id:
-            raise UnexpectedParentInRevision("Expected parent to be {0}, but is {1}"\
-                    .format(revision.parent_id, vault.revision))
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(receive)
+            nursery.start_soon(self._prepare_ahead, receive_received, send_prepared, vault)
+            await self.apply_many(prepared(), vault)
 
-        smokesignal.emit('pre_apply_revision', vault=vault, revision=revision)
+    async def _prepare_ahead(self, received, prepared, vault: Vault) -> None:
+        '''
+        Verify the signature and decrypt the metadata of every received revision in a worker
+        thread and pass the revisions on in order, each together with an event that is set
+        when its preparation has finished.
 
+        This stage tracks the keys that are added along the chain, but it does not decide
+        which keys are allowed. _apply_to_session still looks up the signer key, and it
+        verifies every revision that has not been verified with that exact key here. Errors
+        are left to _apply_to_session as well, so they are raised in the order of the chain.
+        '''
         with store.session() as session:
-            # 2. Check if signing user's key is in the user vault key list
-            if revision.operation != RevisionOp.CreateVault:
-                signer_key = self.app.user_vault_keys.find_key(
-                    vault, revision.user_fingerprint
-                )
-                if not signer_key:
-                    raise InvalidRevision(
-                        "Key {0} is not allowed to generate revisions for vault {1}"
-                            .format(revision.user_fingerprint, vault)
-                    )
-            else:
-                # CreateVault is the only operation that is allowed to provide its own key
-                signer_key = UserVaultKey(
-                    vault_id=vault.id,
-                    user_id=revision.user_id,
-                    fingerprint=revision.user_fingerprint,
-                    public_key=revision.user_public_key,
-                )
+            keys = {fingerprint: public_key for fingerprint, (_, public_key)
+                    in self.app.user_vault_keys.signer_keys(session, vault).items()}
+        private_key = vault.identity.private_key
 
-            # 3. Verify revision signature
-            revision.verify(signer_key.get_identity(self.app.config))
+        def get_identity(public_key: Optional[bytes]) -> Optional[Identity]:
+            if public_key is None:
+                return None
+            try:
+                return self.app.user_vault_keys.get_identity(public_key)
+            except Exception: # pylint: disable=broad-except
+                return None
 
-            # 4. Based on the revision type, perform an action to our state of the vault
-            logger.debug(
-                "Applying %s (%s) to %s",
-                revision.operation,
-                revision.revision_id,
-                vault.id,
-            )
+        async def prepare(revision, public_key, identity, done):
+            try:
+                await run_in_worker_thread(self._prepare, revision, public_key, identity,
+                                           private_key)
+            finally:
+                done.set()
+
+        async with prepared, trio.open_nursery() as nursery:
+            async for revision in received:
+                if revision.operation == RevisionOp.CreateVault:
+                    keys[revision.user_fingerprint] = revision.user_public_key
+                public_key = keys.get(revision.user_fingerprint)
+                done = trio.Event()
+                nursery.start_soon(prepare, revision, public_key, get_identity(public_key), done)
+                await prepared.send((revision, done))
+                if revision.operation == RevisionOp.AddUserKey:
+                    identity = get_identity(revision.user_public_key)
+                    if identity is not None:
+                        keys[identity.get_fingerprint()] = \
+                                identity.public_key.export_key('DER')
+
+    @staticmethod
+    def _prepare(revision: Revision, public_key: Optional[bytes], identity: Optional[Identity],
+                 private_key) -> None:
+        if identity is not None:
+            try:
+                revision.verify(identity)
+                revision.verified_key = public_key
+            except InvalidRevision:
+                pass
+        if private_key is not None and revision.revision_metadata and \
+                revision.operation in METADATA_OPERATIONS:
+            try:
+                revision.decrypted_metadata = \
+                        decrypt_serialized_metadata(private_key, revision.revision_metadata)
+            except Exception: # pylint: disable=broad-except
+                pass
+
+    async def _apply_group(self, group: List[Revision], vault: Vault, check_applied: bool) -> bool:
+        '''
+        Apply and commit a group of revisions in a single transaction. Returns whether the
+        next group could still contain revisions that have been applied before.
+        '''
+        parent_id = vault.revision
+        state = (vault.revision_count, vault.file_count, vault.user_count,
+                 vault.modification_date, vault.revision_id, vault.remote_metadata)
+        vault.revision_count = vault.revision_count or 0
+        vault.file_count = vault.file_count or 0
+        vault.user_count = vault.user_count or 0
+        applied = [] # type: List[Revision]
+
+        try:
+            with store.session() as session:
+                for revision in group:
+                    revision.assert_valid()
+
+                    # 1. Check preconditions for this to be a valid revision (current revision
+                    #    must be parent)
+                    if parent_id != revision.parent_id:
+                        raise UnexpectedParentInRevision("Expected parent to be {0}, but is {1}"\
+                                .format(revision.parent_id, parent_id))
 
-            if revision.operation == RevisionOp.CreateVault:
+                    if check_applied:
+                        check_applied = self._is_applied(session, revision, vault)
+                        if check_applied:
+                            logger.debug("Skipping already applied %s", revision.revision_id)
+                            parent_id = revision.revision_id
+                            continue
+
+                    smokesignal.emit('pre_apply_revision', vault=vault, revision=revision)
+                    await self._apply_to_session(session, revision, vault)
+                    session.flush()
+                    parent_id = revision.revision_id
+                    applied.append(revision)
+
+                logger.debug("Vault state revision_count=%s file_count=%s user_count=%s",
+                        vault.revision_count, vault.file_count, vault.user_count)
+
+                # 6. Store the revision pointer, once for the whole group
+                vault.update_revision(group[-1])
                 session.add(vault)
-                session.add(signer_key)
-                session.add(VaultUser(vault_id=vault.id, user_id=revision.user_id))
-                session.commit()
-            elif revision.operation == RevisionOp.Upload:
-                try:
-                    bundle = await self.app.bundles.get_bundle_by_hash(vault, revision.file_hash)
-                    session.delete(bundle)
-                except FileNotFoundError:
-                    pass
-                bundle = await self.create_bundle_from_revision(revision, vault)
-                session.add(bundle)
-                session.commit()
-                revision.path = bundle.relpath
-            elif revision.operation == RevisionOp.SetMetadata:
-                await vault.write_encrypted_metadata(Once(revision.revision_metadata))
-            elif revision.operation == RevisionOp.RemoveFile:
-                bundle = await self.app.bundles.get_bundle_by_hash(vault, revision.file_hash)
-                session.delete(bundle)
-                session.commit()
-                revision.path = bundle.relpath
-            elif revision.operation == RevisionOp.AddUser:
-                self.app.vault_users.add(vault, revision.user_id)
-            elif revision.operation == RevisionOp.RemoveUser:
-                self.app.vault_users.remove(vault, revision.user_id)
-            elif revision.operation == RevisionOp.AddUserKey:
-                new_identity = Identity.from_key(revision.user_public_key, self.app.config)
-                self.app.user_vault_keys.add(vault, revision.user_id, new_identity)
-            elif revision.operation == RevisionOp.RemoveUserKey:
-                new_identity = Identity.from_key(revision.user_public_key, self.app.config)
-                self.app.user_vault_keys.remove(vault, revision.user_id, new_identity)
+        except BaseException:
+            # The transaction has been rolled back, so do the same for the detached vault
+            (vault.revision_count, vault.file_count, vault.user_count,
+             vault.modification_date, vault.revision_id, vault.remote_metadata) = state
+            # The cached keys might include keys of the group that has been rolled back
+            self.app.user_vault_keys.forget_signer_keys(vault)
+            raise
+
+        metadata = [revision.decrypted_metadata for revision in applied
+                    if revision.operation == RevisionOp.SetMetadata]
+        if metadata:
+            await vault.update_serialized_metadata(Once(metadata[-1]))
+
+        for revision in applied:
+            smokesignal.emit('post_apply_revision', vault=vault, revision=revision)
+
+        return check_applied
+
+    def _is_applied(self, session, revision: Revision, vault: Vault) -> bool:
+        return session.query(sa_exists().where(and_(
+            Revision.local_vault_id == vault.id,
+            Revision.revision_id == revision.revision_id
+        ))).scalar()
+
+    async def _apply_to_session(self, session, revision: Revision, vault: Vault) -> None:
+
+        # 2. Check if signing user's key is in the user vault key list
+        keys = self.app.user_vault_keys.signer_keys(session, vault)
+        if revision.operation != RevisionOp.CreateVault:
+            if revision.user_fingerprint not in keys:
+                raise InvalidRevision(
+                    "Key {0} is not allowed to generate revisions for vault {1}"
+                        .format(revision.user_fingerprint, vault)
+                )
+            signer_id, signer_public_key = keys[revision.user_fingerprint]
+        else:
+            # CreateVault is the only operation that is allowed to provide its own key
+            signer_id, signer_public_key = revision.user_id, revision.user_public_key
+
+        # 3. Verify revision signature, unless it has already been verified with this key
+        if revision.verified_key is None or revision.verified_key != signer_public_key:
+            revision.verify(self.app.user_vault_keys.get_identity(signer_public_key))
+
+        # 4. Based on the revision type, perform an action to our state of the vault
+        logger.debug(
+            "Applying %s (%s) to %s",
+            revision.operation,
+            revision.revision_id,
+            vault.id,
+        )
+
+        if revision.operation == RevisionOp.CreateVault:
+            session.add(vault)
+            session.add(UserVaultKey(vault_id=vault.id, user_id=signer_id,
+                                     fingerprint=revision.user_fingerprint,
+                                     public_key=signer_public_key))
+            keys[revision.user_fingerprint] = (signer_id, signer_public_key)
+            session.add(VaultUser(vault_id=vault.id, user_id=revision.user_id))
+            vault.user_count += 1
+        elif revision.operation == RevisionOp.Upload:
+            bundle = self._find_bundle(session, vault, revision.file_hash)
+            if bundle is None:
+                vault.file_count += 1
             else:
-                raise NotImplementedError(revision.operation)
-
-            # 5. Store the revision in config and db
-            revision.local_vault_id = vault.id
-            revision.creator_id = signer_key.user_id
-            session.add(revision)
-            session.commit()
-            vault.revision_count = (
-                session.query(Revision)
-                .filter(Revision.local_vault_id == vault.id)
-                .count()
-            )
-            if revision.operation in (RevisionOp.Upload, RevisionOp.RemoveFile):
-                vault.file_count = (
-                    session.query(Bundle)
-                    .filter(Bundle.vault_id == vault.id)
-                    .count()
+                session.delete(bundle)
+            bundle = await self.create_bundle_from_revision(revision, vault)
+            session.add(bundle)
+            revision.path = bundle.relpath
+        elif revision.operation == RevisionOp.SetMetadata:
+            # The vault config is only updated once the group has been committed
+            if revision.decrypted_metadata is None:
+                revision.decrypted_metadata = await vault.encrypted_metadata_decoder(
+                    Once(revision.revision_metadata)).read()
+            vault.remote_metadata = revision.decrypted_metadata
+        elif revision.operation == RevisionOp.RemoveFile:
+            bundle = self._find_bundle(session, vault, revision.file_hash)
+            if bundle is None:
+                raise FileNotFoundError(
+                    'No file with hash "{0}" exists in {1}'.format(revision.file_hash, vault)
                 )
-            if revision.operation in (RevisionOp.CreateVault, RevisionOp.AddUser, RevisionOp.RemoveUser):
-                vault.user_count = (
-                    session.query(VaultUser)
-                    .filter(VaultUser.vault_id == vault.id)
-                    .count()
+            session.delete(bundle)
+            self._delete_stat(session, vault, bundle.relpath)
+            vault.file_count -= 1
+            revision.path = bundle.relpath
+        elif revision.operation == RevisionOp.RenameFile:
+            source = self._find_bundle(session, vault, revision.file_hash)
+            if source is None:
+                raise FileNotFoundError(
+                    'No file with hash "{0}" exists in {1}'.format(revision.file_hash, vault)
                 )
-            vault.modification_date = revision.created_at
-            logger.debug("Vault state revision_count=%s file_count=%s user_count=%s",
-                    vault.revision_count, vault.file_count, vault.user_count)
-            # vault.revision = revision.id
-            session.add(vault)
-            vault.update_revision(revision)
-            session.commit()
+            session.delete(source)
+            self._delete_stat(session, vault, source.relpath)
+            # The new store hash follows from the path in the metadata
+            bundle = await self.create_bundle_from_revision(revision, vault)
+            bundle.update_store_hash()
+            target = self._find_bundle(session, vault, bundle.store_hash)
+            if target is not None and target is not source:
+                session.delete(target)
+                vault.file_count -= 1
+            session.add(bundle)
+            revision.path = bundle.relpath
+        elif revision.operation == RevisionOp.AddUser:
+            session.add(VaultUser(vault_id=vault.id, user_id=revision.user_id))
+            vault.user_count += 1
+        elif revision.operation == RevisionOp.RemoveUser:
+            vault.user_count -= session.query(VaultUser).filter(
+                VaultUser.vault_id == vault.id,
+                VaultUser.user_id == revision.user_id
+            ).delete()
+        elif revision.operation == RevisionOp.AddUserKey:
+            new_identity = self.app.user_vault_keys.get_identity(revision.user_public_key)
+            self.app.user_vault_keys.add_to_session(session, vault, revision.user_id,
+                                                    new_identity)
+        elif revision.operation == RevisionOp.RemoveUserKey:
+            new_identity = self.app.user_vault_keys.get_identity(revision.user_public_key)
+            fingerprint = new_identity.get_fingerprint()
+            session.query(UserVaultKey).filter(
+                UserVaultKey.vault_id == vault.id,
+                UserVaultKey.fingerprint == fingerprint,
+                UserVaultKey.user_id == revision.user_id
+            ).delete()
+            if fingerprint in keys and keys[fingerprint][0] == revision.user_id:
+                del keys[fingerprint]
+        else:
+            raise NotImplementedError(revision.operation)
+
+        # 5. Store the revision in the db
+        revision.local_vault_id = vault.id
+        revision.creator_id = signer_id
+        session.add(revision)
+        vault.revision_count += 1
+        vault.modification_date = revision.created_at
+
+    def _delete_stat(self, session, vault: Vault, relpath: str) -> None:
+        session.query(BundleStat).filter(BundleStat.vault_id == vault.id,
+                BundleStat.relpath == relpath).delete(synchronize_session=False)
 
-        smokesignal.emit('post_apply_revision', vault=vault, revision=revision)
+    def _find_bundle(self, session, vault: Vault, store_hash: str) -> Optional[Bundle]:
+        return session.query(Bundle).filter(Bundle.vault_id == vault.id,
+                Bundle.store_hash == store_hash).first()
 
-    async def create_bundle_from_revision(self, revision, vault):
+    async def create_bundle_from_revision(self, revision: Revision, vault: Vault) -> Bundle:
         bundle = Bundle(vault=vault, store_hash=revision.file_hash)
-        metadata = await bundle.decrypt_metadata(revision.revision_metadata)
+        if revision.decrypted_metadata is not None:
+            metadata = bundle.unserialize_metadata(revision.decrypted_metadata)
+        else:
+            metadata = await bundle.decrypt_metadata(revision.revision_metadata)
         bundle.relpath = metadata["filename"]
         bundle.hash = revision.crypt_hash
         bundle.key = metadata["key"]
+        bundle.file_size = metadata.get("file_size")
+        bundle.chunked = bool(metadata.get("chunked", False))
         return bundle
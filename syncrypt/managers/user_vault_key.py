@@ -1,30 +1,42 @@
 import logging
+from typing import Dict, Tuple  # pylint: disable=unused-import
 
 from syncrypt.models import Identity, UserVaultKey, Vault, store
 
 logger = logging.getLogger(__name__)
 
+# The user id and public key of a key that may sign revisions
+SignerKey = Tuple[str, bytes]
+
 
 class UserVaultKeyManager:
     model = UserVaultKey
 
     def __init__(self, app):
         self.app = app
+        self._signer_keys = {} # type: Dict[str, Dict[str, SignerKey]]
+        self._identities = {} # type: Dict[bytes, Identity]
 
     def add(self, vault: Vault, user_id: str, identity: Identity):
-        with store.session() as session:
-            fingerprint = identity.get_fingerprint()
-            public_key = identity.public_key.export_key('DER')
-            user_vault_key = session.query(UserVaultKey)\
-                .filter(self.model.vault_id == vault.id)\
-                .filter(self.model.fingerprint == fingerprint)\
-                .first()
-            if not user_vault_key:
-                session.add(self.model(vault_id=vault.id, fingerprint=fingerprint,
-                    user_id=user_id, public_key=public_key))
-            else:
-                if user_vault_key.user_id != user_id or user_vault_key.public_key != public_key:
-                    raise ValueError("Attempted to another UserVaultKey with existing fingerprint")
+        try:
+            with store.session() as session:
+                self.add_to_session(session, vault, user_id, identity)
+        except BaseException:
+            # The cached keys include the key that has not been committed
+            self.forget_signer_keys(vault)
+            raise
+
+    def add_to_session(self, session, vault: Vault, user_id: str, identity: Identity) -> None:
+        'add the key within the given session and keep the cached signer keys up to date'
+        fingerprint = identity.get_fingerprint()
+        public_key = identity.public_key.export_key('DER')
+        keys = self.signer_keys(session, vault)
+        if fingerprint not in keys:
+            session.add(self.model(vault_id=vault.id, fingerprint=fingerprint,
+                user_id=user_id, public_key=public_key))
+            keys[fingerprint] = (user_id, public_key)
+        elif keys[fingerprint] != (user_id, public_key):
+            raise ValueError("Attempted to add another UserVaultKey with an existing fingerprint")
 
     def list_for_vault(self, vault):
         with store.session() as session:
@@ -35,10 +47,12 @@ class UserVaultKeyManager:
             )
 
     async def delete_for_vault(self, vault: Vault) -> None:
+        self.forget_signer_keys(vault)
         with store.session() as session:
             session.query(self.model).filter(self.model.vault_id == vault.id).delete()
 
     def remove(self, vault: Vault, user_id: str, identity: Identity) -> None:
+        self.forget_signer_keys(vault)
         with store.session() as session:
             session.query(self.model).filter(
                     self.model.vault_id == vault.id,
@@ -53,3 +67,27 @@ class UserVaultKeyManager:
                 .filter(self.model.fingerprint == fingerprint)
                 .first()
             )
+
+    def signer_keys(self, session, vault: Vault) -> Dict[str, SignerKey]:
+        '''
+        Return the keys of the vault by fingerprint. They are loaded with the given session
+        once and cached afterwards. Whoever changes the keys of the vault in a session has to
+        update the returned dict or call forget_signer_keys.
+        '''
+        keys = self._signer_keys.get(vault.id)
+        if keys is None:
+            keys = {
+                key.fingerprint: (key.user_id, key.public_key)
+                for key in session.query(UserVaultKey).filter(self.model.vault_id == vault.id)
+            }
+            self._signer_keys[vault.id] = keys
+        return keys
+
+    def forget_signer_keys(self, vault: Vault) -> None:
+        self._signer_keys.pop(vault.id, None)
+
+    def get_identity(self, public_key: bytes) -> Identity:
+        'return an Identity for the public key, which is only imported once'
+        if public_key not in self._identities:
+            self._identities[public_key] = Identity.from_key(public_key, self.app.config)
+        return self._identities[public_key]
@@ -21,4 +21,20 @@ class VaultManager:
             vault.revision_count = 0
             vault.file_count = 0
             vault.user_count = 0
+            vault.reset_revision()
             session.commit()
+
+    async def migrate_revision(self, vault: Vault):
+        '''
+        Move the revision pointer of the vault from its config file into the store. This is
+        only required once for vaults that have been created by older versions.
+        '''
+        revision_id = vault.config_revision
+        if revision_id is not None:
+            with store.session() as session:
+                session.add(vault)
+                if vault.revision_id is None:
+                    vault.logger.info('Moving revision pointer %s to the store', revision_id)
+                    vault.revision_id = revision_id
+        # Only drop the pointer from the config once the store has it
+        vault.clear_config_revision()
@@ -1,12 +1,16 @@
+import logging
 import os.path
+import re
 from contextlib import contextmanager
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import SingletonThreadPool
 
 from syncrypt.models.base import Base
 
 from .bundle import Bundle
+from .bundle_stat import BundleStat
 from .flying_vault import FlyingVault
 from .identity import Identity, IdentityState
 from .revision import Revision, RevisionOp
@@ -15,6 +19,14 @@ from .vault_user import VaultUser
 from .vault import Vault, VaultState
 from .logitem import LogItem
 
+logger = logging.getLogger(__name__)
+
+# Increase this whenever columns or indexes are added to existing tables
+SCHEMA_VERSION = 2
+
+# These pragmas can be set in the "store" section of the app config
+SQLITE_PRAGMAS = ('journal_mode', 'synchronous', 'cache_size', 'mmap_size')
+
 
 class Store:
     def __init__(self):
@@ -27,9 +39,62 @@ class Store:
             db = os.path.join(config.config_dir, db)
             os.makedirs(os.path.dirname(db), exist_ok=True)
         uri = '{engine}:///{db}'.format(engine=engine, db=db)
-        engine = create_engine(uri, echo=False)
+        if engine == 'sqlite' and db != ':memory:':
+            # By default, SQLite file databases get a new connection for every session. Keep
+            # one per thread instead, so that the page cache (store.cache_size) and the
+            # mapping (store.mmap_size) are reused.
+            engine = create_engine(uri, echo=False, poolclass=SingletonThreadPool)
+        else:
+            engine = create_engine(uri, echo=False)
+        if engine.dialect.name == 'sqlite':
+            self.set_pragmas(engine, {
+                name: config.get('store.' + name) for name in SQLITE_PRAGMAS
+                if config.get('store.' + name) is not None
+            })
         self._session = sessionmaker(bind=engine, expire_on_commit=False, autoflush=False)
         Base.metadata.create_all(engine)
+        self.migrate(engine)
+
+    def set_pragmas(self, engine, pragmas):
+        'set the given pragmas on every new connection'
+        for name, value in pragmas.items():
+            if not re.match(r'^-?\w+$', str(value)):
+                raise ValueError('Invalid value for store.{0}: {1}'.format(name, value))
+
+        @event.listens_for(engine, 'connect')
+        def on_connect(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas.items():
+                cursor.execute('PRAGMA {0} = {1}'.format(name, value))
+            cursor.close()
+
+    def migrate(self, engine):
+        '''
+        Bring the tables of an existing database up to date with the models. create_all only
+        creates missing tables, so this adds the columns and indexes that have been
+        introduced after a table was created.
+        '''
+        if engine.dialect.name == 'sqlite':
+            if engine.execute('PRAGMA user_version').scalar() >= SCHEMA_VERSION:
+                return
+
+        inspector = inspect(engine)
+        for table in Base.metadata.sorted_tables:
+            columns = [column['name'] for column in inspector.get_columns(table.name)]
+            for column in table.columns:
+                if column.name not in columns:
+                    logger.info('Adding column %s.%s', table.name, column.name)
+                    engine.execute('ALTER TABLE {0} ADD COLUMN {1} {2}'.format(
+                        table.name, column.name, column.type.compile(engine.dialect)
+                    ))
+            indexes = [index['name'] for index in inspector.get_indexes(table.name)]
+            for index in table.indexes:
+                if index.name not in indexes:
+                    logger.info('Creating index %s', index.name)
+                    index.create(engine)
+
+        if engine.dialect.name == 'sqlite':
+            engine.execute('PRAGMA user_version = {0}'.format(SCHEMA_VERSION))
 
     def drop(self, config):
         engine = config.get('store.engine')
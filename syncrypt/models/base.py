@@ -1,4 +1,7 @@
+import snappy
 import umsgpack
+from Cryptodome.Cipher import PKCS1_OAEP
+from Cryptodome.Util.number import size
 from sqlalchemy.ext.declarative import declarative_base
 
 from syncrypt.pipes import (DecryptRSA_PKCS1_OAEP, EncryptRSA_PKCS1_OAEP, Once, SnappyCompress,
@@ -7,6 +10,18 @@ from syncrypt.pipes import (DecryptRSA_PKCS1_OAEP, EncryptRSA_PKCS1_OAEP, Once,
 Base = declarative_base()
 
 
+def decrypt_serialized_metadata(private_key, metadata: bytes) -> bytes:
+    '''
+    Decrypt and decompress metadata like MetadataHolder.encrypted_metadata_decoder, but
+    without pipes, so that it can run in a worker thread.
+    '''
+    cipher = PKCS1_OAEP.new(private_key)
+    block_size = size(private_key.n) // 8
+    compressed = b''.join(cipher.decrypt(metadata[offset:offset + block_size])
+                          for offset in range(0, len(metadata), block_size))
+    return snappy.StreamDecompressor().decompress(compressed)
+
+
 class MetadataHolder:
 
     @property
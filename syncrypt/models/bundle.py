@@ -6,14 +6,15 @@ from typing import Optional
 
 import trio
 import umsgpack
-from sqlalchemy import Column, ForeignKey, Integer, LargeBinary, String, orm
+from sqlalchemy import Boolean, Column, ForeignKey, Index, Integer, LargeBinary, String, orm
 from sqlalchemy.orm import relationship
 
 from syncrypt.exceptions import InvalidBundleKey, InvalidBundleMetadata
-from syncrypt.pipes import FileWriter, Once
+from syncrypt.pipes import FileWriter, Once, Pipe
 from syncrypt.utils.filesystem import splitpath
 
 from .base import Base, MetadataHolder
+from .bundle_stat import BundleStat
 
 logger = logging.getLogger(__name__)
 
@@ -23,6 +24,10 @@ VERBOSE_DEBUG = False
 class Bundle(MetadataHolder, Base):
     'A Bundle represents a file and some additional information'
     __tablename__ = 'bundle'
+    __table_args__ = (
+        Index('ix_bundle_vault_store_hash', 'vault_id', 'store_hash'),
+        Index('ix_bundle_vault_relpath', 'vault_id', 'relpath'),
+    )
 
     # TODO normally these fields should only be set when applying the revsion
     # do we need an extra model to deal with local size/hash etc.?
@@ -34,6 +39,8 @@ class Bundle(MetadataHolder, Base):
     store_hash = Column(String(128), nullable=False)
     hash = Column(String(128), nullable=False)
     key = Column(LargeBinary(512)) # AES key used
+    # True if the contents are stored as content-defined chunks (see syncrypt.crypt.delta)
+    chunked = Column(Boolean(), default=False)
 
     #__slots__ = ('path', 'relpath', 'vault', 'file_size', 'file_size_crypt',
     #        'store_hash', 'crypt_hash', 'uptodate',
@@ -43,18 +50,38 @@ class Bundle(MetadataHolder, Base):
         super(Bundle, self).__init__(*args, **kwargs)
         self.uptodate = False
         self.local_hash = None # type: Optional[str]
+        self.local_size = None # type: Optional[int]
         self.bytes_written = 0
+        self._upload_reader = None # type: Optional[Pipe]
+        # True if the backend has already stored the contents for the next upload revision
+        self.contents_stored = False
+        self.stat = None # type: Optional[BundleStat]
+        self.stat_dirty = False
+        # True if the file has not been hashed by update, because its upload will hash it
+        self.hash_deferred = False
+        self.renamed_from = None # type: Optional[Bundle]
 
     @orm.reconstructor
     def init_on_load(self):
         self.uptodate = False
         self.bytes_written = 0
         self.local_hash = None
+        self.local_size = None
+        self._upload_reader = None
+        self.contents_stored = False
+        self.stat = None
+        self.stat_dirty = False
+        self.hash_deferred = False
+        self.renamed_from = None
         self.relpath = self.relpath.decode() # why is this binary?!
 
     def update_store_hash(self):
         h = hashlib.new(self.vault.config.hash_algo)
-        h.update(self.encode_path(self.relpath))
+        if isinstance(self.relpath, bytes):
+            # Already encoded, i.e. the filename from the metadata
+            h.update(self.relpath)
+        else:
+            h.update(self.encode_path(self.relpath))
         self.store_hash = h.hexdigest()
 
     def __hash__(self):
@@ -67,13 +94,16 @@ class Bundle(MetadataHolder, Base):
 
     @property
     def _metadata(self):
-        return {
+        metadata = {
             'filename': self.encode_path(self.relpath),
             'key': self.key,
             'hash': self.local_hash,
-            'file_size': self.file_size,
+            'file_size': self.local_size,
             'key_size': self.key_size
         }
+        if self.chunked:
+            metadata['chunked'] = True
+        return metadata
 
     @property
     def key_size(self):
@@ -126,7 +156,11 @@ class Bundle(MetadataHolder, Base):
 
     async def generate_key(self):
         logger.debug('Generating key for %s', self)
-        self.key = os.urandom(self.key_size)
+        await self.set_key(os.urandom(self.key_size))
+
+    async def set_key(self, key: bytes):
+        'use the given key for this bundle and write it into the metadata'
+        self.key = key
         if not os.path.exists(os.path.dirname(self.path_metadata)):
             os.makedirs(os.path.dirname(self.path_metadata))
         assert len(self.key) == self.key_size
@@ -140,11 +174,21 @@ class Bundle(MetadataHolder, Base):
         await sink.consume()
         assert os.path.exists(self.path_metadata)
 
-    async def update(self):
-        'update encrypted hash (store in .vault)'
+    async def update(self, defer_hash: bool = False):
+        '''
+        update encrypted hash (store in .vault)
+
+        If defer_hash is set and the file would have to be hashed in single pass upload mode,
+        it is not read here, as spooling its upload hashes it anyway (see
+        encrypted_upload_reader). Until then, local_hash stays None and the bundle counts as
+        modified.
+        '''
 
         #logger.info('Updating %s', self)
 
+        self.contents_stored = False
+        self.hash_deferred = False
+
         try:
             await self.load_key()
         except (FileNotFoundError, InvalidBundleKey):
@@ -153,14 +197,101 @@ class Bundle(MetadataHolder, Base):
         assert self.path is not None
 
         if os.path.exists(self.path):
-            self.local_hash, self.file_size_crypt = \
-                await self.vault.crypt_engine.get_crypt_hash_and_size(self)
+            single_pass = self.vault.config.single_pass_upload
+            stat_result = os.stat(self.path)
+            self.local_size = stat_result.st_size
+            if self.stat is not None and self.stat.matches(stat_result, self.key) and \
+                    (single_pass or self.stat.file_size_crypt is not None):
+                # The file did not change since we hashed it the last time
+                self.local_hash = self.stat.local_hash
+                self.file_size_crypt = None if single_pass else self.stat.file_size_crypt
+            elif single_pass and defer_hash and not self.delta_upload:
+                self.local_hash = None
+                self.file_size_crypt = None
+                self.hash_deferred = True
+            else:
+                if single_pass:
+                    # The encrypted size will be determined while spooling the upload
+                    self.local_hash = await self.vault.crypt_engine.get_crypt_hash(self)
+                    self.file_size_crypt = None
+                else:
+                    self.local_hash, self.file_size_crypt = \
+                        await self.vault.crypt_engine.get_crypt_hash_and_size(self)
+                self.update_stat(stat_result)
             self.uptodate = True
         else:
             self.local_hash = None
             self.file_size_crypt = None
             self.uptodate = True
 
+    def update_stat(self, stat_result):
+        '''
+        Remember the stat of the file for the hash that has just been computed. Nothing is
+        remembered if the file has been modified while it was hashed.
+        '''
+        if BundleStat.stat_key(os.stat(self.path)) != BundleStat.stat_key(stat_result):
+            return
+        if self.stat is None:
+            self.stat = BundleStat(vault_id=self.vault.id, relpath=self.relpath)
+        self.stat.update_from(stat_result, self.key, self.local_hash, self.file_size_crypt)
+        self.stat_dirty = True
+
+    async def encrypted_upload_reader(self) -> Pipe:
+        '''
+        Return a pipe with the encrypted contents of this bundle. In single pass upload mode,
+        this will also update local_hash and file_size_crypt from the spooled contents.
+        '''
+        if self._upload_reader is not None:
+            reader, self._upload_reader = self._upload_reader, None
+            return reader
+        crypt_engine = self.vault.crypt_engine
+        if self.vault.config.single_pass_upload:
+            stat_result = os.stat(self.path)
+            self.local_hash, self.file_size_crypt, reader = \
+                await crypt_engine.spool_encrypted_stream(self)
+            if self.hash_deferred:
+                self.hash_deferred = False
+                self.update_stat(stat_result)
+            return reader
+        return crypt_engine.read_encrypted_stream(self)
+
+    async def prepare_upload(self):
+        '''
+        Encrypt and spool the contents ahead of the upload, so that this can run concurrently
+        for many bundles. The next call to encrypted_upload_reader will return this pipe.
+        '''
+        if self.renamed_from is not None:
+            # Only the metadata changes
+            return
+        if self.delta_upload:
+            # The chunks are encrypted while uploading, as most of them are usually known
+            return
+        self._upload_reader = await self.encrypted_upload_reader()
+
+    async def discard_upload_reader(self):
+        '''
+        Close the pipe prepared by prepare_upload if it has not been uploaded, which removes
+        its spool.
+        '''
+        if self._upload_reader is not None:
+            reader, self._upload_reader = self._upload_reader, None
+            await reader.close()
+
+    @property
+    def upload_spool_size(self) -> int:
+        'Estimated number of bytes that prepare_upload will spool for this bundle'
+        if self.renamed_from is not None or self.delta_upload or \
+                not self.vault.config.single_pass_upload or \
+                not self.vault.crypt_engine.spools_upload:
+            return 0
+        return self.local_size or 0
+
+    @property
+    def delta_upload(self) -> bool:
+        'True if this bundle is uploaded as content-defined chunks'
+        config = self.vault.config
+        return config.delta_sync and (self.local_size or 0) >= config.delta_min_size
+
     def __str__(self):
         return "<Bundle: {0}>".format(self.relpath)
 
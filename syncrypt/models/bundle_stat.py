@@ -0,0 +1,49 @@
+import hashlib
+
+from sqlalchemy import BigInteger, Column, Index, Integer, String
+
+from .base import Base
+
+
+class BundleStat(Base):
+    '''
+    Remembers the file system stat of a bundle's file at the time its local hash was computed.
+    As long as the stat and the bundle key did not change, the hash does not need to be
+    computed again.
+    '''
+    __tablename__ = 'bundle_stat'
+
+    id = Column(Integer(), primary_key=True)
+    vault_id = Column(String(128), nullable=False)
+    relpath = Column(String(512), nullable=False)
+    file_size = Column(BigInteger())
+    mtime_ns = Column(BigInteger())
+    ctime_ns = Column(BigInteger())
+    inode = Column(BigInteger())
+    key_digest = Column(String(64))
+    local_hash = Column(String(128))
+    file_size_crypt = Column(BigInteger(), nullable=True)
+
+    __table_args__ = (Index('ix_bundle_stat_vault_relpath', 'vault_id', 'relpath', unique=True),)
+
+    @staticmethod
+    def digest_key(key):
+        return hashlib.sha256(key).hexdigest()
+
+    @staticmethod
+    def stat_key(stat_result):
+        return (stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ctime_ns,
+                stat_result.st_ino)
+
+    def matches(self, stat_result, key):
+        return (self.file_size, self.mtime_ns, self.ctime_ns, self.inode) == \
+                self.stat_key(stat_result) and self.key_digest == self.digest_key(key)
+
+    def update_from(self, stat_result, key, local_hash, file_size_crypt):
+        self.file_size = stat_result.st_size
+        self.mtime_ns = stat_result.st_mtime_ns
+        self.ctime_ns = stat_result.st_ctime_ns
+        self.inode = stat_result.st_ino
+        self.key_digest = self.digest_key(key)
+        self.local_hash = local_hash
+        self.file_size_crypt = file_size_crypt
@@ -1,7 +1,7 @@
 import enum
 import logging
 
-from sqlalchemy import Column, DateTime, Enum, ForeignKey, Integer, String
+from sqlalchemy import Column, DateTime, Enum, ForeignKey, Index, Integer, String
 
 from .base import Base
 
@@ -17,6 +17,9 @@ class LogLevel(enum.Enum):
 
 class LogItem(Base):
     __tablename__ = "logitem"
+    __table_args__ = (
+        Index("ix_logitem_local_vault", "local_vault_id"),
+    )
 
     # These are for local management
     id = Column(Integer(), primary_key=True)
@@ -1,7 +1,8 @@
 import enum
 import logging
+from typing import Optional  # pylint: disable=unused-import
 
-from sqlalchemy import (Column, DateTime, Enum, ForeignKey, Integer, LargeBinary, String,
+from sqlalchemy import (Column, DateTime, Enum, ForeignKey, Index, Integer, LargeBinary, String,
                         UniqueConstraint)
 
 from syncrypt.exceptions import InvalidRevision
@@ -31,6 +32,7 @@ class Revision(Base):
     __tablename__ = "revision"
     __table_args__ = (
         UniqueConstraint("revision_id", "local_vault_id", name="revision_vault_uniq"),
+        Index("ix_revision_local_vault", "local_vault_id"),
     )
 
     # These are for local management
@@ -51,7 +53,8 @@ class Revision(Base):
     # Additional fields for OP_CREATE_VAULT
     vault_public_key = Column(LargeBinary(4096), nullable=True)
 
-    # Additional fields for OP_UPLOAD
+    # Additional fields for OP_UPLOAD & OP_RENAME_FILE. A rename refers to the old file by
+    # file_hash, the new path is part of the encrypted metadata.
     file_hash = Column(String(250), nullable=True)
     path = Column(String(255), nullable=True)
     revision_metadata = Column(LargeBinary(), nullable=True)
@@ -64,6 +67,11 @@ class Revision(Base):
     # Additional fields for OP_CREATE_VAULT & OP_ADD_USER_KEY
     user_public_key = Column(LargeBinary(4096), nullable=True)
 
+    # The public key that the signature has already been verified with, if any
+    verified_key = None # type: Optional[bytes]
+    # The serialized revision_metadata, if it has already been decrypted
+    decrypted_metadata = None # type: Optional[bytes]
+
     def assert_valid(self) -> None:
         if self.vault_id is None and self.operation != RevisionOp.CreateVault:
             raise InvalidRevision("Invalid vault_id: {0}".format(self.vault_id))
@@ -102,6 +110,9 @@ class Revision(Base):
             pass
         elif self.operation == RevisionOp.RemoveFile:
             assert self.file_hash, "file_hash"
+        elif self.operation == RevisionOp.RenameFile:
+            assert self.file_hash, "file_hash"
+            assert self.revision_metadata, "revision_metadata"
         elif self.operation in (RevisionOp.CreateVault, RevisionOp.AddUser, RevisionOp.RemoveUser):
             assert self.user_id, "user_id"
         elif self.operation in (RevisionOp.AddUserKey, RevisionOp.RemoveUserKey):
@@ -132,6 +143,11 @@ class Revision(Base):
         elif self.operation == RevisionOp.RemoveFile:
             message += str(self.parent_id).encode() + sep
             message += str(self.file_hash).encode()
+        elif self.operation == RevisionOp.RenameFile:
+            message += str(self.parent_id).encode() + sep
+            message += str(self.file_hash).encode() + sep
+            message += str(self.crypt_hash).encode() + sep
+            message += self.revision_metadata
         elif self.operation in (RevisionOp.AddUser, RevisionOp.RemoveUser):
             message += str(self.parent_id).encode() + sep
             message += self.user_id.encode()
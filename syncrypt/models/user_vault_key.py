@@ -1,5 +1,5 @@
 
-from sqlalchemy import Column, Integer, LargeBinary, String
+from sqlalchemy import Column, Index, Integer, LargeBinary, String
 
 from .base import Base
 from .identity import Identity
@@ -7,6 +7,9 @@ from .identity import Identity
 
 class UserVaultKey(Base):
     __tablename__ = 'user_vault_key'
+    __table_args__ = (
+        Index('ix_user_vault_key_vault_fingerprint', 'vault_id', 'fingerprint'),
+    )
 
     id = Column(Integer(), primary_key=True)
     vault_id = Column(String(128))
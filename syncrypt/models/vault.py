@@ -10,6 +10,7 @@ from enum import Enum
 from io import BytesIO, StringIO
 from typing import TYPE_CHECKING, Dict, Optional  # pylint: disable=unused-import
 
+import trio
 from sqlalchemy import Column, DateTime, Integer, LargeBinary, String, orm
 
 from syncrypt.config import VaultConfig
@@ -67,12 +68,16 @@ class Vault(MetadataHolder, Base):
     modification_date = Column(DateTime())
     revision_count = Column(Integer(), default=0)
     user_count = Column(Integer(), default=0)
+    # The id of the latest revision that has been applied to this vault
+    revision_id = Column("revision", String(128), nullable=True)
 
     def __init__(self, folder):
         self.state = VaultState.UNINITIALIZED
         self.folder = folder
         self._bundle_cache = {}  # type: Dict[str, Bundle]
         self._identity = None  # type: Optional[Identity]
+        # Revisions that refer to the current revision as their parent are created under this lock
+        self.revision_lock = trio.Lock()
 
         self.logger = VaultLoggerAdapter(self, logger)
 
@@ -86,6 +91,7 @@ class Vault(MetadataHolder, Base):
             self.state = VaultState.UNINITIALIZED
         self._bundle_cache = {}
         self._identity = None
+        self.revision_lock = trio.Lock()
         self.logger = VaultLoggerAdapter(self, logger)
 
     @property
@@ -176,9 +182,8 @@ class Vault(MetadataHolder, Base):
         return os.path.join(self.folder, ".vault", "metadata")
 
     @property
-    def revision(self):
-        # The "or None" is when "revision" is an empty string
-        return self.config.vault.get("revision") or None
+    def revision(self) -> Optional[str]:
+        return self.revision_id
 
     @property
     def config_path(self):
@@ -199,9 +204,12 @@ class Vault(MetadataHolder, Base):
         return bundle
 
     def reset_revision(self) -> None:
+        '''
+        Reset the revision pointer. Like update_revision, this only changes the vault
+        object; the pointer is persisted when the vault is stored.
+        '''
         self.logger.debug('Reset vault revision')
-        with self.config.update_context():
-            self.config.update("vault", {"revision": ""})
+        self.revision_id = None
 
     def update_revision(self, revision: Revision) -> None:
         if not isinstance(revision, Revision):
@@ -209,8 +217,24 @@ class Vault(MetadataHolder, Base):
         # if isinstance(revision_id, bytes):
         #    revision_id = revision_id.decode(self.config.encoding)
         self.logger.debug('Update vault revision to "%s"', revision.revision_id)
-        with self.config.update_context():
-            self.config.update("vault", {"revision": revision.revision_id})
+        self.revision_id = revision.revision_id
+
+    @property
+    def config_revision(self) -> Optional[str]:
+        '''
+        The revision pointer from the vault config. Older versions of Syncrypt stored it
+        there instead of the store.
+        '''
+        # The "or None" is when "revision" is an empty string
+        return self.config.vault.get("revision") or None
+
+    def clear_config_revision(self) -> None:
+        '''
+        Remove the revision pointer from the vault config.
+        '''
+        if "revision" in self.config.vault:
+            with self.config.update_context():
+                self.config.unset("vault.revision")
 
     def package_info(self):
         """
@@ -1,11 +1,14 @@
 
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import Column, Index, Integer, String
 
 from .base import Base
 
 
 class VaultUser(Base):
     __tablename__ = 'vault_user'
+    __table_args__ = (
+        Index('ix_vault_user_vault_user', 'vault_id', 'user_id'),
+    )
 
     id = Column(Integer(), primary_key=True)
     vault_id = Column(String(128))
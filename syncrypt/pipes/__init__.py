@@ -1,7 +1,8 @@
 from .base import Buffered, BufferedFree, Count, Limit, Once, Pipe, Repeat
 from .compression import SnappyCompress, SnappyDecompress
-from .crypto import (DecryptAES, DecryptRSA, DecryptRSA_PKCS1_OAEP, EncryptAES, EncryptRSA,
-                     EncryptRSA_PKCS1_OAEP, Hash, PadAES, UnpadAES)
+from .crypto import (ChunkedGCM, DecryptAES, DecryptAESGCM, DecryptRSA, DecryptRSA_PKCS1_OAEP,
+                     EncryptAES, EncryptAESGCM, EncryptRSA, EncryptRSA_PKCS1_OAEP, Hash, PadAES,
+                     UnpadAES)
 from .http import ChunkedURLWriter, URLReader, URLWriter
-from .io import (FileReader, FileWriter, StdoutWriter, StreamReader, StreamWriter, TrioStreamReader,
-                 TrioStreamWriter)
+from .io import (FileReader, FileWriter, ReceiveStream, SpoolReader, SpoolWriter, StdoutWriter,
+                 StreamReader, StreamWriter, TrioStreamReader, TrioStreamWriter)
@@ -1,7 +1,14 @@
-from typing import Optional
+from collections import deque
+from typing import Deque, Optional  # pylint: disable=unused-import
+
+
+DEFAULT_CHUNK_SIZE = 1024 * 10 * 16
 
 
 class Pipe(object):
+    # Leftover of a read() that did not fit into the buffer given to readinto()
+    _readinto_pending = None  # type: Optional[memoryview]
+
     def __init__(self):
         self._eof = False
         self.input = None  # type: Optional[Pipe]
@@ -12,6 +19,31 @@ class Pipe(object):
         else:
             raise NotImplementedError()
 
+    @property
+    def supports_readinto(self):
+        '''
+        True if this pipe can fill a buffer given to readinto() without allocating an
+        intermediate bytes object for each chunk.
+        '''
+        return False
+
+    async def readinto(self, buffer) -> int:
+        '''
+        Read data from this pipe into the writable buffer and return the number of bytes
+        written into it (0 means end of stream). This implementation falls back to read() and
+        keeps data that did not fit into the buffer for the next call.
+        '''
+        pending = self._readinto_pending
+        if pending is None:
+            data = await self.read()
+            if len(data) == 0:
+                return 0
+            pending = memoryview(data)
+        count = min(len(buffer), len(pending))
+        buffer[:count] = pending[:count]
+        self._readinto_pending = pending[count:] if count < len(pending) else None
+        return count
+
     async def close(self):
         if self.input:
             return (await self.input.close())
@@ -19,22 +51,28 @@ class Pipe(object):
     async def consume(self):
         'read all data from this pipe, but forget about that data'
         try:
-            while True:
-                if len((await self.read())) == 0:
-                    break
+            if self.supports_readinto:
+                # Let the pipes fill the same buffer over and over again
+                buffer = bytearray(DEFAULT_CHUNK_SIZE)
+                while (await self.readinto(buffer)) > 0:
+                    pass
+            else:
+                while True:
+                    if len((await self.read())) == 0:
+                        break
         finally:
             await self.close()
 
     async def readall(self):
         'read all data from this pipe and return that'
-        data = b''
+        chunks = []
         while True:
             new_data = await self.read()
             if len(new_data) == 0:
                 break
-            data += new_data
+            chunks.append(new_data)
         await self.close()
-        return data
+        return b''.join(chunks)
 
     def add_input(self, input):
         self.input = input
@@ -77,12 +115,68 @@ class Repeat(Pipe):
             self.copies -= 1
         return self.buf
 
+class ByteQueue(object):
+    '''
+    A FIFO byte buffer with a read offset into its first chunk. Appended
+    chunks are stored as they are, so appending never copies. Popping hands
+    out memoryview slices whenever the requested bytes lie within a single
+    chunk and only joins (and thus copies) when a read spans several chunks.
+    This keeps the cost of buffering linear, regardless of how the chunk
+    sizes of writer and reader relate to each other.
+    '''
+    def __init__(self):
+        self._chunks = deque()  # type: Deque[bytes]
+        self._offset = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def append(self, data):
+        if len(data) > 0:
+            self._chunks.append(data)
+            self._size += len(data)
+
+    def _take(self, length):
+        'take at most length bytes from the first chunk'
+        head = self._chunks[0]
+        available = len(head) - self._offset
+        if self._offset == 0 and length >= available:
+            self._chunks.popleft()
+            return head
+        view = memoryview(head)[self._offset:self._offset + length]
+        if length >= available:
+            self._chunks.popleft()
+            self._offset = 0
+        else:
+            self._offset += length
+        return view
+
+    def pop(self, length=-1):
+        'remove and return up to length bytes from the front of the queue'
+        if length < 0 or length > self._size:
+            length = self._size
+        if length == 0:
+            return b''
+        self._size -= length
+        first = self._take(length)
+        if len(first) == length:
+            return first
+        parts = [first]
+        left = length - len(first)
+        while left > 0:
+            part = self._take(left)
+            parts.append(part)
+            left -= len(part)
+        return b''.join(parts)
+
+
 class BufferedFree(Pipe):
     '''
     This will buffer the input data to allow arbitrary reads.
     '''
     def __init__(self):
-        self.buf = b''
+        self.buf = ByteQueue()
         super(BufferedFree, self).__init__()
 
     async def read(self, count=-1):
@@ -96,18 +190,11 @@ class BufferedFree(Pipe):
                 if len(add_buf) == 0:
                     self._eof = True
                     break
-                self.buf += add_buf
-        if len(self.buf) < count:
-            ret = self.buf
-            self.buf = b''
-            return ret
-        else:
-            return self.pop(count)
+                self.buf.append(add_buf)
+        return self.pop(count)
 
     def pop(self, length):
-        retbuf = self.buf[:length]
-        self.buf = self.buf[length:]
-        return retbuf
+        return self.buf.pop(length)
 
 class Buffered(Pipe):
     '''
@@ -117,10 +204,11 @@ class Buffered(Pipe):
     | {head_size} | {buf_size} | {buf_size} | {buf_size} | ...
     +-------------+------------+------------+------------+----
 
+    The parts may be handed out as memoryviews of the input chunks.
     '''
     def __init__(self, buf_size, head_size=0):
         self.buf_size = buf_size
-        self.buf = b''
+        self.buf = ByteQueue()
         self.head = False
         self.head_size = head_size
         super(Buffered, self).__init__()
@@ -132,7 +220,7 @@ class Buffered(Pipe):
 
         if not self.head and self.head_size > 0:
             assert count == self.head_size
-            self.buf += await self.input.read(count)
+            self.buf.append(await self.input.read(count))
             self.head = True
             return self.pop(self.head_size)
 
@@ -142,13 +230,11 @@ class Buffered(Pipe):
             if len(add_buf) == 0:
                 self._eof = True
                 break
-            self.buf += add_buf
+            self.buf.append(add_buf)
         return self.pop(self.buf_size)
 
     def pop(self, length):
-        retbuf = self.buf[:length]
-        self.buf = self.buf[length:]
-        return retbuf
+        return self.buf.pop(length)
 
 
 class Limit(Pipe):
@@ -175,6 +261,24 @@ class Limit(Pipe):
         self.bytes_read += len(buf)
         return buf
 
+    @property
+    def supports_readinto(self):
+        return self.input is not None and self.input.supports_readinto
+
+    async def readinto(self, buffer) -> int:
+        assert self.input is not None
+        if self._eof:
+            return 0
+        left = self.bytes_limit - self.bytes_read
+        if left == 0:
+            self._eof = True
+            return 0
+        count = await self.input.readinto(memoryview(buffer)[:left])
+        if count == 0:
+            self._eof = True
+        self.bytes_read += count
+        return count
+
 
 class Count(Pipe):
     def __init__(self):
@@ -190,3 +294,13 @@ class Count(Pipe):
         buf = await self.input.read(count)
         self._bytes_passed += len(buf)
         return buf
+
+    @property
+    def supports_readinto(self):
+        return self.input is not None and self.input.supports_readinto
+
+    async def readinto(self, buffer) -> int:
+        assert self.input is not None
+        count = await self.input.readinto(buffer)
+        self._bytes_passed += count
+        return count
@@ -1,6 +1,7 @@
 import snappy
 
 from .base import Pipe
+from .workers import run_in_worker
 
 
 class SnappyCompress(Pipe):
@@ -10,7 +11,12 @@ class SnappyCompress(Pipe):
     async def read(self, count=-1):
         assert self.input is not None
         contents = await self.input.read(count)
-        return self.compressor.add_chunk(contents, compress=True)
+        return (await run_in_worker(len(contents), self._compress, contents))
+
+    def _compress(self, contents):
+        # snappy requires bytes, but the input might be a memoryview. Converting it here lets
+        # the copy happen in the worker thread as well.
+        return self.compressor.add_chunk(bytes(contents), True)
 
 
 class SnappyDecompress(Pipe):
@@ -19,12 +25,12 @@ class SnappyDecompress(Pipe):
 
     async def read(self, count=-1):
         assert self.input is not None
-        data = b''
         while True:
             contents = await self.input.read(count)
             if len(contents) == 0:
                 self._eof = True
                 return contents
-            data += self.decompressor.decompress(contents)
+            data = await run_in_worker(len(contents), self.decompressor.decompress,
+                                       bytes(contents))
             if len(data) > 0:
                 return data
@@ -1,13 +1,20 @@
 import hashlib
 import logging
 import os
+import struct
+from functools import partial
+from typing import List, Optional, Tuple  # pylint: disable=unused-import
 
 import Cryptodome.Util
 from Cryptodome.Cipher import AES, PKCS1_OAEP, PKCS1_v1_5
 
+import trio
+
+from syncrypt.exceptions import InvalidBundleContents
 from syncrypt.utils.padding import PKCS5Padding
 
-from .base import Buffered, Pipe
+from .base import Buffered, BufferedFree, Pipe
+from .workers import run_in_worker
 
 logger = logging.getLogger(__name__)
 
@@ -36,9 +43,20 @@ class Hash(Pipe):
         assert self.input is not None
         data = await self.input.read(count)
         if len(data) != 0:
-            self._hash.update(data)
+            await run_in_worker(len(data), self._hash.update, data)
         return data
 
+    @property
+    def supports_readinto(self):
+        return self.input is not None and self.input.supports_readinto
+
+    async def readinto(self, buffer) -> int:
+        assert self.input is not None
+        count = await self.input.readinto(buffer)
+        if count != 0:
+            await run_in_worker(count, self._hash.update, memoryview(buffer)[:count])
+        return count
+
 
 class AESPipe(Pipe):
     # AES has a fixed data block size of 16 bytes
@@ -104,6 +122,13 @@ class EncryptAES(AESPipe):
         self.key = key
         self.iv = None
 
+    def init_cipher(self) -> bytes:
+        self.iv = os.urandom(self.block_size)
+        self.aes = AES.new(self.key, AES.MODE_CBC, self.iv)
+        if VERBOSE_DEBUG:
+            logger.debug('Writing IV of %d bytes', len(self.iv))
+        return self.iv
+
     async def read(self, count=-1):
         assert self.input is not None
         data = await self.input.read(count)
@@ -111,15 +136,44 @@ class EncryptAES(AESPipe):
             return b''
         enc_data = b''
         if self.aes is None:
-            self.iv = os.urandom(self.block_size)
-            self.aes = AES.new(self.key, AES.MODE_CBC, self.iv)
-            if VERBOSE_DEBUG:
-                logger.debug('Writing IV of %d bytes', len(self.iv))
-            enc_data += self.iv
-        enc_data += self.aes.encrypt(data)
+            enc_data += self.init_cipher()
+        assert self.aes is not None
+        enc_data += await run_in_worker(len(data), self.aes.encrypt, data)
         logger.debug('Encrypting %d bytes -> %d bytes', len(data), len(enc_data))
         return enc_data
 
+    @property
+    def supports_readinto(self):
+        return True
+
+    async def readinto(self, buffer) -> int:
+        assert self.input is not None
+        if self._readinto_pending is not None:
+            return (await super(EncryptAES, self).readinto(buffer))
+        data = await self.input.read()
+        if len(data) == 0:
+            return 0
+        view = memoryview(buffer)
+        offset = 0
+        if self.aes is None:
+            iv = self.init_cipher()
+            assert self.aes is not None
+            if len(iv) + len(data) > len(buffer):
+                enc_data = await run_in_worker(len(data), self.aes.encrypt, data)
+                self._readinto_pending = memoryview(iv + enc_data)
+                return (await super(EncryptAES, self).readinto(buffer))
+            view[:len(iv)] = iv
+            offset = len(iv)
+        elif len(data) > len(buffer):
+            enc_data = await run_in_worker(len(data), self.aes.encrypt, data)
+            self._readinto_pending = memoryview(enc_data)
+            return (await super(EncryptAES, self).readinto(buffer))
+        # Encrypt directly into the given buffer
+        output = view[offset:offset + len(data)]
+        await run_in_worker(len(data), partial(self.aes.encrypt, data, output=output))
+        logger.debug('Encrypting %d bytes -> %d bytes', len(data), offset + len(data))
+        return offset + len(data)
+
 
 class DecryptAES(AESPipe):
     def __init__(self, key):
@@ -138,10 +192,180 @@ class DecryptAES(AESPipe):
             self.aes = AES.new(self.key, AES.MODE_CBC, iv)
         data = await self.input.read(count)
         logger.debug('Decrypting %d bytes', len(data))
-        original_content = self.aes.decrypt(data)
+        original_content = await run_in_worker(len(data), self.aes.decrypt, data)
         return original_content
 
 
+class ChunkedGCM(object):
+    '''
+    The chunked AES-GCM format encrypts fixed-size chunks of a file independently:
+
+        +---------+------------------+--------------+---------+---------+----
+        | version | chunk size (u32) | nonce prefix | chunk 0 | chunk 1 | ...
+        +---------+------------------+--------------+---------+---------+----
+
+    Every chunk holds chunk_size bytes of plaintext (only the last one may be shorter, and
+    it is never omitted) followed by its tag. A chunk is encrypted with the nonce
+    "<nonce prefix><chunk index>" and authenticates its index and whether it is the last
+    chunk, so that chunks can be neither reordered nor cut off.
+    '''
+    version = 1
+    header = struct.Struct('>BI8s')
+    chunk_info = struct.Struct('>I?')
+    tag_size = 16
+
+    def __init__(self, key, chunk_size, nonce_prefix=None):
+        self.key = key
+        self.chunk_size = chunk_size
+        self.nonce_prefix = os.urandom(8) if nonce_prefix is None else nonce_prefix
+
+    @classmethod
+    def from_header(cls, key, data) -> 'ChunkedGCM':
+        if len(data) != cls.header.size:
+            raise InvalidBundleContents('Premature end of stream, could not read header')
+        version, chunk_size, nonce_prefix = cls.header.unpack(data)
+        if version != cls.version or chunk_size == 0:
+            raise InvalidBundleContents('Unknown chunked format {0}'.format(version))
+        return cls(key, chunk_size, nonce_prefix)
+
+    def pack_header(self) -> bytes:
+        return self.header.pack(self.version, self.chunk_size, self.nonce_prefix)
+
+    @property
+    def encrypted_chunk_size(self):
+        return self.chunk_size + self.tag_size
+
+    @classmethod
+    def encrypted_size(cls, size, chunk_size):
+        'return the size of the ciphertext of "size" bytes of plaintext'
+        chunks = max(1, -(-size // chunk_size))
+        return cls.header.size + size + chunks * cls.tag_size
+
+    def _cipher(self, index, last):
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=self.nonce_prefix + struct.pack('>I', index))
+        cipher.update(self.chunk_info.pack(index, last))
+        return cipher
+
+    def encrypt_chunk(self, index, data, last) -> bytes:
+        ciphertext, tag = self._cipher(index, last).encrypt_and_digest(data)
+        return ciphertext + tag
+
+    def decrypt_chunk(self, index, data, last) -> bytes:
+        if len(data) < self.tag_size:
+            raise InvalidBundleContents('Chunk {0} is truncated'.format(index))
+        data = memoryview(data)
+        try:
+            return self._cipher(index, last).decrypt_and_verify(data[:-self.tag_size],
+                                                                data[-self.tag_size:])
+        except ValueError:
+            raise InvalidBundleContents('Chunk {0} failed authentication'.format(index))
+
+
+class _ChunkedGCMPipe(Pipe):
+    '''
+    Base for pipes that process the chunks of the chunked AES-GCM format. Up to "parallel"
+    chunks are handed to worker threads at the same time.
+    '''
+    def __init__(self, parallel=1):
+        super(_ChunkedGCMPipe, self).__init__()
+        self.parallel = max(1, parallel)
+        self.format = None  # type: Optional[ChunkedGCM]
+        self._index = 0
+        self._lookahead = None
+
+    async def _read_chunk(self):
+        raise NotImplementedError()
+
+    def _process_chunk(self, index, data, last):
+        raise NotImplementedError()
+
+    async def _process_batch(self):
+        'process the next batch of chunks and return the results in order'
+        if self._lookahead is None:
+            self._lookahead = await self._read_chunk()
+        batch = []  # type: List[Tuple[int, bytes, bool]]
+        while len(batch) < self.parallel and not self._eof:
+            chunk = self._lookahead
+            # Read one chunk ahead to know whether this is the last one
+            self._lookahead = await self._read_chunk()
+            last = len(self._lookahead) == 0
+            batch.append((self._index, chunk, last))
+            self._index += 1
+            self._eof = last
+        results = [b''] * len(batch)
+
+        async def process(position, index, data, last):
+            results[position] = await run_in_worker(len(data), self._process_chunk,
+                                                    index, data, last)
+
+        async with trio.open_nursery() as nursery:
+            for position, (index, data, last) in enumerate(batch):
+                nursery.start_soon(process, position, index, data, last)
+        return b''.join(results)
+
+
+class EncryptAESGCM(_ChunkedGCMPipe):
+    '''
+    Encrypts the input stream into the chunked AES-GCM format (see ChunkedGCM).
+    '''
+    def __init__(self, key, chunk_size, parallel=1):
+        super(EncryptAESGCM, self).__init__(parallel)
+        self.format = ChunkedGCM(key, chunk_size)
+        self._buffered = None  # type: Optional[Buffered]
+
+    def add_input(self, input):
+        assert self.format is not None
+        # Cut the input into chunks of exactly chunk_size bytes
+        self._buffered = input >> Buffered(self.format.chunk_size)
+        self.input = input
+
+    async def _read_chunk(self):
+        assert self._buffered is not None
+        return (await self._buffered.read())
+
+    def _process_chunk(self, index, data, last):
+        assert self.format is not None
+        return self.format.encrypt_chunk(index, data, last)
+
+    async def read(self, count=-1):
+        assert self.format is not None
+        if self._eof:
+            return b''
+        header = self.format.pack_header() if self._index == 0 else b''
+        return header + (await self._process_batch())
+
+
+class DecryptAESGCM(_ChunkedGCMPipe):
+    '''
+    Decrypts a stream in the chunked AES-GCM format (see ChunkedGCM).
+    '''
+    def __init__(self, key, parallel=1):
+        super(DecryptAESGCM, self).__init__(parallel)
+        self.key = key
+        self._buffered = None  # type: Optional[BufferedFree]
+
+    def add_input(self, input):
+        self._buffered = input >> BufferedFree()
+        self.input = input
+
+    async def _read_chunk(self):
+        assert self._buffered is not None and self.format is not None
+        return (await self._buffered.read(self.format.encrypted_chunk_size))
+
+    def _process_chunk(self, index, data, last):
+        assert self.format is not None
+        return self.format.decrypt_chunk(index, data, last)
+
+    async def read(self, count=-1):
+        assert self._buffered is not None
+        if self._eof:
+            return b''
+        if self.format is None:
+            header = await self._buffered.read(ChunkedGCM.header.size)
+            self.format = ChunkedGCM.from_header(self.key, header)
+        return (await self._process_batch())
+
+
 class EncryptRSA(Buffered):
     '''
     Asymmetric encryption pipe that divides the incoming stream into blocks
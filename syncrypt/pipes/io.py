@@ -1,12 +1,16 @@
 import logging
+import mmap
 import os.path
 import shutil
+import stat
 import sys
+import tempfile
 from typing import Optional, Any
 
 import trio
+from typing_extensions import Protocol
 
-from .base import Sink, Source
+from .base import DEFAULT_CHUNK_SIZE, Sink, Source
 
 logger = logging.getLogger(__name__)
 
@@ -21,25 +25,123 @@ class StreamReader(Source):
         pass
 
 
+# Regular files of at least this size are mapped into memory by FileReader
+MMAP_THRESHOLD = 1024 * 1024
+
+
 class FileReader(Source):
-    def __init__(self, filename: str) -> None:
+    '''
+    Reads a file chunk by chunk. Regular files of at least mmap_threshold bytes are mapped
+    into memory and handed out as read-only memoryview slices of the mapping, which saves a
+    thread round trip and a copy per chunk. The mapping stays open until the reader is
+    closed (or until the last slice is gone). If the file changes while it is being read, the
+    reader continues with ordinary reads at the same position.
+    '''
+    def __init__(self, filename: str, mmap_threshold: Optional[int] = MMAP_THRESHOLD) -> None:
         self.filename = filename
+        self.mmap_threshold = mmap_threshold
         self.handle = None  # type: Any
+        self._map = None  # type: Optional[mmap.mmap]
+        self._view = None  # type: Optional[memoryview]
+        self._stat = None  # type: Optional[os.stat_result]
+        self._pos = 0
         super(FileReader, self).__init__()
 
+    async def open(self):
+        self.handle = await trio.open_file(self.filename, 'rb')
+        if self.mmap_threshold is None:
+            return
+        stat_result = os.fstat(self.handle.fileno())
+        if not stat.S_ISREG(stat_result.st_mode) or stat_result.st_size < self.mmap_threshold:
+            return
+        try:
+            self._map = mmap.mmap(self.handle.fileno(), stat_result.st_size,
+                                  access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            logger.debug('Could not map %s into memory', self.filename)
+            return
+        self._view = memoryview(self._map)
+        self._stat = stat_result
+
+    @property
+    def mapped(self):
+        return self._view is not None
+
+    async def _next_mapped(self, count: int) -> Optional[memoryview]:
+        '''
+        Return the next chunk of the mapping as a read-only memoryview, or None if the file
+        has to be read through the handle.
+        '''
+        if self._view is None:
+            return None
+        assert self._stat is not None
+        # Accessing a mapping beyond the end of a truncated file would crash the process
+        current = os.fstat(self.handle.fileno())
+        if (current.st_size, current.st_mtime_ns) != \
+                (self._stat.st_size, self._stat.st_mtime_ns):
+            logger.info('%s changed while reading it, continuing without mmap', self.filename)
+            # Slices that have been handed out keep the mapping, it is closed in close()
+            self._view = None
+            await self.handle.seek(self._pos)
+            return None
+        chunk = self._view[self._pos:self._pos + count]
+        self._pos += len(chunk)
+        return chunk
+
+    def _unmap(self):
+        self._view = None
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # Slices are still referenced, the mapping is released together with them
+                pass
+            self._map = None
+
     async def read(self, count=-1):
         if self.handle is None and not self._eof:
-            self.handle = await trio.open_file(self.filename, 'rb')
+            await self.open()
         assert self.handle is not None
+        if count == -1:
+            count = DEFAULT_CHUNK_SIZE
+        chunk = await self._next_mapped(count)
+        if chunk is not None:
+            return chunk if len(chunk) > 0 else b''
         return (await self.handle.read(count))
 
+    @property
+    def supports_readinto(self):
+        return True
+
+    async def readinto(self, buffer) -> int:
+        if self.handle is None and not self._eof:
+            await self.open()
+        assert self.handle is not None
+        view = await self._next_mapped(len(buffer))  # type: Optional[memoryview]
+        if view is not None:
+            count = len(view)  # type: int
+            buffer[:count] = view
+            return count
+        return (await self.handle.readinto(buffer))
+
     async def close(self):
+        self._unmap()
         if self.handle:
             await self.handle.aclose()
 
 
+class ReceiveStream(Protocol):
+    'The part of trio.abc.ReceiveStream that TrioStreamReader and FrameReader read from'
+
+    async def receive_some(self, max_bytes: Optional[int] = None) -> bytes:
+        raise NotImplementedError()
+
+    async def aclose(self) -> None:
+        raise NotImplementedError()
+
+
 class TrioStreamReader(Source):
-    def __init__(self, stream: trio.abc.ReceiveStream) -> None:
+    def __init__(self, stream: ReceiveStream) -> None:
         self.stream = stream
         super(TrioStreamReader, self).__init__()
 
@@ -76,6 +178,18 @@ class TrioStreamWriter(StreamWriter):
             self.bytes_written += len(buf)
         return buf
 
+    @property
+    def supports_readinto(self):
+        return self.input is not None and self.input.supports_readinto
+
+    async def readinto(self, buffer) -> int:
+        assert self.input is not None
+        count = await self.input.readinto(buffer)
+        if count > 0:
+            await self.writer.send_all(memoryview(buffer)[:count])
+            self.bytes_written += count
+        return count
+
 
 class StdoutWriter(StreamWriter):
     def __init__(self):
@@ -83,41 +197,105 @@ class StdoutWriter(StreamWriter):
         super(StdoutWriter, self).__init__(self.handle.buffer)
 
 
+# Durability of the files written by FileWriter:
+#   none       leave it to the operating system when data reaches the disk
+#   finalize   fsync the file before it is closed (and moved into place)
+#   directory  additionally fsync the containing directory, so that the new name persists
+FSYNC_POLICIES = ('none', 'finalize', 'directory')
+
+# FileWriter collects chunks until it can write at least this many bytes at once
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+
 class FileWriter(Sink):
-    def __init__(self, filename, create_dirs=False, create_backup=False, store_temporary=False):
+    '''
+    Writes the input stream into a file. Chunks are collected into writes of at least
+    buffer_size bytes. If the final size of the file is known, pass it as "size" to reserve
+    the disk space upfront, which keeps large files from being fragmented.
+    '''
+    def __init__(self, filename, create_dirs=False, create_backup=False, store_temporary=False,
+                 size=None, fsync='none', buffer_size=WRITE_BUFFER_SIZE):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('Unknown fsync policy: {0}'.format(fsync))
         self.filename = filename
         self.handle = None
         self.create_dirs = create_dirs
         self.create_backup = create_backup
         self.store_temporary = store_temporary
+        self.size = size
+        self.fsync = fsync
+        self.buffer_size = buffer_size
+        self.bytes_written = 0
+        self._buffer = bytearray()
+        self._preallocated = False
         super(FileWriter, self).__init__()
 
+    async def open(self):
+        fn = self.filename
+        if self.create_dirs:
+            os.makedirs(os.path.dirname(fn), exist_ok=True)
+        if self.create_backup and os.path.exists(fn) and not self.store_temporary:
+            shutil.move(fn, self.get_backup_filename(fn))
+        if self.store_temporary:
+            fn = self.get_temporary_filename(fn)
+        logger.debug('Writing to %s', fn)
+        self.handle = await trio.open_file(fn, 'wb')
+        if self.size and hasattr(os, 'posix_fallocate'):
+            try:
+                await trio.to_thread.run_sync(os.posix_fallocate, self.handle.fileno(), 0,
+                                              self.size)
+                self._preallocated = True
+            except OSError:
+                # Not supported by this filesystem
+                logger.debug('Could not preallocate %d bytes for %s', self.size, fn)
+
+    async def write(self, data):
+        assert self.handle is not None
+        if len(data) == 0:
+            return
+        self.bytes_written += len(data)
+        if not self._buffer and len(data) >= self.buffer_size:
+            await self.handle.write(data)
+            return
+        self._buffer += data
+        if len(self._buffer) >= self.buffer_size:
+            await self.flush()
+
+    async def flush(self):
+        if self._buffer:
+            assert self.handle is not None
+            await self.handle.write(self._buffer)
+            self._buffer = bytearray()
+
     async def read(self, count=-1):
         if self.handle is None and not self._eof:
-            fn = self.filename
-            if self.create_dirs and not os.path.exists(os.path.dirname(fn)):
-                os.makedirs(os.path.dirname(fn))
-            if self.create_backup and os.path.exists(fn) and not self.store_temporary:
-                shutil.move(fn, self.get_backup_filename(fn))
-            if self.store_temporary:
-                fn = self.get_temporary_filename(fn)
-            logger.debug('Writing to %s', fn)
-            self.handle = await trio.open_file(fn, 'wb')
+            await self.open()
         assert self.input is not None
         contents = await self.input.read(count)
-        assert self.handle is not None
-        await self.handle.write(contents)
+        await self.write(contents)
         return contents
 
+    @property
+    def supports_readinto(self):
+        return self.input is not None and self.input.supports_readinto
+
+    async def readinto(self, buffer) -> int:
+        if self.handle is None and not self._eof:
+            await self.open()
+        assert self.input is not None
+        count = await self.input.readinto(buffer)
+        await self.write(memoryview(buffer)[:count])
+        return count
+
     async def finalize(self):
         fn = self.filename
         if self.store_temporary: # we only wrote a temporary filename
-            if os.path.exists(fn):
-                if self.create_backup:
-                    shutil.move(fn, self.get_backup_filename(fn))
-                else:
-                    os.remove(fn)
-            shutil.move(self.get_temporary_filename(fn), fn)
+            if self.create_backup and os.path.exists(fn):
+                shutil.move(fn, self.get_backup_filename(fn))
+            # The temporary file is in the same directory, so the file is replaced atomically
+            os.replace(self.get_temporary_filename(fn), fn)
+            if self.fsync == 'directory':
+                await trio.to_thread.run_sync(fsync_directory, os.path.dirname(fn))
 
     def get_temporary_filename(self, filename):
         # TODO: more elaborate temporary filename composition required
@@ -131,5 +309,88 @@ class FileWriter(Sink):
         if self.input:
             await self.input.close()
         if self.handle:
+            await self.flush()
             await self.handle.flush()
+            if self._preallocated and self.bytes_written != self.size:
+                # Give back space that has been reserved, but not written
+                await self.handle.truncate(self.bytes_written)
+            if self.fsync != 'none':
+                await trio.to_thread.run_sync(os.fsync, self.handle.fileno())
+            await self.handle.aclose()
+            self.handle = None
+            self._eof = True
+            if self.fsync == 'directory' and not self.store_temporary:
+                await trio.to_thread.run_sync(fsync_directory,
+                                              os.path.dirname(self.filename))
+
+
+def fsync_directory(path):
+    'make sure that new or renamed entries in the directory are persisted'
+    if not hasattr(os, 'O_DIRECTORY'):
+        return # Not possible (nor required) on Windows
+    fd = os.open(path or '.', os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class SpoolWriter(Sink):
+    '''
+    Writes the input stream into a temporary spool. The spool is kept in memory
+    until it grows beyond max_size bytes and will then be rolled over to a
+    temporary file. After the input has been consumed, the spooled contents
+    can be read again through the pipe returned by "reader()".
+    '''
+    def __init__(self, max_size=0, dir=None):
+        self.max_size = max_size
+        self.dir = dir
+        self.handle = None  # type: Any
+        self.bytes_written = 0
+        super(SpoolWriter, self).__init__()
+
+    async def read(self, count=-1):
+        assert self.input is not None
+        if self.handle is None:
+            self.handle = trio.wrap_file(
+                tempfile.SpooledTemporaryFile(max_size=self.max_size, dir=self.dir)
+            )
+        contents = await self.input.read(count)
+        if len(contents) > 0:
+            await self.handle.write(contents)
+            self.bytes_written += len(contents)
+        return contents
+
+    def reader(self) -> 'SpoolReader':
+        assert self.handle is not None
+        return SpoolReader(self.handle)
+
+    async def close(self):
+        # Do NOT close the spool here, it will be closed by its reader
+        if self.input:
+            await self.input.close()
+
+
+class SpoolReader(Source):
+    def __init__(self, handle) -> None:
+        self.handle = handle
+        self._rewound = False
+        super(SpoolReader, self).__init__()
+
+    async def read(self, count=-1):
+        if self._eof:
+            return b''
+        if not self._rewound:
+            await self.handle.seek(0)
+            self._rewound = True
+        if count == -1:
+            count = DEFAULT_CHUNK_SIZE
+        buf = await self.handle.read(count)
+        if len(buf) == 0:
+            self._eof = True
+        return buf
+
+    async def close(self):
+        if self.handle is not None:
             await self.handle.aclose()
+            self.handle = None
@@ -0,0 +1,39 @@
+'''
+CPU bound work in pipes (encryption, compression and hashing) can be run in a
+bounded pool of worker threads instead of on the trio event loop. pycryptodome,
+snappy and hashlib release the GIL while processing large buffers, so this
+also allows the pipes of several vaults to use multiple cores.
+
+Every pipe awaits the result of its own work item, so a pipe chain never has
+more than one chunk per stage in flight. When all worker threads are busy, the
+pipes simply wait for a free slot, which propagates backpressure upstream.
+'''
+from typing import Optional  # pylint: disable=unused-import
+
+import trio
+
+# Chunks smaller than this are processed inline, as the round trip to a
+# worker thread would cost more than the work itself.
+MIN_OFFLOAD_SIZE = 64 * 1024
+
+_limiter = None  # type: Optional[trio.CapacityLimiter]
+
+
+def set_worker_threads(count: int) -> None:
+    'Set the maximum number of worker threads. 0 will run all work on the event loop.'
+    global _limiter  # pylint: disable=global-statement
+    _limiter = trio.CapacityLimiter(count) if count > 0 else None
+
+
+async def run_in_worker(size: int, fn, *args):
+    'Run fn(*args) in a worker thread if size is big enough to be worth it.'
+    if size < MIN_OFFLOAD_SIZE:
+        return fn(*args)
+    return (await run_in_worker_thread(fn, *args))
+
+
+async def run_in_worker_thread(fn, *args):
+    'Run fn(*args) in a worker thread, unless worker threads are disabled.'
+    if _limiter is None:
+        return fn(*args)
+    return (await trio.to_thread.run_sync(fn, *args, limiter=_limiter))
@@ -0,0 +1,158 @@
+import hashlib
+from typing import List, Optional  # pylint: disable=unused-import
+
+try:
+    import numpy
+except ImportError: # the pure Python scan cuts at the same positions, only much slower
+    numpy = None # type: ignore
+
+# A fixed table of 256 pseudo random 64 bit values. It must never change, as otherwise files
+# would be cut at different positions and no chunk could be reused.
+GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], 'big') for i in range(256)]
+
+# The gear hash only depends on this many of the most recent bytes
+WINDOW_SIZE = 64
+HASH_MASK = (1 << 64) - 1
+
+if numpy is not None:
+    GEAR_ARRAY = numpy.array(GEAR, dtype=numpy.uint64)
+
+# Number of positions that find_cut_candidates hashes at once. The arrays for a block should
+# stay in the CPU cache.
+BLOCK_SIZE = 16 * 1024
+
+
+def find_cut_candidates(data, first: int, mask: int):
+    '''
+    Return the positions from first on, after which the gear hash of data has none of the mask
+    bits set. mask has to consist of the top bits of the hash. Instead of rolling the hash byte
+    by byte, the hashes of all positions in a block are added up from the hashes of windows of
+    half the size, so numpy only needs a few passes over the block. first must be at least
+    WINDOW_SIZE - 1.
+    '''
+    view = numpy.frombuffer(data, dtype=numpy.uint8)
+    # The top bits are zero if and only if the hash is below the lowest of them
+    threshold = numpy.uint64(HASH_MASK - mask + 1)
+    # Multiplying wraps around like the rolling hash and is faster than shifting
+    steps = [(width, numpy.uint64(1 << width)) for width in (1, 2, 4, 8, 16, 32)]
+    scratch = numpy.empty(BLOCK_SIZE + WINDOW_SIZE, dtype=numpy.uint64)
+    candidates = [numpy.empty(0, dtype=numpy.intp)]
+    for block in range(first, len(data), BLOCK_SIZE):
+        window = view[block - WINDOW_SIZE + 1:block + BLOCK_SIZE]
+        hashes = GEAR_ARRAY[window.astype(numpy.intp)]
+        spare = scratch
+        for width, factor in steps:
+            count = len(hashes) - width
+            doubled = numpy.multiply(hashes[:count], factor, out=spare[:count])
+            doubled += hashes[width:]
+            hashes, spare = doubled, hashes
+        candidates.append(block + numpy.flatnonzero(hashes < threshold))
+    return numpy.concatenate(candidates)
+
+
+class ContentDefinedChunker(object):
+    '''
+    Cuts a stream into chunks at positions that depend on the content around them, so that an
+    insertion or deletion only changes the chunks near it. A chunk ends where the top bits of
+    a rolling gear hash are all zero, but no earlier than min_size and no later than max_size
+    bytes after its start. Because the hash only depends on the last WINDOW_SIZE bytes, the
+    first min_size - WINDOW_SIZE bytes of every chunk do not have to be hashed at all. If numpy
+    is installed, the hashes are computed for whole blocks of the stream at once (see
+    find_cut_candidates); the chunks are the same either way.
+    '''
+
+    def __init__(self, avg_size: int, min_size: Optional[int] = None,
+                 max_size: Optional[int] = None) -> None:
+        self.min_size = max(WINDOW_SIZE, avg_size // 2 if min_size is None else min_size)
+        self.max_size = avg_size * 4 if max_size is None else max_size
+        assert self.min_size <= avg_size <= self.max_size
+        bits = max(1, (avg_size - self.min_size).bit_length() - 1)
+        self.mask = ((1 << bits) - 1) << (64 - bits)
+        self._pending = bytearray()
+        self._pos = 0
+        self._hash = 0
+
+    def feed(self, data) -> List[bytes]:
+        'add data to the stream and return the chunks that have been completed by it'
+        self._pending += data
+        chunks = []  # type: List[bytes]
+        start = 0
+        for end in self._find_ends():
+            chunks.append(bytes(self._pending[start:end]))
+            start = end
+        del self._pending[:start]
+        return chunks
+
+    def finish(self) -> List[bytes]:
+        'return the last chunk of the stream'
+        chunks = [bytes(self._pending)] if self._pending else []
+        self._pending = bytearray()
+        self._pos = 0
+        self._hash = 0
+        return chunks
+
+    def _find_ends(self) -> List[int]:
+        if numpy is not None:
+            return self._find_ends_vectorized()
+        ends = []  # type: List[int]
+        start = 0
+        while True:
+            end = self._scan(start)
+            if end is None:
+                return ends
+            ends.append(end)
+            start = end
+            self._pos = 0
+            self._hash = 0
+
+    def _find_ends_vectorized(self) -> List[int]:
+        # The hash at a position does not depend on where its chunk starts, so the candidates
+        # for all chunks in the pending data can be found at once
+        size = len(self._pending)
+        lower = max(self._pos, self.min_size)
+        candidates = find_cut_candidates(self._pending, lower, self.mask)
+        ends = []  # type: List[int]
+        start = 0
+        while True:
+            upper = min(start + self.max_size, size)
+            index = numpy.searchsorted(candidates, lower)
+            if index < len(candidates) and candidates[index] < upper:
+                end = int(candidates[index]) + 1
+            elif start + self.max_size <= size:
+                end = start + self.max_size
+            else:
+                break
+            ends.append(end)
+            start = end
+            lower = start + self.min_size
+        self._pos = size - start
+        return ends
+
+    def _scan(self, start: int) -> Optional[int]:
+        pending = self._pending
+        size = len(pending) - start
+        pos = self._pos
+        skip_to = min(self.min_size - WINDOW_SIZE, size)
+        if pos < skip_to:
+            pos = skip_to
+        h = self._hash
+        gear = GEAR
+        # Fill the window up to min_size, no chunk may end before that
+        warmup_end = min(self.min_size, size)
+        if pos < warmup_end:
+            for byte in pending[start + pos:start + warmup_end]:
+                h = ((h << 1) + gear[byte]) & HASH_MASK
+            pos = warmup_end
+        mask = self.mask
+        limit = min(size, self.max_size)
+        if pos < limit:
+            for byte in pending[start + pos:start + limit]:
+                h = ((h << 1) + gear[byte]) & HASH_MASK
+                pos += 1
+                if not h & mask:
+                    return start + pos
+        if pos >= self.max_size:
+            return start + pos
+        self._pos = pos
+        self._hash = h
+        return None
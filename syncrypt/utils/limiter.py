@@ -0,0 +1,28 @@
+import trio
+
+
+class ByteLimiter(object):
+    '''
+    Limits the number of bytes that are in flight at the same time, for example the total
+    size of all bundles that are currently being downloaded. A request that is larger than
+    the whole budget will be admitted as soon as nothing else is in flight.
+    '''
+
+    def __init__(self, total_bytes: int) -> None:
+        self.total_bytes = total_bytes
+        self.bytes_in_flight = 0
+        self._condition = trio.Condition()
+
+    async def acquire(self, size: int) -> None:
+        async with self._condition:
+            while self.bytes_in_flight > 0 and \
+                    self.bytes_in_flight + size > self.total_bytes:
+                await self._condition.wait()
+            self.bytes_in_flight += size
+
+    async def release(self, size: int) -> None:
+        # This is usually called while cleaning up, possibly in a cancelled scope
+        with trio.CancelScope(shield=True):
+            async with self._condition:
+                self.bytes_in_flight -= size
+                self._condition.notify_all()
@@ -2,7 +2,7 @@ class PKCS5Padding(object):
     @staticmethod
     def pad(s, block_size):
         padding = block_size - len(s) % block_size
-        return s + bytes((padding,) * padding)
+        return bytes(s) + bytes((padding,) * padding)
 
     @staticmethod
     def unpad(s):
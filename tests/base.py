@@ -14,7 +14,7 @@ from syncrypt.auth import CredentialsAuthenticationProvider
 from syncrypt.backends import BinaryStorageBackend, LocalStorageBackend
 from syncrypt.backends.binary import get_manager_instance
 from syncrypt.config import AppConfig
-from syncrypt.models import Vault, store
+from syncrypt.models import Vault, VaultState, store
 from syncrypt.utils.logging import setup_logging
 
 
@@ -105,6 +105,35 @@ async def local_api_client(local_daemon_app, asyncio_loop):
     await client.close()
 
 
+async def wait_for_vault(app, interval=0.1):
+    '''
+    Wait until the first vault of the daemon app is ready. This includes its initial pull
+    and push, because they apply revisions as well.
+    '''
+    controller = app.vault_controllers[app.vaults[0].id]
+    while controller.state in (VaultState.UNINITIALIZED, VaultState.SYNCING):
+        await trio.sleep(interval)
+
+
+async def clone_vault(app, vault, working_dir, add=True):
+    '''
+    Clone an initialized vault into the folder "othervault" by copying its config. The clone
+    is opened and, unless add is False, added to the app. Its files still have to be pulled.
+    '''
+    other_vault_path = os.path.join(working_dir, "othervault")
+    if os.path.exists(other_vault_path):
+        shutil.rmtree(other_vault_path)
+    shutil.copytree(
+        os.path.join(vault.folder, ".vault"),
+        os.path.join(other_vault_path, ".vault"),
+    )
+    other_vault = Vault(other_vault_path)
+    await app.open_or_init(other_vault)
+    if add:
+        await app.add_vault(other_vault)
+    return other_vault
+
+
 def assertSameFilesInFolder(self, *folders):
     def all_same(items):
         return all(x == items[0] for x in items)
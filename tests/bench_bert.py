@@ -0,0 +1,31 @@
+'''
+Compare the single pass BERT codec with the erlastic based one on the messages of a vault
+changes listing. Usage: python -m tests.bench_bert [count]
+'''
+import sys
+import time
+
+from erlastic import Atom
+
+from syncrypt.vendor.bert import BERTDecoder, BERTEncoder, FastBERTDecoder, FastBERTEncoder
+from tests.test_bert import revision_info
+
+
+def measure(name, fn, count):
+    start = time.perf_counter()
+    result = fn()
+    duration = time.perf_counter() - start
+    print('{0:<16} {1:>8.3f}s {2:>10.0f} messages/s'.format(name, duration, count / duration))
+    return result
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    messages = [(Atom('ok'), Atom('revision'), str(i).encode(), revision_info())
+                for i in range(count)] + [(Atom('ok'),)] * count
+
+    for prefix, encoder, decoder in (('erlastic', BERTEncoder(), BERTDecoder()),
+                                     ('fast', FastBERTEncoder(), FastBERTDecoder())):
+        packets = measure(prefix + ' encode', lambda: [encoder.encode(m) for m in messages],
+                          len(messages))
+        measure(prefix + ' decode', lambda: [decoder.decode(p) for p in packets], len(messages))
@@ -0,0 +1,49 @@
+'''
+Measure the throughput of the content defined chunker used for delta uploads, with numpy (if it
+is installed) and with the pure Python scan. Usage: python -m tests.bench_chunker [megabytes]
+'''
+import os
+import sys
+import time
+
+from syncrypt.utils import chunker
+from syncrypt.utils.chunker import ContentDefinedChunker
+
+AVG_SIZE = 64 * 1024
+FEED_SIZE = 1024 * 1024
+
+
+def split(data):
+    cdc = ContentDefinedChunker(AVG_SIZE)
+    chunks = []
+    for offset in range(0, len(data), FEED_SIZE):
+        chunks.extend(cdc.feed(data[offset:offset + FEED_SIZE]))
+    chunks.extend(cdc.finish())
+    return chunks
+
+
+def measure(name, fn, size):
+    start = time.perf_counter()
+    result = fn()
+    duration = time.perf_counter() - start
+    print('{0:<16} {1:>8.3f}s {2:>10.1f} MB/s'.format(name, duration, size / duration / 1e6))
+    return result
+
+
+if __name__ == '__main__':
+    size = int(sys.argv[1] if len(sys.argv) > 1 else 32) * 1024 * 1024
+    data = os.urandom(size)
+
+    if chunker.numpy is not None:
+        vectorized = measure('numpy', lambda: split(data), size)
+    else:
+        vectorized = None
+        print('numpy is not installed')
+    numpy = chunker.numpy
+    chunker.numpy = None # type: ignore
+    try:
+        pure = measure('pure python', lambda: split(data), size)
+    finally:
+        chunker.numpy = numpy
+    assert vectorized is None or vectorized == pure
+    print('{0} chunks of {1} bytes on average'.format(len(pure), size // len(pure)))
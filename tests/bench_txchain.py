@@ -0,0 +1,67 @@
+'''
+Compare encoding and decoding throughput of the txchain record format with the pickled
+revisions that older versions stored. Usage: python -m tests.bench_txchain [count]
+'''
+import io
+import os
+import pickle
+import sys
+import time
+from datetime import datetime
+from uuid import uuid4
+
+from syncrypt.backends.txchain import MAGIC, RECORD_HEADER, decode_revision, encode_revision
+from syncrypt.models import Revision, RevisionOp
+
+
+def make_revision():
+    revision = Revision(operation=RevisionOp.Upload)
+    revision.revision_id = str(uuid4())
+    revision.parent_id = str(uuid4())
+    revision.vault_id = str(uuid4())
+    revision.created_at = datetime.utcnow()
+    revision.user_fingerprint = os.urandom(8).hex()
+    revision.signature = os.urandom(512)
+    revision.file_hash = os.urandom(32).hex()
+    revision.crypt_hash = os.urandom(32).hex()
+    revision.revision_metadata = os.urandom(512)
+    revision.file_size_crypt = 123456
+    return revision
+
+
+def measure(name, fn, count):
+    start = time.perf_counter()
+    result = fn()
+    duration = time.perf_counter() - start
+    print('{0:<16} {1:>8.3f}s {2:>10.0f} revisions/s'.format(name, duration, count / duration))
+    return result
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    revisions = [make_revision() for _ in range(count)]
+
+    pickled = measure('pickle encode', lambda: b''.join(pickle.dumps(r) for r in revisions),
+                      count)
+    records = measure('record encode',
+                      lambda: MAGIC + b''.join(encode_revision(r) for r in revisions), count)
+
+    def unpickle_stream():
+        stream = io.BytesIO(pickled)
+        try:
+            while True:
+                pickle.load(stream)
+        except EOFError:
+            pass
+
+    def decode_all():
+        offset = len(MAGIC)
+        while offset < len(records):
+            length, _ = RECORD_HEADER.unpack_from(records, offset)
+            offset += RECORD_HEADER.size
+            decode_revision(records[offset:offset + length])
+            offset += length
+
+    measure('pickle decode', unpickle_stream, count)
+    measure('record decode', decode_all, count)
+    print('pickle size: {0} bytes, record size: {1} bytes'.format(len(pickled), len(records)))
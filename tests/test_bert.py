@@ -0,0 +1,55 @@
+import os
+from datetime import datetime
+
+import pytest
+from erlastic import Atom
+
+from syncrypt.vendor.bert import BERTDecoder, BERTEncoder, FastBERTDecoder, FastBERTEncoder
+
+
+def revision_info():
+    return {
+        Atom('id'): os.urandom(16).hex().encode(),
+        Atom('operation'): b'store',
+        Atom('file_hash'): os.urandom(32).hex().encode(),
+        Atom('content_hash'): None,
+        Atom('user_key_fingerprint'): os.urandom(8).hex().encode(),
+        Atom('signature'): os.urandom(512),
+        Atom('metadata'): os.urandom(300),
+        Atom('size'): 123456789,
+        Atom('created_at'): b'2019-03-01T12:00:00Z',
+        Atom('user_public_key'): os.urandom(270),
+    }
+
+
+TERMS = [
+    (Atom('ok'),),
+    (Atom('ok'), b''),
+    (Atom('error'), Atom('not_found')),
+    (Atom('error'), b'Something went wrong', 500),
+    (Atom('ok'), os.urandom(70000)),
+    (Atom('ok'), [revision_info() for _ in range(3)]),
+    (Atom('ok'), Atom('revision'), b'42', revision_info()),
+    (Atom('changes'), b'vault', None, True, False, [], {}),
+    (Atom('ok'), [0, 255, 256, -1, 2 ** 31 - 1, -2 ** 31, 2 ** 31, -2 ** 64, 7 ** 700]),
+    (Atom('ok'), 1.5, -0.1, 'unicode ✓', datetime(2019, 3, 1, 12, 0, 0, 5)),
+    tuple(range(300)),
+]
+
+
+@pytest.mark.parametrize('term', TERMS)
+def test_fast_codec_is_wire_compatible(term):
+    packet = BERTEncoder().encode(term)
+    assert FastBERTEncoder().encode(term) == packet
+    decoded = BERTDecoder().decode(packet)
+    assert FastBERTDecoder().decode(packet) == decoded
+    assert FastBERTDecoder().decode(memoryview(packet)) == decoded
+
+
+def test_fast_codec_interns_atoms():
+    decoder = FastBERTDecoder()
+    packet = FastBERTEncoder().encode([(Atom('ok'), Atom('ok'))] * 2)
+    first, second = decoder.decode(packet)
+    assert type(first[0]) is Atom
+    assert first[0] is second[1]
+    assert decoder.decode(FastBERTEncoder().encode(True)) is True
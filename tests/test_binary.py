@@ -0,0 +1,357 @@
+import math
+import struct
+from types import SimpleNamespace
+from typing import Optional, Tuple
+
+import pytest
+import trio
+from erlastic import Atom
+
+from syncrypt.backends.binary import BinaryStorageConnection, BinaryStorageManager, FrameReader
+from syncrypt.exceptions import ConnectionPoolTimeout, ConnectionResetException
+from syncrypt.vendor import bert
+
+OK = Atom('ok')
+
+
+class StandInServer:
+    '''
+    A minimal stand-in for the storage server that answers a few commands. Like the real
+    server, it handles the commands of a connection in order. Every response is delayed by
+    latency seconds to simulate a slow link.
+    '''
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.port = None # type: Optional[int]
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def respond(self, term):
+        command = term[0]
+        if command in ('hello', 'auth', 'login'):
+            return (OK,)
+        elif command == 'vault_login':
+            return (OK, b'token-' + term[-1])
+        elif command == 'vault_size':
+            return (OK, int(term[1].split(b'-')[1]))
+        elif command == 'get_user_vault_key':
+            return (OK, {Atom('encrypted_content'): b'key-' + term[2]})
+        elif command == 'user_info':
+            return (OK, {Atom('email'): b'user@localhost'})
+        return (Atom('error'), Atom('unknown_command'))
+
+    async def serve(self, stream):
+        responses_in, responses_out = trio.open_memory_channel(math.inf) # type: Tuple[trio.abc.SendChannel, trio.abc.ReceiveChannel]
+        async with stream, trio.open_nursery() as nursery:
+            await self.send_term(stream, (OK, b'stand-in'))
+            nursery.start_soon(self.send_responses, stream, responses_out)
+            buf = b''
+            while True:
+                data = await stream.receive_some(65536)
+                if not data:
+                    break
+                buf += data
+                while len(buf) >= 4:
+                    length, = struct.unpack('!I', buf[:4])
+                    if len(buf) < 4 + length:
+                        break
+                    term = bert.decode(buf[4:4 + length])
+                    buf = buf[4 + length:]
+                    if term[0] == 'disconnect':
+                        break
+                    self.in_flight += 1
+                    self.max_in_flight = max(self.max_in_flight, self.in_flight)
+                    await responses_in.send((trio.current_time() + self.latency,
+                                             self.respond(term)))
+            nursery.cancel_scope.cancel()
+
+    async def send_responses(self, stream, responses):
+        async for due, response in responses:
+            await trio.sleep_until(due)
+            self.in_flight -= 1
+            await self.send_term(stream, response)
+
+    async def send_term(self, stream, term):
+        packet = bert.encode(term)
+        await stream.send_all(struct.pack('!I', len(packet)) + packet)
+
+
+@pytest.fixture
+async def stand_in_server(nursery):
+    server = StandInServer(latency=0.05)
+    listeners = await nursery.start(trio.serve_tcp, server.serve, 0)
+    server.port = listeners[0].socket.getsockname()[1]
+    return server
+
+
+def server_manager(server, pipelining):
+    manager = BinaryStorageManager()
+    manager.host = '127.0.0.1'
+    manager.port = server.port
+    manager.ssl = False
+    manager.global_auth = 'token'
+    manager.concurrency = 1
+    manager.pipelining = pipelining
+    return manager
+
+
+def connected_manager(concurrency):
+    'return a manager whose slots are connected without talking to a server'
+    manager = BinaryStorageManager()
+    manager.concurrency = concurrency
+    for _ in range(concurrency):
+        conn = BinaryStorageConnection(manager)
+        conn.connected = True
+        conn.available = True
+        manager.slots.append(conn)
+    return manager
+
+
+async def test_pool_fifo_handover(autojump_clock):
+    manager = connected_manager(2)
+    first = await manager.acquire_connection(None)
+    second = await manager.acquire_connection(None)
+    assert first is not second
+    assert manager.get_stats()['busy'] == 2
+
+    order = []
+
+    async def waiter(name):
+        conn = await manager.acquire_connection(None)
+        order.append(name)
+        await trio.sleep(1)
+        await manager.release_connection(conn)
+
+    async with trio.open_nursery() as nursery:
+        for name in range(5):
+            nursery.start_soon(waiter, name)
+            await trio.sleep(0.1)
+        assert manager.get_wait_stats()['waiting'] == 5
+        await manager.release_connection(first)
+        await trio.sleep(0.1)
+        await manager.release_connection(second)
+
+    assert order == [0, 1, 2, 3, 4]
+    stats = manager.get_wait_stats()
+    assert stats['waiting'] == 0
+    assert stats['waited'] == 5
+    assert stats['timeouts'] == 0
+    assert 0 < stats['wait_time_max'] < 5
+    assert manager.get_stats()['idle'] == 2
+
+
+async def test_pool_timeout(autojump_clock):
+    manager = connected_manager(1)
+    conn = await manager.acquire_connection(None)
+
+    with pytest.raises(ConnectionPoolTimeout):
+        await manager.acquire_connection(None, timeout=5)
+
+    stats = manager.get_wait_stats()
+    assert stats['timeouts'] == 1
+    assert stats['waiting'] == 0
+
+    await manager.release_connection(conn)
+    assert (await manager.acquire_connection(None, timeout=5)) is conn
+
+
+async def test_pool_cancelled_waiter(autojump_clock):
+    manager = connected_manager(1)
+    conn = await manager.acquire_connection(None)
+
+    with trio.move_on_after(1):
+        await manager.acquire_connection(None)
+    assert manager.get_wait_stats()['waiting'] == 0
+
+    await manager.release_connection(conn)
+    assert conn.available
+
+
+async def test_pool_maintenance(autojump_clock):
+    manager = connected_manager(3)
+    manager.idle_timeout = 300
+    manager.keepalive_interval = 60
+    manager.min_connections = 1
+
+    pings = []
+    for conn in manager.slots:
+        async def ping(conn=conn):
+            pings.append(conn)
+        async def disconnect(conn=conn):
+            await conn.clear_connection()
+        conn.ping = ping
+        conn.disconnect = disconnect
+        conn.last_used = trio.current_time()
+
+    # The first connection has just been used, the others have been idle for a while
+    await trio.sleep(100)
+    manager.slots[0].last_used = trio.current_time()
+    await manager.maintain_connections()
+    assert pings == manager.slots[1:]
+    assert manager.get_stats()['idle'] == 3
+
+    # Keepalives do not count as usage
+    await trio.sleep(250)
+    await manager.maintain_connections()
+    assert manager.get_stats()['idle'] == 1
+    assert manager.get_stats()['closed'] == 2
+    assert manager.slots[0].connected
+
+    # The last connection is kept open
+    await trio.sleep(1000)
+    await manager.maintain_connections()
+    assert manager.get_stats()['idle'] == 1
+
+
+async def test_pool_keepalive_failure(autojump_clock):
+    manager = connected_manager(1)
+
+    async def ping():
+        raise ConnectionResetError()
+    manager.slots[0].ping = ping
+
+    conn = await manager.acquire_connection(None)
+    await manager.release_connection(conn)
+    await trio.sleep(manager.keepalive_interval)
+    await manager.maintain_connections()
+    assert manager.get_stats()['closed'] == 1
+
+
+async def query_vault_sizes(manager, count):
+    sizes = {}
+
+    async def query(i):
+        conn = await manager.acquire_connection(None, shared=True)
+        try:
+            sizes[i] = await conn.vault_size(SimpleNamespace(config=SimpleNamespace(id='v-%d' % i)))
+        finally:
+            await manager.release_connection(conn)
+
+    async with trio.open_nursery() as nursery:
+        for i in range(count):
+            nursery.start_soon(query, i)
+    return sizes
+
+
+async def test_pipelined_requests(stand_in_server):
+    manager = server_manager(stand_in_server, pipelining=True)
+    started = trio.current_time()
+    sizes = await query_vault_sizes(manager, 16)
+    duration = trio.current_time() - started
+
+    # Every response has been matched to its request
+    assert sizes == {i: i for i in range(16)}
+    assert len(manager.slots) == 1
+    assert stand_in_server.max_in_flight == manager.pipeline_depth
+    # Two batches of 8 requests, plus the round trips to log in
+    assert duration < 8 * stand_in_server.latency
+    assert manager.slots[0].available
+    await manager.close()
+
+
+async def test_requests_without_pipelining(stand_in_server):
+    manager = server_manager(stand_in_server, pipelining=False)
+    sizes = await query_vault_sizes(manager, 4)
+    assert sizes == {i: i for i in range(4)}
+    assert stand_in_server.max_in_flight == 1
+    await manager.close()
+
+
+async def test_pipelined_user_vault_key(stand_in_server):
+    manager = server_manager(stand_in_server, pipelining=True)
+    conn = await manager.acquire_connection(None)
+    auth_token, key = await conn.get_user_vault_key('aabbcc', 'v-1')
+    assert auth_token == 'token-v-1'
+    assert key == b'key-v-1'
+    assert stand_in_server.max_in_flight == 2
+    await manager.release_connection(conn)
+    await manager.close()
+
+
+async def test_shared_connection_switching_vault(stand_in_server):
+    manager = server_manager(stand_in_server, pipelining=True)
+    vault_a, vault_b = [SimpleNamespace(config=SimpleNamespace(id=vault_id, get=lambda key: 'token'))
+                        for vault_id in ('v-1', 'v-2')]
+    conn = await manager.acquire_connection(vault_a)
+    await manager.release_connection(conn)
+
+    # A task that shares the connection must not send its commands while the connection is
+    # still logging in to the other vault
+    sizes = []
+
+    async def query():
+        conn = await manager.acquire_connection(vault_b, shared=True)
+        try:
+            sizes.append(await conn.vault_size(vault_b))
+        finally:
+            await manager.release_connection(conn)
+
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(query)
+        nursery.start_soon(query)
+    assert sizes == [2, 2]
+    assert len(manager.slots) == 1
+    assert manager.slots[0].vault is vault_b
+    assert manager.slots[0].available
+    await manager.close()
+
+
+class ChunkedStream:
+    'A receive stream that returns the given data in chunks of at most chunk_size bytes'
+
+    def __init__(self, data, chunk_size):
+        self.data = data
+        self.chunk_size = chunk_size
+        self.calls = 0
+
+    async def receive_some(self, max_bytes=None):
+        self.calls += 1
+        size = self.chunk_size if max_bytes is None else min(max_bytes, self.chunk_size)
+        chunk = self.data[:size]
+        self.data = self.data[len(chunk):]
+        return chunk
+
+    async def aclose(self):
+        self.data = b''
+
+
+def frame(term):
+    packet = bert.encode(term)
+    return struct.pack('!I', len(packet)) + packet
+
+
+async def test_frame_reader():
+    terms = [(OK, i, b'x' * (i % 7)) for i in range(1000)]
+    data = b''.join(frame(term) for term in terms)
+
+    # Many frames are parsed from the data of one receive_some
+    stream = ChunkedStream(data, 65536)
+    reader = FrameReader(stream, buffer_size=4096)
+    for term in terms:
+        assert bert.decode(await reader.read_frame()) == term
+    assert stream.calls < len(data) // 4096 + 10
+
+    # Short reads, even within the length of a frame
+    reader = FrameReader(ChunkedStream(data[:1000], 3), buffer_size=16)
+    decoded = []
+    with pytest.raises(ConnectionResetException):
+        while True:
+            decoded.append(bert.decode(await reader.read_frame()))
+    assert decoded == terms[:len(decoded)]
+    assert len(decoded) > 10
+
+
+async def test_frame_reader_large_frame_and_raw_data():
+    large = (OK, b'y' * 100000)
+    contents = bytes(range(256)) * 10
+    reader = FrameReader(ChunkedStream(frame((OK,)) + frame(large) + contents, 30000),
+                         buffer_size=1024)
+    assert bert.decode(await reader.read_frame()) == (OK,)
+    assert bert.decode(await reader.read_frame()) == large
+
+    # Raw data that follows a frame might already be in the buffer
+    received = b''
+    while len(received) < len(contents):
+        received += await reader.receive_some(1000)
+    assert received == contents
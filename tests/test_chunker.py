@@ -0,0 +1,36 @@
+import os
+
+import pytest
+
+from syncrypt.utils import chunker
+from syncrypt.utils.chunker import ContentDefinedChunker
+
+
+def split(data, avg_size, feed_size):
+    cdc = ContentDefinedChunker(avg_size)
+    chunks = []
+    for offset in range(0, len(data), feed_size):
+        chunks.extend(cdc.feed(data[offset:offset + feed_size]))
+    chunks.extend(cdc.finish())
+    return chunks
+
+
+def test_chunks_survive_insertion(monkeypatch):
+    monkeypatch.setattr(chunker, "numpy", None)
+    data = os.urandom(256 * 1024)
+    chunks = split(data, 4096, 10000)
+    assert b"".join(chunks) == data
+    assert all(len(chunk) <= 4 * 4096 for chunk in chunks)
+
+    changed = split(data[:1000] + b"inserted" + data[1000:], 4096, 10000)
+    assert len(set(chunks) - set(changed)) <= 2
+
+
+@pytest.mark.parametrize("feed_size", [1000, 50000, 1024 * 1024])
+def test_vectorized_chunks_match(monkeypatch, feed_size):
+    pytest.importorskip("numpy")
+    # Random data as well as data with few cut points, so that chunks end at max_size
+    data = os.urandom(512 * 1024) + b"ab" * (64 * 1024) + os.urandom(64 * 1024)
+    vectorized = split(data, 4096, feed_size)
+    monkeypatch.setattr(chunker, "numpy", None)
+    assert vectorized == split(data, 4096, feed_size)
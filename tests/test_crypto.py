@@ -3,10 +3,13 @@ import os.path
 import shutil
 import unittest
 
+import pytest
+
+from syncrypt.exceptions import InvalidBundleContents
 from syncrypt.managers import BundleManager
-from syncrypt.pipes import (Buffered, Count, DecryptRSA, DecryptRSA_PKCS1_OAEP, EncryptRSA,
-                            EncryptRSA_PKCS1_OAEP, FileReader, Limit, Once, Repeat, SnappyCompress,
-                            SnappyDecompress, StreamReader)
+from syncrypt.pipes import (Buffered, ChunkedGCM, Count, DecryptRSA, DecryptRSA_PKCS1_OAEP,
+                            EncryptRSA, EncryptRSA_PKCS1_OAEP, FileReader, Limit, Once, Repeat,
+                            SnappyCompress, SnappyDecompress, StreamReader)
 
 from .base import *
 
@@ -37,3 +40,49 @@ async def test_rsa_pipe_pkcs1_oaep(local_vault, local_app):
             >> DecryptRSA_PKCS1_OAEP(bundle.vault.identity.private_key)
         output = await pipe.readall()
         assert input == output
+
+
+async def test_aes_single_pass_spool(local_vault, local_app):
+    bundle = BundleManager(local_app).get_bundle_for_relpath('random250k', local_vault)
+    await bundle.update()
+    crypt_engine = local_vault.crypt_engine
+
+    crypt_hash, file_size_crypt = await crypt_engine.get_crypt_hash_and_size(bundle)
+    spooled_hash, spooled_size, reader = await crypt_engine.spool_encrypted_stream(bundle)
+
+    assert crypt_hash == bundle.local_hash == spooled_hash
+    assert file_size_crypt == spooled_size
+    assert len(await reader.readall()) == spooled_size
+
+
+async def test_aes_gcm_engine(local_vault, local_app, working_dir):
+    with local_vault.config.update_context():
+        local_vault.config.set("vault.crypt_engine", "aes_gcm")
+        local_vault.config.set("vault.crypt_chunk_size", str(64 * 1024))
+    crypt_engine = local_vault.crypt_engine
+    assert type(crypt_engine).__name__ == 'AESGCMEngine'
+
+    bundle = BundleManager(local_app).get_bundle_for_relpath('random250k', local_vault)
+    await bundle.update()
+    crypt_hash, file_size_crypt = await crypt_engine.get_crypt_hash_and_size(bundle)
+    spooled_hash, spooled_size, reader = await crypt_engine.spool_encrypted_stream(bundle)
+    assert crypt_hash == bundle.local_hash == spooled_hash
+    assert file_size_crypt == spooled_size
+
+    ciphertext = await reader.readall()
+    assert len(ciphertext) == spooled_size
+    encrypted_path = os.path.join(working_dir, 'random250k.gcm')
+    with open(encrypted_path, 'wb') as encrypted:
+        encrypted.write(ciphertext)
+
+    with open(bundle.path, 'rb') as original:
+        plaintext = original.read()
+    for offset, length in ((0, 10), (65530, 100), (200000, 100000), (len(plaintext), 10)):
+        assert await crypt_engine.read_range(bundle.key, encrypted_path, offset, length) == \
+                plaintext[offset:offset + length]
+
+    # Cutting off the last chunk is detected
+    with open(encrypted_path, 'wb') as encrypted:
+        encrypted.write(ciphertext[:ChunkedGCM.header.size + 2 * (64 * 1024 + 16)])
+    with pytest.raises(InvalidBundleContents):
+        await crypt_engine.read_range(bundle.key, encrypted_path, 70000, 10)
@@ -1,21 +1,31 @@
 import logging
 import os
 import os.path
+import pickle
 import shutil
+import struct
 import sys
+import threading
 import unittest
 from glob import glob
+from typing import AsyncIterator, List
 
 import pytest
 import trio
 
+from syncrypt.api.resources import VaultResource
 from syncrypt.app import SyncryptApp
 from syncrypt.backends import LocalStorageBackend
-from syncrypt.exceptions import AlreadyPresent, InvalidRevision, VaultFolderDoesNotExist
+from syncrypt.backends.txchain import TxChain
+from syncrypt.exceptions import (AlreadyPresent, InvalidRevision, SyncRequired,
+                                 VaultFolderDoesNotExist)
 from syncrypt.managers import UserVaultKeyManager
-from syncrypt.models import Bundle, Identity, Revision, RevisionOp, Vault, VaultState, store
+from syncrypt.models import (Bundle, Identity, Revision, RevisionOp, Store, Vault, VaultState,
+                             store)
+from syncrypt.utils.limiter import ByteLimiter
 
-from .base import assertSameFilesInFolder, local_app, local_vault, test_vault, working_dir
+from .base import (TestAppConfig, assertSameFilesInFolder, clone_vault, local_app, local_vault,
+                   test_vault, working_dir)
 
 
 def generate_fake_revision(vault):
@@ -353,3 +363,726 @@ async def test_add_user_twice(local_app, local_vault):
 
     users = app.vault_users.list_for_vault(local_vault)
     assert len(users) == 2
+
+
+async def test_concurrent_push(local_app, local_vault):
+    app = local_app
+    await app.initialize()
+    await app.open_or_init(local_vault)
+    await app.push()
+
+    for i in range(20):
+        with open(os.path.join(local_vault.folder, "small-%d.txt" % i), "wb") as f:
+            f.write(os.urandom(100 + i))
+
+    with local_vault.config.update_context():
+        local_vault.config.set("vault.upload_concurrency", "5")
+
+    prev_rev_count = local_vault.revision_count
+    await app.push()
+    assert local_vault.revision_count == prev_rev_count + 20
+
+    # Revisions still form a single chain
+    revisions = [rev async for rev in local_vault.backend.changes(None, None)]
+    for parent, child in zip(revisions, revisions[1:]):
+        assert child.parent_id == parent.revision_id
+
+
+async def test_contents_are_stored_concurrently(local_app, local_vault, monkeypatch):
+    app = local_app
+    await app.initialize()
+    await app.open_or_init(local_vault)
+    await app.push()
+
+    for i in range(5):
+        with open(os.path.join(local_vault.folder, "small-%d.txt" % i), "wb") as f:
+            f.write(os.urandom(100 + i))
+
+    with local_vault.config.update_context():
+        local_vault.config.set("vault.upload_concurrency", "5")
+
+    store_contents = local_vault.backend.store_contents
+    storing = []
+    max_storing = 0
+
+    async def slow_store_contents(bundle):
+        nonlocal max_storing
+        storing.append(bundle)
+        max_storing = max(max_storing, len(storing))
+        await trio.sleep(0.1)
+        await store_contents(bundle)
+        storing.remove(bundle)
+
+    monkeypatch.setattr(local_vault.backend, "store_contents", slow_store_contents)
+
+    prev_rev_count = local_vault.revision_count
+    await app.push()
+    assert local_vault.revision_count == prev_rev_count + 5
+
+    # The contents have been transferred in parallel, the revisions still form a chain
+    assert max_storing > 1
+    revisions = [rev async for rev in local_vault.backend.changes(None, None)]
+    for parent, child in zip(revisions, revisions[1:]):
+        assert child.parent_id == parent.revision_id
+
+
+async def test_concurrent_push_of_modified_files(local_app, local_vault):
+    app = local_app
+    await app.initialize()
+    await app.open_or_init(local_vault)
+    await app.push()
+
+    # Files that have been uploaded before are pushed concurrently as well
+    filenames = ["README.md", "hello.txt", "random12k"]
+    for filename in filenames:
+        with open(os.path.join(local_vault.folder, filename), "ab") as f:
+            f.write(b"modified")
+
+    prev_rev_count = local_vault.revision_count
+    await app.push()
+    assert local_vault.state == VaultState.READY
+    assert local_vault.revision_count == prev_rev_count + len(filenames)
+
+
+async def test_push_bundle_syncs_on_sync_required(local_app, local_vault, monkeypatch):
+    app = local_app
+    await app.initialize()
+    await app.open_or_init(local_vault)
+    await app.push()
+
+    with open(os.path.join(local_vault.folder, "hello.txt"), "a") as f:
+        f.write("changed")
+
+    bundles = [b async for b in app.bundles.upload_bundles_for_vault(local_vault)]
+    assert [b.relpath for b in bundles] == ["hello.txt"]
+    bundle = bundles[0]
+    await bundle.update()
+
+    upload = local_vault.backend.upload
+    sync_vault = app.sync_vault
+    uploads = []
+    syncs = []
+
+    async def outdated_upload(bundle, identity):
+        uploads.append(bundle)
+        if len(uploads) == 1:
+            raise SyncRequired()
+        return await upload(bundle, identity)
+
+    async def recording_sync_vault(vault, full=False):
+        # The upload is retried while the revision lock is held
+        assert local_vault.revision_lock.locked()
+        syncs.append(vault)
+        await sync_vault(vault, full)
+
+    monkeypatch.setattr(local_vault.backend, "upload", outdated_upload)
+    monkeypatch.setattr(app, "sync_vault", recording_sync_vault)
+
+    prev_rev_count = local_vault.revision_count
+    await app.push_bundle(bundle)
+
+    assert len(uploads) == 2
+    assert syncs == [local_vault]
+    assert local_vault.revision_count == prev_rev_count + 1
+    assert not local_vault.revision_lock.locked()
+
+
+async def test_failed_upload_removes_spool(local_app, local_vault, monkeypatch):
+    app = local_app
+    await app.initialize()
+    await app.open_or_init(local_vault)
+
+    bundles = [b async for b in app.bundles.upload_bundles_for_vault(local_vault)]
+    bundle = next(b for b in bundles if b.relpath == "random250k")
+    await bundle.update()
+    assert bundle.upload_spool_size == bundle.local_size > 0
+
+    prepared = []
+    spooled = []
+    prepare_upload = bundle.prepare_upload
+
+    async def recording_prepare_upload():
+        await prepare_upload()
+        prepared.append(bundle._upload_reader)
+
+    async def failing_upload(bundle, identity):
+        spooled.append(app.spool_bytes.bytes_in_flight)
+        raise IOError("Simulated upload failure")
+
+    monkeypatch.setattr(bundle, "prepare_upload", recording_prepare_upload)
+    monkeypatch.setattr(local_vault.backend, "upload", failing_upload)
+
+    with pytest.raises(IOError):
+        await app.push_bundle(bundle)
+
+    # The spool was accounted for while uploading and has been closed afterwards
+    assert spooled == [bundle.local_size]
+    assert app.spool_bytes.bytes_in_flight == 0
+    assert len(prepared) == 1 and prepared[0].handle is None
+
+
+async def test_pull_reports_failed_bundles(local_app, local_vault, working_dir, monkeypatch):
+    app = local_app
+    await app.initialize()
+    await app.open_or_init(local_vault)
+    await app.push()  # init all vaults
+
+    other_vault = await clone_vault(app, local_vault, working_dir)
+
+    download = other_vault.backend.download
+
+    async def failing_download(bundle):
+        if bundle.relpath == "hello.txt":
+            raise IOError("Simulated download failure")
+        await download(bundle)
+
+    monkeypatch.setattr(other_vault.backend, "download", failing_download)
+
+    await app.pull_vault(other_vault)
+
+    # All other bundles have been downloaded despite the failure
+    assert other_vault.state == VaultState.FAILURE
+    assert not os.path.exists(os.path.join(other_vault.folder, "hello.txt"))
+    assert len(glob(os.path.join(other_vault.folder, "*"))) == 7
+
+
+@pytest.mark.skipif(not hasattr(os, "posix_fallocate"), reason="requires posix_fallocate")
+async def test_pull_preallocates_files(local_app, local_vault, working_dir, monkeypatch):
+    app = local_app
+    await app.initialize()
+    await app.open_or_init(local_vault)
+    await app.push()
+
+    other_vault = await clone_vault(app, local_vault, working_dir)
+
+    posix_fallocate = os.posix_fallocate
+    preallocated = []
+
+    def recording_posix_fallocate(fd, offset, length):
+        preallocated.append(length)
+        posix_fallocate(fd, offset, length)
+
+    monkeypatch.setattr(os, "posix_fallocate", recording_posix_fallocate)
+
+    await app.pull_vault(other_vault)
+
+    # Every file has been preallocated with the size from its metadata
+    sizes = [os.path.getsize(path) for path in glob(os.path.join(local_vault.folder, "**"),
+                                                    recursive=True) if os.path.isfile(path)]
+    assert sorted(preallocated) == sorted(size for size in sizes if size > 0)
+
+
+async def test_pull_download_budget(local_app, local_vault, working_dir, monkeypatch):
+    app = local_app
+    await app.initialize()
+    await app.open_or_init(local_vault)
+    await app.push()
+
+    # random250k and random200k do not fit into the budget together
+    budget = 300 * 1000
+    monkeypatch.setattr(app, "download_bytes", ByteLimiter(budget))
+
+    other_vault = await clone_vault(app, local_vault, working_dir)
+
+    download = other_vault.backend.download
+    downloading = {}
+    sizes = {}
+    max_in_flight = 0
+
+    async def slow_download(bundle):
+        nonlocal max_in_flight
+        sizes[bundle.relpath] = downloading[bundle.relpath] = bundle.file_size
+        max_in_flight = max(max_in_flight, sum(downloading.values()))
+        await trio.sleep(0.1)
+        await download(bundle)
+        del downloading[bundle.relpath]
+
+    monkeypatch.setattr(other_vault.backend, "download", slow_download)
+
+    await app.pull_vault(other_vault)
+
+    assert other_vault.state == VaultState.READY
+    # The budget is based on the file sizes from the metadata
+    assert sizes == {relpath: os.path.getsize(os.path.join(local_vault.folder, relpath))
+                     for relpath in sizes}
+    assert len(sizes) == 8
+    assert 256000 <= max_in_flight <= budget
+
+
+async def test_stat_index_skips_rehashing(local_app, local_vault):
+    app = local_app
+    await app.initialize()
+    await app.open_or_init(local_vault)
+    await app.push()
+
+    crypt_engine = local_vault.crypt_engine
+    get_crypt_hash = crypt_engine.get_crypt_hash
+    hashed = []
+
+    async def counting_get_crypt_hash(bundle):
+        hashed.append(bundle.relpath)
+        return await get_crypt_hash(bundle)
+
+    crypt_engine.get_crypt_hash = counting_get_crypt_hash
+
+    # Nothing changed, so nothing needs to be hashed or uploaded
+    bundles = [b async for b in app.bundles.upload_bundles_for_vault(local_vault)]
+    assert bundles == []
+    assert hashed == []
+
+    # Modify one file; it is only hashed while its upload is spooled
+    with open(os.path.join(local_vault.folder, "hello.txt"), "ab") as f:
+        f.write(b"more")
+    bundles = [b async for b in app.bundles.upload_bundles_for_vault(local_vault)]
+    assert [b.relpath for b in bundles] == ["hello.txt"]
+    assert hashed == []
+    revision_count = local_vault.revision_count
+    await app.push()
+    assert hashed == []
+    assert local_vault.revision_count == revision_count + 1
+
+    # Touch a file; it is spooled once, but not uploaded
+    os.utime(os.path.join(local_vault.folder, "README.md"))
+    await app.push()
+    assert local_vault.revision_count == revision_count + 1
+    bundles = [b async for b in app.bundles.upload_bundles_for_vault(local_vault)]
+    assert bundles == []
+    assert hashed == []
+
+
+async def test_stat_index_forgets_vanished_files(local_app, local_vault):
+    app = local_app
+    await app.initialize()
+    await app.open_or_init(local_vault)
+    await app.push()
+    assert "hello.txt" in app.bundles.get_stat_index(local_vault)
+
+    # Removed files
+    await app.remove_file(local_vault, os.path.join(local_vault.folder, "hello.txt"))
+    assert "hello.txt" not in app.bundles.get_stat_index(local_vault)
+
+    # Renamed files
+    os.rename(os.path.join(local_vault.folder, "random250k"),
+              os.path.join(local_vault.folder, "random250k.moved"))
+    await app.push()
+    index = app.bundles.get_stat_index(local_vault)
+    assert "random250k" not in index
+    assert "random250k.moved" in index
+
+    # Files that are deleted on disk
+    with open(os.path.join(local_vault.folder, "draft.txt"), "wb") as f:
+        f.write(b"draft")
+    await app.push()
+    assert "draft.txt" in app.bundles.get_stat_index(local_vault)
+    os.remove(os.path.join(local_vault.folder, "draft.txt"))
+    bundles = [b async for b in app.bundles.upload_bundles_for_vault(local_vault)]
+    assert "draft.txt" not in app.bundles.get_stat_index(local_vault)
+
+
+async def test_apply_many_in_groups(local_app, local_vault, working_dir):
+    app = local_app
+    await app.initialize()
+    await app.open_or_init(local_vault)
+    await app.push()
+    await app.add_vault_user(local_vault, 'ericb@localhost')
+
+    other_vault = await clone_vault(app, local_vault, working_dir, add=False)
+    other_vault.identity.read()
+
+    revisions = [rev async for rev in other_vault.backend.changes(None, None)]
+    await app.revisions.apply_many(revisions[:5], other_vault, batch_size=2)
+    assert other_vault.revision == revisions[4].revision_id
+
+    # Simulate a revision pointer that lags behind the store, like one that has been
+    # migrated from the vault config
+    other_vault.update_revision(revisions[2])
+    await app.revisions.apply_many(revisions[3:], other_vault, batch_size=3)
+
+    assert other_vault.revision == local_vault.revision
+    assert other_vault.revision_count == local_vault.revision_count
+    assert other_vault.file_count == local_vault.file_count
+    assert other_vault.user_count == local_vault.user_count == 2
+    assert len(app.revisions.list_for_vault(other_vault)) == len(revisions)
+
+
+async def test_apply_group_rollback(local_app, local_vault, working_dir):
+    app = local_app
+    await app.initialize()
+    await app.open_or_init(local_vault)
+    await app.push()
+    await app.add_vault_user(local_vault, 'ericb@localhost')
+
+    with local_vault.config.update_context():
+        local_vault.config.set("vault.name", "renamed")
+    revision = await local_vault.backend.set_vault_metadata(app.identity)
+    await app.revisions.apply(revision, local_vault)
+
+    other_vault = await clone_vault(app, local_vault, working_dir, add=False)
+    other_vault.identity.read()
+    with other_vault.config.update_context():
+        other_vault.config.set("vault.name", "original")
+
+    revisions = [rev async for rev in other_vault.backend.changes(None, None)]
+    assert revisions[-1].operation == RevisionOp.SetMetadata
+    forged = generate_fake_revision(local_vault)
+    forged.user_fingerprint = revisions[-1].user_fingerprint
+
+    # The metadata is not written, because the group is rolled back
+    with pytest.raises(InvalidRevision):
+        await app.revisions.apply_many(revisions + [forged], other_vault)
+    assert other_vault.revision is None
+    assert other_vault.remote_metadata is None
+    assert other_vault.config.get("vault.name") == "original"
+    assert app.user_vault_keys.list_for_vault(other_vault) == []
+
+    await app.revisions.apply_many(revisions, other_vault)
+    assert other_vault.revision == local_vault.revision
+    assert other_vault.config.get("vault.name") == "renamed"
+    assert len(app.user_vault_keys.list_for_vault(other_vault)) == \
+            len(app.user_vault_keys.list_for_vault(local_vault))
+
+
+async def test_apply_stream(local_app, local_vault, working_dir):
+    app = local_app
+    await app.initialize()
+    await app.open_or_init(local_vault)
+    await app.push()
+    await app.add_vault_user(local_vault, 'ericb@localhost')
+
+    other_vault = await clone_vault(app, local_vault, working_dir, add=False)
+    other_vault.identity.read()
+
+    revisions = [rev async for rev in other_vault.backend.changes(None, None)]
+    forged = generate_fake_revision(local_vault)
+    forged.user_fingerprint = revisions[-1].user_fingerprint
+
+    async def slow_changes(revisions: List[Revision]) -> AsyncIterator[Revision]:
+        for revision in revisions:
+            await trio.sleep(0.01)
+            yield revision
+
+    # The forged revision is signed with a known key, but its signature does not match
+    with pytest.raises(InvalidRevision):
+        await app.revisions.apply_stream(slow_changes(revisions + [forged]), other_vault,
+                                         lookahead=3)
+    assert forged.verified_key is None
+    assert other_vault.revision is None
+
+    revisions = [rev async for rev in other_vault.backend.changes(None, None)]
+    await app.revisions.apply_stream(slow_changes(revisions), other_vault, lookahead=3)
+
+    # All signatures have been verified and the metadata has been decrypted before the
+    # revisions were applied
+    assert all(revision.verified_key is not None for revision in revisions)
+    assert all(revision.decrypted_metadata is not None for revision in revisions
+               if revision.operation in (RevisionOp.Upload, RevisionOp.SetMetadata))
+    assert other_vault.revision == local_vault.revision
+    assert other_vault.file_count == local_vault.file_count
+    assert other_vault.user_count == local_vault.user_count == 2
+    assert len(app.revisions.list_for_vault(other_vault)) == len(revisions)
+
+    # The cached signer keys match the store, and so do the paths from the metadata
+    with store.session() as session:
+        relpaths = {vault.id: sorted(bundle.relpath for bundle in session.query(Bundle)
+                                     .filter(Bundle.vault_id == vault.id))
+                    for vault in (local_vault, other_vault)}
+        cached_keys = app.user_vault_keys.signer_keys(session, other_vault)
+    assert cached_keys == {key.fingerprint: (key.user_id, key.public_key)
+                           for key in app.user_vault_keys.list_for_vault(other_vault)}
+    assert relpaths[other_vault.id] == relpaths[local_vault.id]
+
+
+async def test_migrate_revision_from_config(local_app, local_vault, monkeypatch):
+    app = local_app
+    await app.initialize()
+    await app.open_or_init(local_vault)
+    await app.push()
+    revision_id = local_vault.revision
+    assert local_vault.config.get("vault.revision") is None
+
+    # Older versions stored the revision pointer in the vault config
+    with local_vault.config.update_context():
+        local_vault.config.set("vault.revision", revision_id)
+    await app.db_vaults.reset(local_vault)
+    assert local_vault.revision is None
+
+    # The pointer has to stay in the config if it could not be written to the store
+    make_session = store._session
+
+    def failing_session():
+        session = make_session()
+        def failing_commit():
+            raise IOError("Store is not writable")
+        session.commit = failing_commit
+        return session
+
+    monkeypatch.setattr(store, "_session", failing_session)
+    with pytest.raises(IOError):
+        await app.db_vaults.migrate_revision(local_vault)
+    assert local_vault.config.get("vault.revision") == revision_id
+    monkeypatch.setattr(store, "_session", make_session)
+
+    await app.db_vaults.migrate_revision(local_vault)
+    assert local_vault.revision == revision_id
+    assert local_vault.config.get("vault.revision") is None
+    with store.session() as session:
+        stored = session.query(Vault).filter(Vault.id == local_vault.id).one()
+        assert stored.revision == revision_id
+
+
+def test_store_reuses_sqlite_connections(tmpdir):
+    config = TestAppConfig(str(tmpdir.join("test_config")))
+    config.set("store.path", str(tmpdir.join("syncrypt.db")))
+    file_store = Store()
+    file_store.init(config)
+
+    # The connection and with it the configured page cache are kept between sessions
+    with file_store.session() as session:
+        connection = session.connection().connection.connection
+        assert session.execute("PRAGMA cache_size").scalar() == -16000
+    with file_store.session() as session:
+        assert session.connection().connection.connection is connection
+
+
+async def test_txchain_index(local_app, local_vault):
+    app = local_app
+    await app.initialize()
+    await app.open_or_init(local_vault)
+    await app.push()
+
+    backend = local_vault.backend
+    revisions = [rev async for rev in backend.changes(None, None)]
+    assert len(revisions) > 3
+
+    async def changes_since(revision):
+        return [rev.revision_id async for rev in backend.changes(revision.revision_id, None)]
+
+    expected = [rev.revision_id for rev in revisions[3:]]
+    assert await changes_since(revisions[2]) == expected
+
+    # The index will be rebuilt if it is missing...
+    os.remove(backend.txchain.index.path)
+    backend._txchain = None
+    assert await changes_since(revisions[2]) == expected
+    assert os.path.exists(backend.txchain.index.path)
+
+    # ...or does not cover the whole txchain
+    with open(backend.txchain.index.path) as index:
+        lines = index.readlines()
+    with open(backend.txchain.index.path, "w") as index:
+        index.writelines(lines[:-2])
+    backend._txchain = None
+    assert await changes_since(revisions[2]) == expected
+    assert await changes_since(revisions[-1]) == []
+
+
+async def test_txchain_index_rebuild_locks(local_app, local_vault):
+    app = local_app
+    await app.initialize()
+    await app.open_or_init(local_vault)
+    await app.push()
+
+    # Two TxChain objects on the same file behave like two daemons sharing the backend
+    writer = TxChain(local_vault.backend.txchain.path)
+    reader = TxChain(local_vault.backend.txchain.path)
+    head = writer.index.last_revision_id()
+    os.remove(reader.index.path)
+    result = []
+
+    with writer.lock():
+        thread = threading.Thread(target=lambda: result.append(reader.index.last_revision_id()))
+        thread.start()
+        thread.join(0.5)
+        # The index is not rebuilt while someone else holds the write lock
+        assert thread.is_alive()
+        assert not os.path.exists(reader.index.path)
+    thread.join()
+
+    assert result == [head]
+    assert os.path.exists(reader.index.path)
+
+
+async def test_txchain_torn_record(local_app, local_vault):
+    app = local_app
+    await app.initialize()
+    await app.open_or_init(local_vault)
+    await app.push()
+
+    backend = local_vault.backend
+    revisions = [rev async for rev in backend.changes(None, None)]
+
+    torn_records = [b"\x00\x00", struct.pack(">II", 1000, 0) + b"partial",
+                    struct.pack(">II", 7, 0) + b"garbage"]
+    for i, torn in enumerate(torn_records):
+        # A crash left part of a record at the end of the log
+        with open(backend.txchain.path, "ab") as txchain:
+            txchain.write(torn)
+        backend._txchain = None
+        assert len([rev async for rev in backend.changes(None, None)]) == len(revisions)
+
+        # The next revision is appended right after the last complete record
+        with open(os.path.join(local_vault.folder, "new-%d.txt" % i), "wb") as f:
+            f.write(torn)
+        await app.push()
+        assert local_vault.state == VaultState.READY
+        previous, revisions = revisions, [rev async for rev in backend.changes(None, None)]
+        assert len(revisions) == len(previous) + 1
+        assert revisions[-1].parent_id == previous[-1].revision_id
+
+
+async def test_txchain_upgrade_and_parent_check(local_app, local_vault):
+    app = local_app
+    await app.initialize()
+    await app.open_or_init(local_vault)
+    await app.push()
+
+    backend = local_vault.backend
+    revisions = [rev async for rev in backend.changes(None, None)]
+
+    # Write the chain in the pickle format of older versions
+    with open(backend.txchain.path, "wb") as txchain:
+        for rev in revisions:
+            pickle.dump(rev, txchain)
+    backend._txchain = None
+
+    upgraded = [rev async for rev in backend.changes(None, None)]
+    assert [rev.revision_id for rev in upgraded] == [rev.revision_id for rev in revisions]
+    assert [rev.signature for rev in upgraded] == [rev.signature for rev in revisions]
+    assert upgraded[-1].created_at == revisions[-1].created_at
+
+    # Revisions that are not based on the head of the chain are rejected
+    revision = generate_fake_revision(local_vault)
+    revision.parent_id = revisions[-2].revision_id
+    with pytest.raises(SyncRequired):
+        backend.add_revision(revision)
+
+
+async def test_sharded_object_layout(local_app, local_vault, working_dir):
+    app = local_app
+    await app.initialize()
+    await app.open_or_init(local_vault)
+    await app.push()
+
+    backend = local_vault.backend
+    bundle = await app.bundles.get_bundle(local_vault,
+            os.path.join(local_vault.folder, "hello.txt"))
+    object_path = backend.object_path(bundle.store_hash)
+    assert object_path == os.path.join(backend.path, bundle.store_hash[:2],
+                                       bundle.store_hash[2:4], bundle.store_hash)
+    assert os.path.isfile(object_path)
+    assert os.path.isfile(object_path + ".hash")
+    assert not os.path.exists(os.path.join(backend.path, bundle.store_hash))
+
+    # Move all objects back into the flat layout of older versions
+    for path in glob(os.path.join(backend.path, "??", "??", "*")):
+        os.rename(path, os.path.join(backend.path, os.path.basename(path)))
+    os.remove(os.path.join(backend.path, "layout"))
+
+    other_vault = await clone_vault(app, local_vault, working_dir)
+    await app.pull_vault(other_vault)
+
+    assert os.path.isfile(object_path)
+    assert not os.path.exists(os.path.join(backend.path, bundle.store_hash))
+    assertSameFilesInFolder(local_vault.folder, other_vault.folder)
+
+
+async def test_aes_gcm_push_and_pull(local_app, local_vault, working_dir):
+    with local_vault.config.update_context():
+        local_vault.config.set("vault.crypt_engine", "aes_gcm")
+        local_vault.config.set("vault.crypt_chunk_size", str(16 * 1024))
+
+    app = local_app
+    await app.initialize()
+    await app.open_or_init(local_vault)
+    await app.push()
+
+    other_vault = await clone_vault(app, local_vault, working_dir)
+    await app.pull_vault(other_vault)
+
+    assert type(other_vault.crypt_engine).__name__ == "AESGCMEngine"
+    assert other_vault.state == VaultState.READY
+    assertSameFilesInFolder(local_vault.folder, other_vault.folder)
+
+
+async def test_delta_upload(local_app, local_vault, working_dir):
+    with local_vault.config.update_context():
+        local_vault.config.set("vault.delta_sync", "1")
+        local_vault.config.set("vault.delta_min_size", str(100 * 1024))
+        local_vault.config.set("vault.delta_chunk_size", str(16 * 1024))
+
+    app = local_app
+    await app.initialize()
+    await app.open_or_init(local_vault)
+    await app.push()
+
+    backend = local_vault.backend
+    chunks = set(glob(os.path.join(backend.path, "chunks", "??", "??", "*")))
+    assert len(chunks) > 10
+
+    # Change a single byte in the middle of a large file
+    path = os.path.join(local_vault.folder, "random250k")
+    with open(path, "r+b") as changed:
+        changed.seek(120 * 1024)
+        byte = changed.read(1)
+        changed.seek(120 * 1024)
+        changed.write(bytes([byte[0] ^ 0xff]))
+    await app.push()
+
+    new_chunks = set(glob(os.path.join(backend.path, "chunks", "??", "??", "*"))) - chunks
+    assert 1 <= len(new_chunks) <= 2
+
+    other_vault = await clone_vault(app, local_vault, working_dir)
+    await app.pull_vault(other_vault)
+
+    assert other_vault.state == VaultState.READY
+    assertSameFilesInFolder(local_vault.folder, other_vault.folder)
+
+
+async def test_rename_detection(local_app, local_vault, working_dir):
+    app = local_app
+    await app.initialize()
+    await app.open_or_init(local_vault)
+    await app.push()
+    file_count = local_vault.file_count
+
+    # Move a file into a new folder
+    os.makedirs(os.path.join(local_vault.folder, "moved"))
+    os.rename(os.path.join(local_vault.folder, "random250k"),
+              os.path.join(local_vault.folder, "moved", "random250k"))
+    await app.push()
+
+    revisions = app.revisions.list_for_vault(local_vault)
+    assert [r.operation for r in revisions].count(RevisionOp.RenameFile) == 1
+    assert [r.operation for r in revisions].count(RevisionOp.Upload) == file_count
+    assert local_vault.file_count == file_count
+
+    other_vault = await clone_vault(app, local_vault, working_dir)
+    await app.pull_vault(other_vault)
+
+    assert other_vault.state == VaultState.READY
+    assert other_vault.file_count == file_count
+    assertSameFilesInFolder(local_vault.folder, other_vault.folder)
+
+
+async def test_vault_ready_after_initial_push(local_app, test_vault, monkeypatch):
+    app = local_app
+    pushed = []
+    push_vault = app.push_vault
+
+    async def tracked_push_vault(vault):
+        await push_vault(vault)
+        pushed.append(vault)
+    monkeypatch.setattr(app, 'push_vault', tracked_push_vault)
+
+    # Add the vault like the API does. init_vault sets the vault READY before the initial pull
+    # and push, but the API must not report it as ready until they are done.
+    await app.add_vault(test_vault, async_init=True, async_push=True)
+    resource = VaultResource(app)
+    with trio.fail_after(60):
+        while resource.dehydrate(test_vault)['state'] != VaultState.READY:
+            await trio.sleep(0.01)
+
+    assert pushed == [test_vault]
+    assert not app.vault_controllers[test_vault.id].starting
+    assert test_vault.file_count == 8
+    assert [bundle async for bundle in app.bundles.upload_bundles_for_vault(test_vault)] == []
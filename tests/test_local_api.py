@@ -91,8 +91,7 @@ async def test_api_init_vault_history(local_daemon_app, local_api_client, empty_
     vault_uri = resp['resource_uri']
 
     assert len(app.vaults) == 1 # one vault
-    while app.vaults[0].state in (VaultState.UNINITIALIZED, VaultState.SYNCING):
-        await trio.sleep(0.1)
+    await wait_for_vault(app)
 
     resp = await client.get('/v1/vault/')
     assert len(resp) == 1 # one vault
@@ -154,8 +153,7 @@ async def test_api_init_vault_remove_from_sync_and_re_add(local_daemon_app, loca
     vault_uri = resp['resource_uri']
 
     assert len(app.vaults) == 1 # one vault
-    while app.vaults[0].state in (VaultState.UNINITIALIZED, VaultState.SYNCING):
-        await trio.sleep(0.2)
+    await wait_for_vault(app, 0.2)
 
     resp = await client.get('/v1/vault/')
     assert len(resp) == 1 # one vault
@@ -178,8 +176,7 @@ async def test_api_init_vault_remove_from_sync_and_re_add(local_daemon_app, loca
     vault_uri = resp['resource_uri']
 
     assert len(app.vaults) == 1 # one vault
-    while app.vaults[0].state in (VaultState.UNINITIALIZED, VaultState.SYNCING):
-        await trio.sleep(0.2)
+    await wait_for_vault(app, 0.2)
 
     resp = await client.get('/v1/vault/')
     assert len(resp) == 1 # one vault
@@ -200,8 +197,7 @@ async def test_api_init_vault_remove_from_sync_and_re_add_same(local_daemon_app,
     vault_uri = resp['resource_uri']
 
     assert len(app.vaults) == 1 # one vault
-    while app.vaults[0].state in (VaultState.UNINITIALIZED, VaultState.SYNCING):
-        await trio.sleep(0.2)
+    await wait_for_vault(app, 0.2)
 
     resp = await client.get('/v1/vault/')
     assert len(resp) == 1 # one vault
@@ -221,8 +217,7 @@ async def test_api_init_vault_remove_from_sync_and_re_add_same(local_daemon_app,
     vault_uri = resp['resource_uri']
 
     assert len(app.vaults) == 1 # one vault
-    while app.vaults[0].state in (VaultState.UNINITIALIZED, VaultState.SYNCING):
-        await trio.sleep(0.2)
+    await wait_for_vault(app, 0.2)
 
     resp = await client.get('/v1/vault/')
     assert len(resp) == 1 # one vault
@@ -243,8 +238,7 @@ async def test_api_init_vault_fingerprints(local_daemon_app, local_api_client, e
     vault_uri = c['resource_uri']
 
     assert len(app.vaults) == 1 # one vault
-    while app.vaults[0].state in (VaultState.UNINITIALIZED, VaultState.SYNCING):
-        await trio.sleep(0.2)
+    await wait_for_vault(app, 0.2)
 
     c = await client.get('/v1/vault/')
     assert len(c) == 1 # one vault
@@ -282,8 +276,7 @@ async def test_api_watchdog(local_daemon_app, local_api_client, empty_vault):
     vault_uri = resp['resource_uri']
 
     assert len(app.vaults) == 1 # one vault
-    while app.vaults[0].state in (VaultState.UNINITIALIZED, VaultState.SYNCING):
-        await trio.sleep(0.1)
+    await wait_for_vault(app)
 
     resp = await client.get('/v1/vault/')
     assert len(resp) == 1 # one vault
@@ -304,8 +297,7 @@ async def test_api_watchdog(local_daemon_app, local_api_client, empty_vault):
     assert c['items'][0]['operation'] == "OP_CREATE_VAULT"
     assert c['items'][1]['operation'] == "OP_SET_METADATA"
 
-    while app.vaults[0].state in (VaultState.UNINITIALIZED, VaultState.SYNCING):
-        await trio.sleep(0.1)
+    await wait_for_vault(app)
 
     # Create a new file and do five fast-paced changes to it
     for i in range(3):
@@ -24,8 +24,7 @@ async def test_api_local_websockets_stream(local_daemon_app, empty_vault, local_
     vault_uri = c['resource_uri']
 
     assert len(app.vaults) == 1 # one vault
-    while app.vaults[0].state in (VaultState.UNINITIALIZED, VaultState.SYNCING):
-        await trio.sleep(0.2)
+    await wait_for_vault(app, 0.2)
     assert len(app.vaults) == 1 # one vault
 
     c = await client.get(vault_uri)
@@ -69,8 +68,7 @@ async def test_api_local_websockets_resync(
     vault_uri = c['resource_uri']
 
     assert len(app.vaults) == 1 # one vault
-    while app.vaults[0].state in (VaultState.UNINITIALIZED, VaultState.SYNCING):
-        await trio.sleep(0.2)
+    await wait_for_vault(app, 0.2)
     assert len(app.vaults) == 1 # one vault
 
     c = await client.get(vault_uri)
@@ -1,11 +1,16 @@
 import asyncio
+import hashlib
 import os
 import os.path
 import shutil
 import unittest
 
-from syncrypt.pipes import (Buffered, Count, FileReader, Limit, Once, Repeat, SnappyCompress,
-                            SnappyDecompress, StreamReader)
+import pytest
+
+from syncrypt.pipes import (Buffered, Count, DecryptAES, EncryptAES, FileReader, FileWriter, Hash,
+                            Limit, Once, PadAES, Repeat, SnappyCompress, SnappyDecompress,
+                            SpoolWriter, StreamReader, UnpadAES)
+from syncrypt.pipes.workers import set_worker_threads
 
 __all__ = ("PipesTests",)
 
@@ -49,6 +54,28 @@ async def test_buffered_2():
     contents = await buffered.read()
     assert contents == b""
 
+async def test_buffered_large_chunks():
+    stream = Once(bytes(range(256)) * 40)
+    buffered = stream >> Repeat(3) >> Buffered(1000)
+
+    contents = b""
+    while True:
+        buf = await buffered.read()
+        if len(buf) == 0:
+            break
+        assert len(buf) <= 1000
+        contents += buf
+
+    assert contents == bytes(range(256)) * 120
+
+async def test_buffered_head():
+    stream = Once(b"0123456789abcdef")
+    buffered = stream >> Repeat(3) >> Buffered(10, 4)
+
+    assert await buffered.read(4) == b"0123"
+    assert await buffered.read() == b"456789abcd"
+    assert await buffered.read() == b"ef01234567"
+
 async def test_filereader():
     stream = FileReader("tests/testbinaryvault/README.md")
     contents = await stream.read()
@@ -102,3 +129,126 @@ async def test_limit():
             length += len(contents)
         await limited.close()
         assert length == limit
+
+async def test_spool():
+    for max_size in (0, 100, 1024 * 1024):
+        spool = Once(b"abcdefgh") >> Repeat(241) >> Buffered(100) >> SpoolWriter(max_size)
+        await spool.consume()
+        assert spool.bytes_written == 241 * 8
+        contents = await spool.reader().readall()
+        assert contents == b"abcdefgh" * 241
+
+async def test_readinto():
+    hashed = FileReader("tests/testbinaryvault/random200k") >> Hash('sha256')
+    counter = hashed >> Limit(150 * 1024) >> Count()
+    assert counter.supports_readinto
+    buffer = bytearray(1000)
+    while True:
+        if (await counter.readinto(buffer)) == 0:
+            break
+    await counter.close()
+    assert counter.count == 150 * 1024
+
+    contents = await (FileReader("tests/testbinaryvault/random200k") >> Limit(150 * 1024)).readall()
+    assert hashed.hash == hashlib.sha256(contents).hexdigest()
+
+async def test_readinto_fallback():
+    stream = Once(b"0123456789abcdef") >> Repeat(3)
+    assert not stream.supports_readinto
+    buffer = bytearray(10)
+    contents = b""
+    while True:
+        length = await stream.readinto(buffer)
+        if length == 0:
+            break
+        contents += buffer[:length]
+    assert contents == b"0123456789abcdef" * 3
+
+async def test_encrypt_readinto():
+    key = os.urandom(32)
+    for buf_size in (16, 1000, 1024 * 1024):
+        encrypted = FileReader("tests/testbinaryvault/random200k") \
+                >> Buffered(1024) \
+                >> PadAES() \
+                >> EncryptAES(key)
+        buffer = bytearray(buf_size)
+        ciphertext = b""
+        while True:
+            length = await encrypted.readinto(buffer)
+            if length == 0:
+                break
+            ciphertext += buffer[:length]
+        await encrypted.close()
+        decrypted = Once(ciphertext) >> Buffered(1024, 16) >> DecryptAES(key) >> UnpadAES()
+        contents = await decrypted.readall()
+        assert contents == await FileReader("tests/testbinaryvault/random200k").readall()
+
+
+async def test_worker_threads():
+    key = os.urandom(32)
+    set_worker_threads(2)
+    try:
+        hashed = FileReader("tests/testbinaryvault/random200k") >> Hash('sha256')
+        encrypted = hashed >> SnappyCompress() >> Buffered(128 * 1024) \
+                >> PadAES() >> EncryptAES(key)
+        ciphertext = await encrypted.readall()
+        decrypted = Once(ciphertext) >> Buffered(128 * 1024, 16) >> DecryptAES(key) \
+                >> UnpadAES() >> SnappyDecompress()
+        contents = await decrypted.readall()
+    finally:
+        set_worker_threads(0)
+    original = await FileReader("tests/testbinaryvault/random200k").readall()
+    assert contents == original
+    assert hashed.hash == hashlib.sha256(original).hexdigest()
+
+
+async def test_filewriter(tmpdir):
+    original = await FileReader("tests/testbinaryvault/random200k").readall()
+    filename = str(tmpdir.join("subdir", "random200k"))
+    for size in (None, len(original), 2 * len(original)):
+        for fsync in ('none', 'finalize', 'directory'):
+            writer = FileWriter(filename, create_dirs=True, store_temporary=True, size=size,
+                                fsync=fsync, buffer_size=64 * 1024)
+            await (FileReader("tests/testbinaryvault/random200k") >> Buffered(1000) >> writer) \
+                    .consume()
+            await writer.finalize()
+            assert writer.bytes_written == len(original)
+            # Space that has been reserved in excess is given back
+            assert os.path.getsize(filename) == len(original)
+            assert await FileReader(filename).readall() == original
+
+    with pytest.raises(ValueError):
+        FileWriter(filename, fsync='always')
+
+
+async def test_filereader_mmap(tmpdir):
+    original = await FileReader("tests/testbinaryvault/random200k", mmap_threshold=None).readall()
+    reader = FileReader("tests/testbinaryvault/random200k", mmap_threshold=1024)
+    hashed = reader >> Hash('sha256')
+    compressed = hashed >> SnappyCompress()
+    decompressed = Once(await compressed.readall()) >> SnappyDecompress()
+    assert await decompressed.readall() == original
+    assert hashed.hash == hashlib.sha256(original).hexdigest()
+
+    # Files that change while being read are read through the file handle from then on
+    filename = str(tmpdir.join("growing"))
+    shutil.copyfile("tests/testbinaryvault/random200k", filename)
+    reader = FileReader(filename, mmap_threshold=1024)
+    first = await reader.read(1000)
+    assert reader.mapped
+    # Chunks are read-only slices of the mapping
+    assert isinstance(first, memoryview) and first.readonly
+    with open(filename, "ab") as growing:
+        growing.write(b"appended")
+    rest = await reader.readall()
+    assert not reader.mapped
+    await reader.close()
+    # Slices that are still referenced stay valid after the reader has been closed
+    assert bytes(first) + rest == original + b"appended"
+
+    reader = FileReader(filename, mmap_threshold=1024)
+    buffer = bytearray(1000)
+    assert await reader.readinto(buffer) == 1000
+    assert reader.mapped
+    await reader.close()
+    assert bytes(buffer) == original[:1000]